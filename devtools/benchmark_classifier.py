@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Compare ncbi.NameClassifier with ncbi.UNCLASSIFIED_REGEX
+
+Checks that both give the same classification for every name and
+reports the time taken by each. Names are read from names.dmp in a
+taxdump archive or from the names table of a taxonomy database:
+
+    python devtools/benchmark_classifier.py -z taxdmp.zip
+    python devtools/benchmark_classifier.py -d ncbi_taxonomy.db
+"""
+
+import argparse
+import sqlite3
+import sys
+import time
+
+from taxtastic import ncbi
+
+
+def timed(func, names):
+    start = time.time()
+    result = [func(name) for name in names]
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-z', '--taxdump-file', help='taxdmp.zip')
+    source.add_argument('-d', '--database-file', help='taxonomy database')
+    parser.add_argument('-n', '--max-names', type=int,
+                        help='use no more than this many names')
+
+    a = parser.parse_args()
+
+    if a.taxdump_file:
+        names = [row[1] for row in ncbi.read_archive(a.taxdump_file, 'names.dmp')]
+    else:
+        con = sqlite3.connect(a.database_file)
+        con.text_factory = str
+        names = [name for name, in con.execute('SELECT tax_name FROM names')]
+
+    names = names[:a.max_names]
+    print >> sys.stderr, "%d names (%d distinct)" % (len(names), len(set(names)))
+
+    regex = ncbi.UNCLASSIFIED_REGEX
+    expected, regex_time = timed(lambda n: 0 if regex.search(n) else 1, names)
+    print >> sys.stderr, "UNCLASSIFIED_REGEX: %.2fs" % regex_time
+
+    for label, cache_size in [('NameClassifier (no memoization)', 0),
+                              ('NameClassifier', 2 ** 16)]:
+        classifier = ncbi.NameClassifier(ncbi.UNCLASSIFIED_REGEX_COMPONENTS,
+                                         cache_size=cache_size)
+        result, elapsed = timed(classifier.is_classified, names)
+        mismatches = [n for n, x, y in zip(names, expected, result) if x != y]
+        print >> sys.stderr, "%s: %.2fs (%.1fx); %d mismatches" % (
+            label, elapsed, regex_time / elapsed, len(mismatches))
+        for name in mismatches[:10]:
+            print >> sys.stderr, "  " + name
+
+        if mismatches:
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
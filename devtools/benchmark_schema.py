@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Compare the default and compact database schemas
+
+Loads a taxdump archive into a database using each schema (see
+``ncbi.db_connect``) and reports the time taken to load it, the size
+of the database file, and the mean time taken to look up randomly
+chosen tax_ids, both using Taxonomy methods and using SQL queries
+over a single connection (Taxonomy lookups include the cost of
+opening a connection for each query):
+
+    python devtools/benchmark_schema.py -z taxdmp.zip
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from sqlalchemy.sql import select
+
+from taxtastic import ncbi
+from taxtastic.taxonomy import Taxonomy
+
+
+def children(tax, tax_id):
+    s = select([tax.nodes.c.tax_id], tax.nodes.c.parent_id == tax_id)
+    return s.execute().fetchall()
+
+
+def lineage(tax, tax_id):
+    tax.cached = {}
+    return tax.lineage(tax_id)
+
+
+LOOKUPS = [
+    ('_node', lambda tax, tax_id: tax._node(tax_id)),
+    ('primary_from_id', lambda tax, tax_id: tax.primary_from_id(tax_id)),
+    ('lineage', lineage),
+    ('children', children),
+]
+
+QUERIES = [
+    ('node', 'SELECT parent_id, rank FROM nodes WHERE tax_id = ?'),
+    ('primary name', """SELECT tax_name FROM names
+        WHERE tax_id = ? AND is_primary = 1"""),
+    ('children', 'SELECT tax_id FROM nodes WHERE parent_id = ?'),
+    ('merged', 'SELECT new_tax_id FROM merged WHERE old_tax_id = ?'),
+]
+
+
+def timed(func, tax_ids):
+    start = time.time()
+    for tax_id in tax_ids:
+        func(tax_id)
+    return 1e6 * (time.time() - start) / len(tax_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-z', '--taxdump-file', required=True, help='taxdmp.zip')
+    parser.add_argument('-n', '--lookups', type=int, default=1000,
+                        help='number of tax_ids to look up [%(default)s]')
+    parser.add_argument('--bulk-load', action='store_true', default=False,
+                        help='load the databases using db_load(bulk=True)')
+    parser.add_argument('--outdir',
+                        help='keep the databases in this directory')
+
+    a = parser.parse_args()
+
+    outdir = a.outdir or tempfile.mkdtemp()
+    tax_ids = None
+    try:
+        for label, compact in [('default', False), ('compact', True)]:
+            dbname = os.path.join(outdir, label + '.db')
+            start = time.time()
+            engine = ncbi.db_connect(dbname, clobber=True, compact=compact)
+            ncbi.db_load(engine, a.taxdump_file, bulk=a.bulk_load)
+            elapsed = time.time() - start
+            print >> sys.stderr, "%s schema: loaded in %.1fs; %.1f MB" % (
+                label, elapsed, os.path.getsize(dbname) / 1e6)
+
+            tax = Taxonomy(engine, ncbi.RANKS)
+            if tax_ids is None:
+                tax_ids = tax.tax_ids()
+                random.seed(1)
+                tax_ids = random.sample(tax_ids, min(a.lookups, len(tax_ids)))
+
+            for name, func in LOOKUPS:
+                elapsed = timed(lambda tax_id: func(tax, tax_id), tax_ids)
+                print >> sys.stderr, "  Taxonomy.%-16s %7.1f us" % (
+                    name, elapsed)
+
+            con = sqlite3.connect(dbname)
+            for name, sql in QUERIES:
+                elapsed = timed(
+                    lambda tax_id: con.execute(sql, [tax_id]).fetchall(),
+                    tax_ids)
+                print >> sys.stderr, "  SQL %-21s %7.1f us" % (name, elapsed)
+            con.close()
+            engine.dispose()
+    finally:
+        if not a.outdir:
+            shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
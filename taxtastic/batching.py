@@ -0,0 +1,232 @@
+# This file is part of taxtastic.
+#
+#    taxtastic is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    taxtastic is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Non-blocking lookups of lineages and names, gathered into batches.
+
+A BatchingTaxonomy returns a Future for each lookup rather than
+waiting for the database, so that it can be used by code that must
+not block, such as the handlers of an event loop (which can be
+notified using Future.add_done_callback). Lookups made at about the
+same time are answered together using the batch queries of Taxonomy
+(lineages and primary_from_names) in a pool of worker threads, and
+identical lookups that are waiting for an answer share a Future.
+"""
+
+import collections
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+
+class Future(object):
+    """
+    The result of a lookup, which is available once it is done.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits at most timeout seconds (or indefinitely if None) for
+        the lookup, then returns its result or raises its error.
+
+        Raises RuntimeError if the lookup is not done in time.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('lookup not done after {} seconds'.format(
+                timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn(future) when the lookup is done, in the thread that
+        completes it (or immediately if it is done already).
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            self._result, self._error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception('error in callback of %r', self)
+
+    def set_result(self, result):
+        self._finish(result=result)
+
+    def set_exception(self, error):
+        self._finish(error=error)
+
+
+class BatchingTaxonomy(object):
+    """
+    Lookups of lineages and primary names using taxonomy (an instance
+    of Taxonomy), each returning a Future.
+
+    Lookups are queued and dispatched by a separate thread, which
+    waits ``delay`` seconds after the first of a batch for others to
+    arrive and runs batches of at most ``batch_size`` lookups in a
+    pool of ``workers`` threads. A taxonomy used by more than one
+    worker must be created with thread_safe=True, in which case it
+    reads the database through at most ``pool_size`` read-only
+    connections, so no more than that many batches query the database
+    at once; further workers wait for a connection.
+    """
+
+    def __init__(self, taxonomy, workers=4, batch_size=500, delay=0.002):
+        if workers > 1 and not taxonomy.thread_safe:
+            raise ValueError(
+                'BatchingTaxonomy requires Taxonomy(thread_safe=True) '
+                'when workers > 1')
+
+        self.taxonomy = taxonomy
+        self.batch_size = batch_size
+        self.delay = delay
+        # counts of lookups, lookups sharing the Future of another,
+        # and batches
+        self.requests = self.coalesced = self.batches = 0
+
+        self._cond = threading.Condition()
+        self._closed = False
+        # keys: (kind, key); vals: Future of each unfinished lookup
+        self._futures = {}
+        # keys: kind; vals: keys waiting to be dispatched
+        self._queues = collections.OrderedDict(
+            (kind, []) for kind in ['lineage', 'name'])
+
+        self._pool = ThreadPool(workers)
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_lineage(self, tax_id):
+        """
+        Returns a Future of the lineage of tax_id as returned by
+        Taxonomy.lineages. The lookup raises ValueError if tax_id is
+        not found in nodes.tax_id.
+        """
+        return self._submit('lineage', tax_id)
+
+    def primary_from_name(self, tax_name):
+        """
+        Returns a Future of (tax_id, primary_name, is_primary) as
+        returned by Taxonomy.primary_from_name. The lookup raises
+        ValueError if tax_name is not found in names.tax_name.
+        """
+        return self._submit('name', tax_name)
+
+    def close(self):
+        """
+        Finishes the lookups already made, then stops the threads.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._dispatcher.join()
+        self._pool.close()
+        self._pool.join()
+
+    def _submit(self, kind, key):
+        with self._cond:
+            if self._closed:
+                raise ValueError('lookup using a closed BatchingTaxonomy')
+            self.requests += 1
+            future = self._futures.get((kind, key))
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._futures[(kind, key)] = Future()
+            self._queues[kind].append(key)
+            self._cond.notify()
+        return future
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._closed and not any(self._queues.values()):
+                    self._cond.wait()
+                if self._closed and not any(self._queues.values()):
+                    return
+                full = any(len(queue) >= self.batch_size
+                           for queue in self._queues.values())
+
+            if not full:
+                # wait for more lookups to join the batch
+                time.sleep(self.delay)
+
+            with self._cond:
+                batches = []
+                for kind, queue in self._queues.items():
+                    while queue:
+                        batches.append((kind, queue[:self.batch_size]))
+                        del queue[:self.batch_size]
+                self.batches += len(batches)
+
+            for kind, keys in batches:
+                self._pool.apply_async(self._run, (kind, keys))
+
+    def _run(self, kind, keys):
+        results, errors = {}, {}
+        try:
+            if kind == 'lineage':
+                found = self.taxonomy.lineages(keys, ignore_missing=True)
+                msg = 'value "{}" not found in nodes.tax_id'
+            else:
+                found, _, _ = self.taxonomy.primary_from_names(keys)
+                msg = '"{}" not found in names.tax_names'
+            for key in keys:
+                if key in found:
+                    results[key] = found[key]
+                else:
+                    errors[key] = ValueError(msg.format(key))
+        except Exception as err:
+            log.exception('error looking up %d keys', len(keys))
+            errors = dict.fromkeys(keys, err)
+
+        with self._cond:
+            futures = [(key, self._futures.pop((kind, key)))
+                       for key in keys]
+        for key, future in futures:
+            if key in errors:
+                future.set_exception(errors[key])
+            else:
+                future.set_result(results[key])
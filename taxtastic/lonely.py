@@ -86,12 +86,17 @@ def lonely_company(taxonomy, tax_ids):
 
     The returned species will probably themselves be lonely.
     """
-    return [taxonomy.species_below(taxonomy.sibling_of(t)) for t in tax_ids]
+    siblings = [taxonomy.sibling_of(t) for t in tax_ids]
+    species = taxonomy.species_below_many(siblings)
+    return [species.get(s) for s in siblings]
 
 
 def solid_company(taxonomy, tax_ids):
     """Return a set of non-lonely species tax_ids that will make those in *tax_ids* not lonely."""
+    siblings = [taxonomy.sibling_of(t) for t in tax_ids]
+    subtrees = taxonomy.nary_subtree_many(
+        [s for s in siblings if s is not None], 2)
     res = []
-    for t in tax_ids:
-        res.extend(taxonomy.nary_subtree(taxonomy.sibling_of(t), 2) or [])
+    for s in siblings:
+        res.extend(subtrees.get(s) or [])
     return res
@@ -16,21 +16,29 @@
 Methods and variables specific to the NCBI taxonomy.
 """
 
+import array
+import collections
+import contextlib
+import csv
 import itertools
 import logging
-import operator
+import multiprocessing
 import os
 import re
 import sqlite3
+import sre_constants
+import sre_parse
 import urllib
 import zipfile
 
 import sqlalchemy
 from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 from errors import IntegrityError
+from utils import peak_memory
 
 log = logging
 
@@ -38,6 +46,22 @@ Base = declarative_base()
 
 DATA_URL = 'ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdmp.zip'
 
+# row of table "source" identifying nodes loaded from a taxdmp archive
+NCBI_SOURCE = {'id': 1, 'name': 'NCBI', 'description': 'NCBI taxonomy'}
+
+# number of bytes of each taxdmp file to decompress at a time
+CHUNK_SIZE = 2 ** 20
+
+# settings for the connection used to load data in bulk-load mode:
+# durability is traded for speed, and the page cache is enlarged to
+# speed up index creation (cache_size is in KiB when negative)
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -{}'.format(2 ** 18),
+    'PRAGMA temp_store = MEMORY',
+]
+
 
 class Node(Base):
     __tablename__ = 'nodes'
@@ -82,6 +106,177 @@ class Source(Base):
     description = Column(String)
 
 
+# The compact schema (see db_connect) stores tax_ids as integers in
+# tables without a rowid, and ranks and name classes as keys of lookup
+# tables. Views named "nodes" and "names" provide the same columns as
+# the tables in the default schema; inserts, updates and deletes using
+# the views are applied to the underlying tables by triggers (updates
+# of only is_valid or is_primary use simpler triggers). Values of
+# tax_ids that are not integers are stored as text.
+CompactBase = declarative_base()
+
+
+class Rank(CompactBase):
+    __tablename__ = 'ranks'
+
+    id = Column(Integer, primary_key=True)
+    rank = Column(String, unique=True)
+
+
+class NameClass(CompactBase):
+    __tablename__ = 'name_classes'
+
+    id = Column(Integer, primary_key=True)
+    name_class = Column(String, unique=True)
+
+
+class CompactNode(CompactBase):
+    __tablename__ = 'compact_nodes'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    tax_id = Column(Integer, primary_key=True, autoincrement=False)
+    parent_id = Column(Integer, index=True)
+    rank_id = Column(Integer, ForeignKey('ranks.id'), index=True)
+    embl_code = Column(String)
+    division_id = Column(String)
+    source_id = Column(Integer, server_default='1')
+    is_valid = Column(Boolean, server_default='1', index=True)
+
+
+class CompactName(CompactBase):
+    __tablename__ = 'compact_names'
+
+    id = Column(Integer, primary_key=True)
+    tax_id = Column(Integer, index=True)
+    tax_name = Column(String, index=True)
+    unique_name = Column(String)
+    name_class_id = Column(Integer, ForeignKey('name_classes.id'))
+    is_primary = Column(Boolean)
+    is_classified = Column(Boolean)
+
+
+Index('ix_compact_names_tax_id_is_primary',
+      CompactName.tax_id, CompactName.is_primary)
+
+
+class CompactMerge(CompactBase):
+    __tablename__ = 'merged'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    old_tax_id = Column(Integer, primary_key=True, autoincrement=False)
+    new_tax_id = Column(Integer, index=True)
+
+
+# table of the compact schema underlying each table of the default schema
+COMPACT_TABLES = {
+    'nodes': 'compact_nodes',
+    'names': 'compact_names',
+    'merged': 'merged',
+}
+
+COMPACT_VIEWS = [
+    """CREATE VIEW IF NOT EXISTS nodes AS
+    SELECT n.tax_id, n.parent_id, ranks.rank, n.embl_code, n.division_id,
+           n.source_id, n.is_valid
+    FROM compact_nodes n
+        JOIN ranks ON ranks.id = n.rank_id""",
+    """CREATE TRIGGER IF NOT EXISTS nodes_insert INSTEAD OF INSERT ON nodes
+    BEGIN
+        INSERT INTO ranks (rank) SELECT NEW.rank
+        WHERE NOT EXISTS (SELECT 1 FROM ranks WHERE rank IS NEW.rank);
+        INSERT INTO compact_nodes VALUES (
+            NEW.tax_id, NEW.parent_id,
+            (SELECT id FROM ranks WHERE rank IS NEW.rank),
+            NEW.embl_code, NEW.division_id, COALESCE(NEW.source_id, 1),
+            COALESCE(NEW.is_valid, 1));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS nodes_update
+    INSTEAD OF UPDATE OF tax_id, parent_id, rank, embl_code, division_id,
+        source_id ON nodes
+    BEGIN
+        INSERT INTO ranks (rank) SELECT NEW.rank
+        WHERE NOT EXISTS (SELECT 1 FROM ranks WHERE rank IS NEW.rank);
+        UPDATE compact_nodes SET
+            tax_id = NEW.tax_id, parent_id = NEW.parent_id,
+            rank_id = (SELECT id FROM ranks WHERE rank IS NEW.rank),
+            embl_code = NEW.embl_code, division_id = NEW.division_id,
+            source_id = NEW.source_id, is_valid = NEW.is_valid
+        WHERE tax_id = OLD.tax_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS nodes_update_is_valid
+    INSTEAD OF UPDATE OF is_valid ON nodes
+    BEGIN
+        UPDATE compact_nodes SET is_valid = NEW.is_valid
+        WHERE tax_id = OLD.tax_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS nodes_delete INSTEAD OF DELETE ON nodes
+    BEGIN
+        DELETE FROM compact_nodes WHERE tax_id = OLD.tax_id;
+    END""",
+    """CREATE VIEW IF NOT EXISTS names AS
+    SELECT n.id, n.tax_id, n.tax_name, n.unique_name,
+           name_classes.name_class, n.is_primary, n.is_classified
+    FROM compact_names n
+        JOIN name_classes ON name_classes.id = n.name_class_id""",
+    """CREATE TRIGGER IF NOT EXISTS names_insert INSTEAD OF INSERT ON names
+    BEGIN
+        INSERT INTO name_classes (name_class) SELECT NEW.name_class
+        WHERE NOT EXISTS (
+            SELECT 1 FROM name_classes WHERE name_class IS NEW.name_class);
+        INSERT INTO compact_names VALUES (
+            NEW.id, NEW.tax_id, NEW.tax_name, NEW.unique_name,
+            (SELECT id FROM name_classes WHERE name_class IS NEW.name_class),
+            NEW.is_primary, NEW.is_classified);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS names_update
+    INSTEAD OF UPDATE OF id, tax_id, tax_name, unique_name, name_class
+    ON names
+    BEGIN
+        INSERT INTO name_classes (name_class) SELECT NEW.name_class
+        WHERE NOT EXISTS (
+            SELECT 1 FROM name_classes WHERE name_class IS NEW.name_class);
+        UPDATE compact_names SET
+            id = NEW.id, tax_id = NEW.tax_id, tax_name = NEW.tax_name,
+            unique_name = NEW.unique_name,
+            name_class_id = (SELECT id FROM name_classes
+                             WHERE name_class IS NEW.name_class),
+            is_primary = NEW.is_primary, is_classified = NEW.is_classified
+        WHERE id = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS names_update_is_primary
+    INSTEAD OF UPDATE OF is_primary, is_classified ON names
+    BEGIN
+        UPDATE compact_names SET
+            is_primary = NEW.is_primary, is_classified = NEW.is_classified
+        WHERE id = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS names_delete INSTEAD OF DELETE ON names
+    BEGIN
+        DELETE FROM compact_names WHERE id = OLD.id;
+    END""",
+]
+
+# columns containing tax_ids in each table or view
+TAX_ID_COLUMNS = {
+    'nodes': ['tax_id', 'parent_id'],
+    'names': ['tax_id'],
+    'merged': ['old_tax_id', 'new_tax_id'],
+    'ancestors': ['tax_id', 'ancestor_id'],
+}
+
+
+class TaxId(TypeDecorator):
+    """
+    Represents tax_ids as strings regardless of how they are stored
+    (see ``TAX_ID_COLUMNS``).
+    """
+
+    impl = String
+
+    def process_result_value(self, value, dialect):
+        return value if value is None else unicode(value)
+
+
 RANKS = [
     'root',
     'superkingdom',
@@ -188,11 +383,218 @@ UNCLASSIFIED_REGEX_COMPONENTS = [r'-like\b',
 UNCLASSIFIED_REGEX = re.compile('|'.join(UNCLASSIFIED_REGEX_COMPONENTS))
 
 
-def db_connect(dbname='ncbi_taxonomy.db', clobber=False):
+def _item_strings(op, av, limit):
+    """
+    Return the list of strings matched by the parsed regular expression
+    element ``(op, av)``, or None if it may match anything other than
+    a small number (no more than ``limit``) of literal strings.
+    """
+
+    if op == sre_constants.LITERAL:
+        return [chr(av)]
+    elif op == sre_constants.IN:
+        chars = []
+        for in_op, in_av in av:
+            if in_op == sre_constants.LITERAL:
+                chars.append(chr(in_av))
+            elif in_op == sre_constants.RANGE:
+                chars.extend(chr(c) for c in range(in_av[0], in_av[1] + 1))
+            else:
+                return None
+        return chars if len(chars) <= limit else None
+    elif op == sre_constants.SUBPATTERN:
+        # the subpattern is the last element of av
+        return _sequence_strings(av[-1], limit)
+    elif op == sre_constants.BRANCH:
+        strings = []
+        for branch in av[1]:
+            branch_strings = _sequence_strings(branch, limit)
+            if branch_strings is None:
+                return None
+            strings.extend(branch_strings)
+        return strings if len(strings) <= limit else None
+    else:
+        return None
+
+
+def _sequence_strings(items, limit):
+    """
+    Return the list of strings matched by a sequence of parsed regular
+    expression elements (see ``_item_strings``), or None.
+    """
+
+    strings = ['']
+    for op, av in items:
+        item_strings = _item_strings(op, av, limit)
+        if item_strings is None or \
+           len(strings) * len(item_strings) > limit:
+            return None
+        strings = [a + b for a in strings for b in item_strings]
+    return strings
+
+
+def required_literals(pattern, limit=16):
+    """
+    Return ``(literals, exact)``, where ``literals`` is a list of
+    strings at least one of which is contained in any string matched
+    by regular expression ``pattern``, and ``exact`` is True if
+    ``pattern`` matches a string if and only if the string contains
+    one of ``literals``. Literals are taken from the run of consecutive
+    elements of ``pattern`` that match the longest (shortest of no
+    more than ``limit``) literal strings. ``literals`` is None if
+    ``pattern`` has no such run.
+    """
+
+    items = list(sre_parse.parse(pattern))
+
+    best, run, runs = None, [''], []
+    for op, av in items:
+        item_strings = _item_strings(op, av, limit)
+        if item_strings is None or len(run) * len(item_strings) > limit:
+            runs.append(run)
+            run = [''] if item_strings is None else item_strings
+        else:
+            run = [a + b for a in run for b in item_strings]
+    runs.append(run)
+
+    best = max(runs, key=lambda r: (min(len(s) for s in r), -len(r)))
+    if not any(best):
+        return None, False
+
+    exact = len(runs) == 1
+    return sorted(set(best)), exact
+
+
+def _trie_pattern(words):
+    """
+    Return a regular expression matching any of ``words``, compiled
+    from a trie of the words so that alternatives sharing a prefix are
+    tried together; where one word is a prefix of another, the
+    longest match is preferred.
+    """
+
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        elif len(branches) == 1 and '' not in node:
+            return branches[0]
+        pattern = '(?:' + '|'.join(branches) + ')'
+        return pattern + '?' if '' in node else pattern
+
+    return build(trie)
+
+
+class NameClassifier(object):
+    """
+    Decides whether names match any of a list of regular expressions
+    more quickly than a single alternation of the expressions.
+
+    Each expression containing a run of literal text is indexed under
+    the literal strings (see ``required_literals``); all literals are
+    located in a single pass using a regular expression compiled from
+    a trie of the literals. An expression is only evaluated if one of
+    its literals is present, and not at all if it is equivalent to the
+    presence of a literal. The remaining expressions are combined into
+    a single regular expression. Results are memoized for up to
+    ``cache_size`` distinct names.
+
+    >>> classifier = NameClassifier(UNCLASSIFIED_REGEX_COMPONENTS)
+    >>> classifier.is_classified('Lactobacillus crispatus')
+    1
+    >>> classifier.is_classified('uncultured bacterium')
+    0
+    """
+
+    def __init__(self, patterns, cache_size=2 ** 16):
+        self.patterns = list(patterns)
+        self.cache_size = cache_size
+        self.cache = {}
+
+        # keys: literal; vals: list of (exact, compiled pattern)
+        indexed = {}
+        others = []
+        for pattern in self.patterns:
+            literals, exact = required_literals(pattern)
+            if literals is None or min(len(s) for s in literals) < 3:
+                others.append(pattern)
+                continue
+            for literal in literals:
+                indexed.setdefault(literal, []).append(
+                    (exact, re.compile(pattern)))
+
+        # a literal is found only where it is the longest literal
+        # starting at a given position, so each literal also implies
+        # the presence of any other literal that is its prefix
+        self.candidates = {}
+        for literal in indexed:
+            self.candidates[literal] = [
+                candidate
+                for other, candidates in sorted(indexed.items())
+                if literal.startswith(other)
+                for candidate in candidates]
+
+        self.literal_regex = re.compile(
+            '(?=({}))'.format(_trie_pattern(self.candidates)))
+        self.other_regex = re.compile('|'.join(others)) if others else None
+
+    def _search(self, name):
+        checked = set()
+        for match in self.literal_regex.finditer(name):
+            for exact, regex in self.candidates[match.group(1)]:
+                if exact:
+                    return True
+                if regex.pattern not in checked:
+                    if regex.search(name):
+                        return True
+                    checked.add(regex.pattern)
+
+        return bool(self.other_regex and self.other_regex.search(name))
+
+    def search(self, name):
+        """
+        Return True if ``name`` matches any of the patterns, False
+        otherwise. Provides the same truth value as
+        ``re.compile('|'.join(patterns)).search(name)``.
+        """
+
+        try:
+            return self.cache[name]
+        except KeyError:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            result = self.cache[name] = self._search(name)
+            return result
+
+    def is_classified(self, name):
+        """
+        Return 0 if ``name`` matches any of the patterns, 1 otherwise.
+        """
+
+        return 0 if self.search(name) else 1
+
+
+# equivalent to, and faster than, UNCLASSIFIED_REGEX
+UNCLASSIFIED_CLASSIFIER = NameClassifier(UNCLASSIFIED_REGEX_COMPONENTS)
+
+
+def db_connect(dbname='ncbi_taxonomy.db', clobber=False, compact=False):
     """
     Create a connection object to a database. Attempt to establish a
     schema. If there are existing tables, delete them if clobber is
     True and return otherwise. Returns a sqlalchemy engine object.
+
+    If ``compact`` is True, a new database is created using the
+    compact schema (see ``CompactBase``); an existing database keeps
+    its schema.
     """
 
     if clobber:
@@ -203,79 +605,520 @@ def db_connect(dbname='ncbi_taxonomy.db', clobber=False):
             pass
 
     engine = sqlalchemy.create_engine('sqlite:///{0}'.format(dbname))
-    Base.metadata.create_all(bind=engine)
+    exists = engine.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'nodes'").first()
+    if compact and not exists or is_compact(engine):
+        CompactBase.metadata.create_all(bind=engine)
+        Base.metadata.create_all(bind=engine, tables=[Source.__table__])
+        with engine.begin() as conn:
+            for statement in COMPACT_VIEWS:
+                conn.execute(statement)
+    else:
+        Base.metadata.create_all(bind=engine)
     return engine
 
 
-def db_load(engine, archive, maxrows=None):
+def is_compact(bind):
+    """
+    Return True if the database identified by engine or connection
+    ``bind`` uses the compact schema.
+    """
+
+    return bind.execute("""SELECT 1 FROM sqlite_master
+        WHERE type = 'table' AND name = 'compact_nodes'""").first() is not None
+
+
+def tax_id_type(bind):
+    """
+    Return the column type to use for tax_ids in temporary tables. The
+    type has the same affinity as nodes.tax_id so that comparisons
+    with it can use its indexes.
+    """
+
+    # INT rather than INTEGER, which would make an INTEGER PRIMARY KEY
+    # an alias for the rowid
+    return 'INT' if is_compact(bind) else 'TEXT'
+
+
+@contextlib.contextmanager
+def transaction(bind):
+    """
+    Context manager providing a connection within a transaction, like
+    ``Engine.begin()``. ``bind`` may also be a Connection, in which case
+    its current transaction (if any) is joined; this allows functions
+    using temporary tables to share a single connection.
+    """
+
+    if isinstance(bind, sqlalchemy.engine.Connection):
+        with bind.begin():
+            yield bind
+    else:
+        with bind.begin() as conn:
+            yield conn
+
+
+def log_peak_memory():
+    peak = peak_memory()
+    if peak is not None:
+        logging.info("Peak memory usage: %.1f MB", peak)
+
+
+def db_load(engine, archive, maxrows=None, bulk=False, workers=1,
+            primary_report=None):
     """
     Load data from zip archive into database identified by con. Data
     is not loaded if target tables already contain data.
+
+    If ``bulk`` is True, rows are inserted using ``bulk_insert`` over
+    a single connection configured with ``BULK_LOAD_PRAGMAS``. Indexes
+    of the loaded tables are created in a single pass once all data
+    is loaded, and the database is analyzed at the end of the load.
+
+    If ``workers`` is greater than 1, the taxdmp files are parsed by a
+    pool of that many processes (see ``parse_archive``) while rows are
+    inserted by this one. The resulting database is identical to the
+    one produced by a serial load.
+
+    ``primary_report`` is passed to ``fix_missing_primary``.
     """
 
+    # start worker processes before opening any database connections
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    queue_size = 2 * workers
+
+    if bulk:
+        connection = engine.raw_connection()
+        cursor = connection.cursor()
+        for pragma in BULK_LOAD_PRAGMAS:
+            cursor.execute(pragma)
+
+        def insert(tablename, rows):
+            return bulk_insert(connection, tablename, rows, maxrows,
+                               add=False)
+    else:
+        def insert(tablename, rows):
+            return do_insert(engine, tablename, rows, maxrows, add=False)
+
     try:
         # nodes
         logging.info("Inserting nodes")
-        rows = read_nodes(
-            rows=read_archive(archive, 'nodes.dmp'),
-            ncbi_source_id=1)
-        # Add is_valid
-        do_insert(engine, 'nodes', rows, maxrows, add=False)
+        rows = parse_archive(archive, 'nodes.dmp', pool, queue_size)
+        insert('nodes', rows)
+        log_peak_memory()
 
         # names
         logging.info("Inserting names")
-        rows = read_names(
-            rows=read_archive(archive, 'names.dmp'),
-            unclassified_regex=UNCLASSIFIED_REGEX)
-        do_insert(engine, 'names', rows, maxrows, add=False)
+        rows = parse_archive(archive, 'names.dmp', pool, queue_size)
+        insert('names', rows)
+        log_peak_memory()
 
         # merged
         logging.info("Inserting merged")
-        rows = read_archive(archive, 'merged.dmp')
-        rows = (dict(zip(['old_tax_id', 'new_tax_id'], row)) for row in rows)
-        do_insert(engine, 'merged', rows, maxrows, add=False)
+        rows = parse_archive(archive, 'merged.dmp', pool, queue_size)
+        insert('merged', rows)
+        log_peak_memory()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+
+        if bulk:
+            connection.close()
+            create_indexes(engine)
 
-        fix_missing_primary(engine)
+        with engine.begin() as conn:
+            conn.execute("""INSERT OR IGNORE INTO source (id, name, description)
+                VALUES (:id, :name, :description)""", NCBI_SOURCE)
+
+        fix_missing_primary(engine, report=primary_report)
 
         # Mark names as valid/invalid
         mark_is_valid(engine)
         update_subtree_validity(engine)
 
+        if bulk:
+            logging.info("Analyzing database")
+            with engine.begin() as conn:
+                conn.execute('ANALYZE')
+
     except sqlite3.IntegrityError as err:
         raise IntegrityError(err)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
+    log_peak_memory()
 
-def fix_missing_primary(engine):
-    with engine.begin() as cursor:
-        missing_primary = """SELECT tax_id
-            FROM names
-            GROUP BY tax_id
-            HAVING SUM(is_primary) = 0;"""
-        rows_for_taxid = """SELECT tax_id, tax_name, unique_name, name_class
-            FROM names
-            WHERE tax_id = ?"""
-        tax_ids = [i[0] for i in cursor.execute(missing_primary)]
-        logging.warn("%d records lack primary names", len(tax_ids))
-
-        for tax_id in tax_ids:
-            records = list(cursor.execute(rows_for_taxid, [tax_id]))
-            # Prefer scientific name
-            if sum(list(i)[-1] == 'scientific name' for i in records) == 1:
-                tax_id, tax_name, unique_name, name_class = next(i for i in records
-                                                                 if list(i)[-1] == 'scientific name')
-                cursor.execute("""UPDATE names
-                    SET is_primary = 1
-                    WHERE tax_id = ? AND name_class = ?""",
-                               [tax_id, 'scientific name'])
-            else:
-                tax_id, tax_name, unique_name, name_class = records[0]
-            logging.warn("No primary name for tax_id %s. Arbitrarily using %s[%s].",
-                         tax_id, tax_name, name_class)
-            cursor.execute("""UPDATE names
-                SET is_primary = 1
-                WHERE tax_id = ? AND tax_name = ? AND
-                    unique_name = ? AND name_class = ?""",
-                           [tax_id, tax_name, unique_name, name_class])
+
+# columns of each table loaded from a taxdmp archive that are
+# compared by db_update; the first identifies each row
+UPDATE_COLUMNS = {
+    'nodes': ['tax_id', 'parent_id', 'rank', 'embl_code', 'division_id'],
+    'names': ['tax_id', 'tax_name', 'unique_name', 'name_class',
+              'is_primary', 'is_classified'],
+    'merged': ['old_tax_id', 'new_tax_id'],
+}
+
+# temporary tables created by db_update
+UPDATE_TEMP_TABLES = [
+    'new_nodes', 'new_names', 'new_merged', 'custom_nodes',
+    'custom_validity', 'deleted_nodes', 'updated_nodes', 'inserted_nodes',
+    'updated_names']
+
+
+def db_update(engine, archive, workers=1, primary_report=None):
+    """
+    Update a database created by ``db_load`` to match a more recent zip
+    archive.
+
+    The contents of the archive are loaded into temporary tables and
+    compared with the database; only the rows that differ are then
+    inserted, updated or deleted (see ``apply_update``), and
+    ``is_valid`` is recomputed for the affected subtrees. Nodes
+    belonging to a source other than NCBI (for example, nodes added
+    using ``taxit add_nodes``) are kept. Tables "ancestors",
+    "lineages", "normalized_names" and "name_grams" are rebuilt if they
+    exist (see ``build_ancestors``, ``build_lineages``,
+    ``build_name_index`` and ``build_fuzzy_index``). ``workers`` and
+    ``primary_report`` are as in ``db_load``.
+    """
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    queue_size = 2 * workers
+
+    # temporary tables are specific to a connection
+    conn = engine.connect()
+    try:
+        stage_archive(conn, archive, pool, queue_size)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+        log_peak_memory()
+
+        fix_missing_primary(conn, report=primary_report, table='new_names')
+        tax_ids = apply_update(conn)
+        update_validity(conn, tax_ids)
+        restore_custom_validity(conn)
+        if has_table(conn, 'ancestors'):
+            build_ancestors(conn)
+        if has_table(conn, 'lineages'):
+            build_lineages(conn)
+        if has_table(conn, 'normalized_names'):
+            build_name_index(conn)
+        if has_table(conn, 'name_grams'):
+            build_fuzzy_index(conn)
+    except sqlite3.IntegrityError as err:
+        raise IntegrityError(err)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for table in UPDATE_TEMP_TABLES:
+            conn.execute('DROP TABLE IF EXISTS ' + table)
+        conn.close()
+
+    log_peak_memory()
+
+
+def stage_archive(conn, archive, pool=None, queue_size=4):
+    """
+    Load the contents of zip archive ``archive`` into temporary tables
+    "new_nodes", "new_names" and "new_merged" using connection ``conn``.
+    """
+
+    # copying column definitions supports older database schemas
+    for fname, table, tablename in [
+            ('nodes.dmp', 'nodes', 'new_nodes'),
+            ('names.dmp', 'names', 'new_names'),
+            ('merged.dmp', 'merged', 'new_merged')]:
+        columns = UPDATE_COLUMNS[table]
+        conn.execute('CREATE TEMPORARY TABLE {} AS SELECT {} FROM {} WHERE 0'.format(
+            tablename, ', '.join(columns), table))
+
+        logging.info("Staging %s", fname)
+        insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            tablename, ', '.join(columns),
+            ', '.join(':' + column for column in columns))
+        rows = parse_archive(archive, fname, pool, queue_size)
+        for chunk in partition(rows, 5000):
+            conn.execute(insert, chunk)
+
+        conn.execute('CREATE INDEX {0}_{1} ON {0} ({1})'.format(
+            tablename, columns[0]))
+
+
+def apply_update(conn, source_name=NCBI_SOURCE['name']):
+    """
+    Apply the differences between the tables staged by
+    ``stage_archive`` and the database in a single transaction. Returns
+    a list of tax_ids at the root of subtrees whose validity may have
+    changed.
+
+    Nodes with a source other than ``source_name`` are considered
+    custom nodes and are kept unless the archive contains the same
+    tax_id. Nodes whose parent is a custom node keep their parent;
+    custom nodes whose parent was merged into another node are moved
+    to that node. All names of a tax_id are replaced if any differ.
+    """
+
+    name_columns = ', '.join(UPDATE_COLUMNS['names'])
+
+    # values of nodes from the archive, except that nodes keep a
+    # custom parent
+    new_values = dict(
+        (column, 'new_nodes.' + column) for column in UPDATE_COLUMNS['nodes'])
+    new_values['parent_id'] = """
+        CASE WHEN nodes.parent_id IN (SELECT tax_id FROM custom_nodes)
+             THEN nodes.parent_id ELSE new_nodes.parent_id END"""
+    node_columns = UPDATE_COLUMNS['nodes'][1:]
+    changed = ' OR '.join('{} IS NOT nodes.{}'.format(new_values[column], column)
+                          for column in node_columns)
+    assignments = ', '.join(
+        '{} = (SELECT {} FROM new_nodes '
+        'WHERE new_nodes.tax_id = nodes.tax_id)'.format(column, new_values[column])
+        for column in node_columns)
+
+    tax_id = tax_id_type(conn)
+    for table in ['custom_nodes', 'deleted_nodes', 'updated_nodes',
+                  'inserted_nodes', 'updated_names']:
+        conn.execute('CREATE TEMPORARY TABLE {} (tax_id {} PRIMARY KEY)'.format(
+            table, tax_id))
+    conn.execute("""CREATE TEMPORARY TABLE custom_validity (
+        tax_id {} PRIMARY KEY, is_valid BOOLEAN)""".format(tax_id))
+
+    with conn.begin():
+        source_id = conn.execute(
+            'SELECT id FROM source WHERE name = ?', [source_name]).scalar()
+        if source_id is None:
+            result = conn.execute(
+                'INSERT INTO source (name, description) VALUES (?, ?)',
+                [source_name, NCBI_SOURCE['description']])
+            source_id = result.lastrowid
+
+        conn.execute("""INSERT INTO custom_nodes
+            SELECT tax_id FROM nodes
+            WHERE source_id IN (SELECT id FROM source WHERE id != ?)
+                AND tax_id NOT IN (SELECT tax_id FROM new_nodes)""",
+                     [source_id])
+        conn.execute("""INSERT INTO custom_validity
+            SELECT tax_id, is_valid FROM nodes
+            WHERE tax_id IN (SELECT tax_id FROM custom_nodes)""")
+
+        # nodes
+        conn.execute("""INSERT INTO deleted_nodes
+            SELECT tax_id FROM nodes
+            WHERE tax_id NOT IN (SELECT tax_id FROM new_nodes)
+                AND tax_id NOT IN (SELECT tax_id FROM custom_nodes)""")
+        conn.execute("""INSERT INTO updated_nodes
+            SELECT nodes.tax_id
+            FROM nodes
+                JOIN new_nodes ON new_nodes.tax_id = nodes.tax_id
+            WHERE {} OR nodes.source_id IS NOT ?""".format(changed),
+                     [source_id])
+        conn.execute("""INSERT INTO inserted_nodes
+            SELECT tax_id FROM new_nodes
+            WHERE tax_id NOT IN (SELECT tax_id FROM nodes)""")
+
+        conn.execute("""DELETE FROM nodes
+            WHERE tax_id IN (SELECT tax_id FROM deleted_nodes)""")
+        conn.execute("""UPDATE nodes SET {}, source_id = ?
+            WHERE tax_id IN (SELECT tax_id FROM updated_nodes)""".format(
+            assignments), [source_id])
+        conn.execute("""INSERT INTO nodes ({0}, source_id)
+            SELECT {0}, ? FROM new_nodes
+            WHERE tax_id IN (SELECT tax_id FROM inserted_nodes)
+            ORDER BY new_nodes.rowid""".format(
+            ', '.join(UPDATE_COLUMNS['nodes'])), [source_id])
+
+        # custom nodes whose parent was deleted
+        conn.execute("""INSERT INTO updated_nodes
+            SELECT tax_id FROM nodes
+            WHERE tax_id IN (SELECT tax_id FROM custom_nodes)
+                AND parent_id IN (SELECT old_tax_id FROM new_merged)
+                AND parent_id IN (SELECT tax_id FROM deleted_nodes)""")
+        conn.execute("""UPDATE nodes SET parent_id = (
+                SELECT new_tax_id FROM new_merged
+                WHERE old_tax_id = nodes.parent_id)
+            WHERE tax_id IN (SELECT tax_id FROM custom_nodes)
+                AND tax_id IN (SELECT tax_id FROM updated_nodes)""")
+        orphans = conn.execute("""SELECT tax_id FROM nodes
+            WHERE tax_id IN (SELECT tax_id FROM custom_nodes)
+                AND parent_id IN (SELECT tax_id FROM deleted_nodes)""")
+        for tax_id, in orphans:
+            logging.warn("Parent of custom node %s was deleted", tax_id)
+
+        # names, compared as multisets by counting rows
+        conn.execute("""INSERT INTO updated_names
+            SELECT DISTINCT tax_id FROM (
+                SELECT * FROM (
+                    SELECT {0}, COUNT(*) FROM names
+                    WHERE tax_id NOT IN (SELECT tax_id FROM custom_nodes)
+                    GROUP BY {0}
+                    EXCEPT
+                    SELECT {0}, COUNT(*) FROM new_names GROUP BY {0})
+                UNION ALL
+                SELECT * FROM (
+                    SELECT {0}, COUNT(*) FROM new_names GROUP BY {0}
+                    EXCEPT
+                    SELECT {0}, COUNT(*) FROM names GROUP BY {0}))""".format(
+            name_columns))
+        conn.execute("""DELETE FROM names
+            WHERE tax_id IN (SELECT tax_id FROM updated_names)""")
+        conn.execute("""INSERT INTO names ({0})
+            SELECT {0} FROM new_names
+            WHERE tax_id IN (SELECT tax_id FROM updated_names)
+            ORDER BY new_names.rowid""".format(name_columns))
+
+        # merged
+        def changes(statement):
+            # rowcount is not set by statements applied to a view
+            # using triggers
+            before = conn.execute('SELECT total_changes()').scalar()
+            conn.execute(statement)
+            return conn.execute('SELECT total_changes()').scalar() - before
+
+        deleted_merged = changes("""DELETE FROM merged
+            WHERE NOT EXISTS (
+                SELECT 1 FROM new_merged
+                WHERE new_merged.old_tax_id = merged.old_tax_id
+                    AND new_merged.new_tax_id IS merged.new_tax_id)""")
+        inserted_merged = changes("""INSERT INTO merged (old_tax_id, new_tax_id)
+            SELECT old_tax_id, new_tax_id FROM new_merged
+            WHERE old_tax_id NOT IN (SELECT old_tax_id FROM merged)
+            ORDER BY new_merged.rowid""")
+
+        def count(table):
+            return conn.execute('SELECT COUNT(*) FROM ' + table).scalar()
+
+        logging.info(
+            "nodes: %d inserted, %d updated, %d deleted, %d custom nodes kept; "
+            "names: %d tax_ids updated; merged: %d inserted, %d deleted",
+            count('inserted_nodes'), count('updated_nodes'),
+            count('deleted_nodes'), count('custom_nodes'),
+            count('updated_names'), inserted_merged, deleted_merged)
+
+    result = conn.execute("""
+        SELECT tax_id FROM updated_nodes
+        UNION SELECT tax_id FROM inserted_nodes
+        UNION SELECT tax_id FROM updated_names""")
+    return [tax_id for tax_id, in result]
+
+
+def restore_custom_validity(conn):
+    """
+    Restore ``is_valid`` of the custom nodes identified by
+    ``apply_update``, which is not determined by the NCBI data.
+    """
+
+    with conn.begin():
+        conn.execute("""UPDATE nodes SET is_valid = (
+                SELECT is_valid FROM custom_validity
+                WHERE custom_validity.tax_id = nodes.tax_id)
+            WHERE tax_id IN (SELECT tax_id FROM custom_validity)""")
+
+
+def drop_indexes(connection, tablename):
+    """
+    Drop the indexes defined in the schema for table ``tablename``
+    using DB-API connection ``connection``. For a database using the
+    compact schema, ``tablename`` identifies a view, and the indexes of
+    the underlying table are dropped.
+    """
+
+    cursor = connection.cursor()
+    compact = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'compact_nodes'").fetchone()
+    if compact:
+        table = CompactBase.metadata.tables[COMPACT_TABLES[tablename]]
+    else:
+        table = Base.metadata.tables[tablename]
+    for index in table.indexes:
+        cursor.execute('DROP INDEX IF EXISTS {}'.format(index.name))
+
+
+def create_indexes(engine):
+    """
+    Create each index defined in the schema that does not yet exist
+    in the database.
+    """
+
+    metadata = CompactBase.metadata if is_compact(engine) else Base.metadata
+    with engine.begin() as conn:
+        existing = set(name for name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in existing:
+                    logging.info("Creating index %s", index.name)
+                    index.create(bind=conn)
+
+
+def fix_missing_primary(engine, report=None, table='names'):
+    """
+    Choose a primary name for each tax_id lacking one. The only
+    scientific name is used if there is exactly one; otherwise the
+    first name listed for the tax_id is used.
+
+    Names are chosen by a single aggregate query and marked using one
+    UPDATE. If ``report`` is a file-like object, a CSV file listing
+    each tax_id and the name chosen for it is written to it. ``table``
+    may name a table other than "names" with the same columns.
+    """
+    # rows are identified by rowid rather than names.id to support
+    # older databases, but names is a view without a rowid in the
+    # compact schema
+    with transaction(engine) as cursor:
+        columns = [row[1] for row in cursor.execute(
+            'PRAGMA table_info({})'.format(table))]
+    rowid = 'id' if 'id' in columns else 'rowid'
+
+    missing_primary = """
+    INSERT INTO missing_primary
+    SELECT {table}.tax_id, tax_name, unique_name, name_class
+    FROM {table}
+        JOIN (SELECT
+                CASE WHEN SUM(name_class = 'scientific name') = 1
+                     THEN MIN(CASE WHEN name_class = 'scientific name'
+                                   THEN {rowid} END)
+                     ELSE MIN({rowid}) END AS name_rowid
+              FROM {table}
+              GROUP BY tax_id
+              HAVING SUM(is_primary) = 0) chosen
+        ON {table}.{rowid} = chosen.name_rowid""".format(table=table, rowid=rowid)
+
+    set_primary = """
+    UPDATE {table} SET is_primary = 1
+    WHERE {rowid} IN (
+        SELECT {table}.{rowid}
+        FROM {table}
+            JOIN missing_primary p
+            ON {table}.tax_id = p.tax_id
+               AND {table}.tax_name = p.tax_name
+               AND {table}.unique_name = p.unique_name
+               AND {table}.name_class = p.name_class)""".format(table=table, rowid=rowid)
+
+    with transaction(engine) as cursor:
+        cursor.execute("""CREATE TEMPORARY TABLE missing_primary (
+            tax_id {} PRIMARY KEY, tax_name TEXT, unique_name TEXT,
+            name_class TEXT)""".format(tax_id_type(cursor)))
+        try:
+            cursor.execute(missing_primary)
+            count, = cursor.execute(
+                'SELECT COUNT(*) FROM missing_primary').first()
+            logging.warn("%d records lack primary names; "
+                         "arbitrarily choosing a name for each", count)
+
+            if report is not None:
+                writer = csv.writer(report)
+                writer.writerow(['tax_id', 'tax_name', 'unique_name',
+                                 'name_class'])
+                writer.writerows(cursor.execute(
+                    'SELECT * FROM missing_primary ORDER BY tax_id'))
+
+            cursor.execute(set_primary)
+        finally:
+            cursor.execute('DROP TABLE missing_primary')
 
 
 def mark_is_valid(engine, regex=UNCLASSIFIED_REGEX):
@@ -306,53 +1149,571 @@ def update_subtree_validity(engine, mark_below_rank='species'):
 
     Also covers the special case of marking the "unclassified Bacteria" subtree
     invalid.
+
+    Subtrees are identified by a single recursive query and ``is_valid``
+    is then updated in one statement for each case; only nodes whose
+    status changes are written. Where subtrees are nested, the status
+    is taken from the most valid ancestor at rank ``mark_below_rank``
+    (NULL < 0 < 1).
     """
-    def generate_in_param(count):
-        return '(' + ', '.join('?' * count) + ')'
-
-    def mark_subtrees(conn, tax_ids, is_valid):
-        to_mark = list(tax_ids)
-        logging.info("Marking %d subtrees as is_valid=%s",
-                     len(to_mark), is_valid)
-        while to_mark:
-            # First, mark nodes
-            conn.execute("""UPDATE nodes SET is_valid = ?
-                WHERE tax_id = ?""",
-                         [[is_valid, tax_id] for tax_id in to_mark])
-
-            # Find children - can exceed the maximum number of parameters in a sqlite query,
-            # so chunk:
-            chunked = partition(to_mark, 250)
-            child_sql = """SELECT tax_id
-                           FROM nodes
-                           WHERE parent_id IN {0}"""
-            to_mark = [i[0] for i in itertools.chain.from_iterable(
-                conn.execute(child_sql.format(generate_in_param(len(chunk))),
-                             chunk) for chunk in chunked)]
-
-    below_rank_query = """
-    SELECT nodes.tax_id, pnodes.is_valid
-    FROM nodes
-        JOIN nodes pnodes ON pnodes.tax_id = nodes.parent_id
-    WHERE pnodes.rank = ?
-    ORDER BY pnodes.is_valid"""
 
-    with engine.begin() as conn:
-        result = list(conn.execute(below_rank_query, [mark_below_rank]))
+    # is_valid is encoded as 0 (NULL), 1 (false) or 2 (true) so that
+    # nested subtrees can be resolved using MAX()
+    subtree_query = """
+    WITH RECURSIVE subtrees(tax_id, code) AS (
+        SELECT nodes.tax_id,
+               CASE WHEN pnodes.is_valid IS NULL THEN 0
+                    WHEN pnodes.is_valid THEN 2 ELSE 1 END
+        FROM nodes
+            JOIN nodes pnodes ON pnodes.tax_id = nodes.parent_id
+        WHERE pnodes.rank = ? AND nodes.tax_id != nodes.parent_id
+        UNION
+        SELECT nodes.tax_id, subtrees.code
+        FROM nodes
+            JOIN subtrees ON nodes.parent_id = subtrees.tax_id
+        WHERE nodes.tax_id != nodes.parent_id
+    )
+    INSERT INTO subtree_validity
+    SELECT tax_id, CASE MAX(code) WHEN 0 THEN NULL ELSE MAX(code) - 1 END
+    FROM subtrees
+    GROUP BY tax_id"""
+
+    unclassified_query = """
+    WITH RECURSIVE subtrees(tax_id) AS (
+        SELECT tax_id FROM names WHERE tax_name = ? AND is_primary = ?
+        UNION
+        SELECT nodes.tax_id
+        FROM nodes
+            JOIN subtrees ON nodes.parent_id = subtrees.tax_id
+    )
+    UPDATE nodes SET is_valid = 0
+    WHERE tax_id IN subtrees AND is_valid IS NOT 0"""
 
-        # Group by validity
-        grouped = itertools.groupby(result, operator.itemgetter(1))
-        for is_valid, records in grouped:
-            tax_ids = [i[0] for i in records]
-            mark_subtrees(conn, tax_ids, is_valid)
+    with engine.begin() as conn:
+        conn.execute("""CREATE TEMPORARY TABLE subtree_validity (
+            tax_id {} PRIMARY KEY, is_valid BOOLEAN)""".format(
+            tax_id_type(conn)))
+        try:
+            conn.execute(subtree_query, [mark_below_rank])
+            subtrees, = conn.execute("""SELECT COUNT(*) FROM nodes
+                JOIN nodes pnodes ON pnodes.tax_id = nodes.parent_id
+                WHERE pnodes.rank = ? AND nodes.tax_id != nodes.parent_id""",
+                                     [mark_below_rank]).first()
+            logging.info("Marking %d subtrees below rank %s",
+                         subtrees, mark_below_rank)
+            count = set_validity(conn, 'subtree_validity')
+            logging.info("Updated is_valid for %d nodes", count)
+        finally:
+            conn.execute("DROP TABLE subtree_validity")
 
         # Special case: unclassified bacteria
         result = list(conn.execute("""SELECT tax_id FROM names WHERE tax_name = ? and is_primary = ?""",
                                    ['unclassified Bacteria', 1]))
         assert len(result) < 2
         logging.info("marking subtrees for unclassified Bacteria invalid")
-        for i, in result:
-            mark_subtrees(conn, [i], 0)
+        conn.execute(unclassified_query, ['unclassified Bacteria', 1])
+
+
+def set_validity(conn, table):
+    """
+    Set ``is_valid`` of nodes to the values in temporary table
+    ``table`` (tax_id, is_valid), which is modified to contain only
+    the nodes whose status changes. Returns the number of nodes
+    updated.
+    """
+
+    conn.execute("""DELETE FROM {0}
+        WHERE is_valid IS (
+            SELECT is_valid FROM nodes WHERE nodes.tax_id = {0}.tax_id)
+        """.format(table))
+    conn.execute("""UPDATE nodes SET is_valid = (
+            SELECT is_valid FROM {0} WHERE {0}.tax_id = nodes.tax_id)
+        WHERE tax_id IN (SELECT tax_id FROM {0})""".format(table))
+    return conn.execute('SELECT COUNT(*) FROM ' + table).scalar()
+
+
+def update_validity(engine, tax_ids, mark_below_rank='species'):
+    """
+    Recompute ``is_valid`` for the subtrees rooted at ``tax_ids``.
+
+    The result is the same as that of ``mark_is_valid`` followed by
+    ``update_subtree_validity``, but only the given subtrees and the
+    lineages above them are visited, so that a database can be updated
+    incrementally. Validity is computed from primary names, so
+    ``is_valid`` of nodes outside the subtrees is not used.
+    """
+
+    # validity of a node based on its primary name, encoded as in
+    # update_subtree_validity: 0 (NULL), 1 (false) or 2 (true)
+    def code(alias):
+        return """COALESCE((SELECT is_classified FROM names
+            WHERE names.tax_id = {0}.tax_id AND names.is_primary = 1) + 1, 0)
+            """.format(alias)
+
+    unclassified = """(SELECT tax_id FROM names
+        WHERE tax_name = :unclassified AND is_primary = 1)"""
+
+    # nodes at the top of each subtree inherit the highest validity
+    # of any ancestor at rank mark_below_rank (or -1 if there is none)
+    # and whether any ancestor is unclassified
+    tops_query = """
+    WITH RECURSIVE tops(tax_id) AS (
+        SELECT nodes.tax_id
+        FROM nodes
+            JOIN validity_region USING (tax_id)
+        WHERE nodes.parent_id IS NULL
+            OR nodes.parent_id = nodes.tax_id
+            OR nodes.parent_id NOT IN (SELECT tax_id FROM validity_region)
+    ), ancestors(tax_id, ancestor_id) AS (
+        SELECT nodes.tax_id, nodes.parent_id
+        FROM nodes
+            JOIN tops USING (tax_id)
+        WHERE nodes.parent_id != nodes.tax_id
+        UNION
+        SELECT ancestors.tax_id, nodes.parent_id
+        FROM ancestors
+            JOIN nodes ON nodes.tax_id = ancestors.ancestor_id
+        WHERE nodes.parent_id != nodes.tax_id
+    ), inherited(tax_id, code, unclassified) AS (
+        SELECT ancestors.tax_id,
+               MAX(CASE WHEN nodes.rank = :rank THEN {code} ELSE -1 END),
+               MAX(nodes.tax_id IN {unclassified})
+        FROM ancestors
+            JOIN nodes ON nodes.tax_id = ancestors.ancestor_id
+        GROUP BY ancestors.tax_id
+    )
+    INSERT INTO validity_tops
+    SELECT tops.tax_id, COALESCE(inherited.code, -1),
+           COALESCE(inherited.unclassified, 0) OR tops.tax_id IN {unclassified}
+    FROM tops
+        LEFT JOIN inherited USING (tax_id)""".format(
+        code=code('nodes'), unclassified=unclassified)
+
+    subtree_query = """
+    WITH RECURSIVE subtrees(tax_id, code, unclassified) AS (
+        SELECT tax_id, code, unclassified FROM validity_tops
+        UNION
+        SELECT nodes.tax_id,
+               MAX(subtrees.code,
+                   CASE WHEN pnodes.rank = :rank THEN {code} ELSE -1 END),
+               subtrees.unclassified OR nodes.tax_id IN {unclassified}
+        FROM subtrees
+            JOIN nodes pnodes ON pnodes.tax_id = subtrees.tax_id
+            JOIN nodes ON nodes.parent_id = subtrees.tax_id
+        WHERE nodes.tax_id != nodes.parent_id
+    )
+    INSERT OR REPLACE INTO validity
+    SELECT nodes.tax_id,
+           NULLIF(CASE WHEN subtrees.unclassified THEN 1
+                       WHEN subtrees.code >= 0 THEN subtrees.code
+                       ELSE {node_code} END, 0) - 1
+    FROM subtrees
+        JOIN nodes USING (tax_id)""".format(
+        code=code('pnodes'), node_code=code('nodes'),
+        unclassified=unclassified)
+
+    params = {'rank': mark_below_rank, 'unclassified': 'unclassified Bacteria'}
+    temp_tables = [
+        'validity_seeds (tax_id {} PRIMARY KEY)',
+        'validity_region (tax_id {} PRIMARY KEY)',
+        'validity_tops (tax_id {} PRIMARY KEY, code INTEGER, '
+        'unclassified INTEGER)',
+        'validity (tax_id {} PRIMARY KEY, is_valid BOOLEAN)',
+    ]
+
+    with transaction(engine) as conn:
+        for table in temp_tables:
+            conn.execute('CREATE TEMPORARY TABLE ' + table.format(
+                tax_id_type(conn)))
+        try:
+            tax_ids = [[tax_id] for tax_id in tax_ids]
+            if tax_ids:
+                conn.execute('INSERT OR IGNORE INTO validity_seeds VALUES (?)',
+                             tax_ids)
+            conn.execute("""
+            WITH RECURSIVE region(tax_id) AS (
+                SELECT tax_id FROM nodes JOIN validity_seeds USING (tax_id)
+                UNION
+                SELECT nodes.tax_id
+                FROM nodes
+                    JOIN region ON nodes.parent_id = region.tax_id
+            )
+            INSERT INTO validity_region SELECT tax_id FROM region""")
+            conn.execute(tops_query, params)
+            conn.execute(subtree_query, params)
+            count = set_validity(conn, 'validity')
+            logging.info("Updated is_valid for %d nodes", count)
+        finally:
+            for table in temp_tables:
+                conn.execute('DROP TABLE ' + table.split()[0])
+
+
+def has_table(bind, tablename):
+    """
+    Return True if the database identified by engine or connection
+    ``bind`` contains a table named ``tablename``.
+    """
+
+    return bind.execute("""SELECT 1 FROM sqlite_master
+        WHERE type = 'table' AND name = ?""", [tablename]).first() is not None
+
+
+def build_ancestors(engine):
+    """
+    Create (or replace) the table "ancestors", a closure table of the
+    taxonomy containing a row (tax_id, ancestor_id, depth) for each
+    node and each node in its lineage, from the node itself (depth 0)
+    to the root. Taxonomy uses this table if it exists to fetch a
+    lineage or the nodes below a tax_id using a single query.
+
+    The table contains roughly one row for each node times the mean
+    depth of the taxonomy, so it is only created on request.
+    """
+
+    # rows are generated in primary key order, since the recursive
+    # query visits the queue ordered by (tax_id, depth)
+    closure_query = """
+    WITH RECURSIVE closure(tax_id, ancestor_id, depth) AS (
+        SELECT tax_id, tax_id, 0 FROM nodes
+        UNION ALL
+        SELECT closure.tax_id, nodes.parent_id, closure.depth + 1
+        FROM closure
+            JOIN nodes ON nodes.tax_id = closure.ancestor_id
+        WHERE nodes.parent_id != nodes.tax_id
+        ORDER BY 1, 3
+    )
+    INSERT INTO ancestors (tax_id, ancestor_id, depth)
+    SELECT tax_id, ancestor_id, depth FROM closure"""
+
+    with transaction(engine) as conn:
+        tax_id = tax_id_type(conn)
+        conn.execute('DROP TABLE IF EXISTS ancestors')
+        conn.execute("""CREATE TABLE ancestors (
+            tax_id {0} NOT NULL,
+            ancestor_id {0} NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (tax_id, depth)
+        ) WITHOUT ROWID""".format(tax_id))
+        logging.info("Creating table ancestors")
+        conn.execute(closure_query)
+        conn.execute("""CREATE INDEX ix_ancestors_ancestor_id
+            ON ancestors (ancestor_id, depth)""")
+        count = conn.execute('SELECT COUNT(*) FROM ancestors').scalar()
+        logging.info("Inserted %d rows into ancestors", count)
+
+
+# columns of table "lineages" preceding a column for each rank
+LINEAGE_COLUMNS = ['tax_id', 'parent_id', 'rank', 'tax_name']
+
+
+def order_ranks(ranks, occurring, undef_prefix='below'):
+    """
+    Return a list of ``ranks`` followed by any ranks in ``occurring``
+    not among them, in the order given by Taxonomy: a rank named
+    "<undef_prefix>_<rank>" directly follows <rank>, and other ranks are
+    placed at the end in the order in which they occur.
+    """
+
+    prefix = undef_prefix + '_'
+
+    def depth(rank):
+        n = 0
+        while rank.startswith(prefix):
+            rank, n = rank[len(prefix):], n + 1
+        return n
+
+    ordered = list(ranks)
+    new_ranks = []
+    for rank in occurring:
+        if rank not in ordered and rank not in new_ranks:
+            new_ranks.append(rank)
+
+    for rank in sorted(new_ranks, key=depth):
+        parent_rank = rank[len(prefix):] if depth(rank) else None
+        if parent_rank in ordered:
+            ordered.insert(ordered.index(parent_rank) + 1, rank)
+        else:
+            ordered.append(rank)
+
+    return ordered
+
+
+def add_lineage_ranks(conn, occurring, undef_prefix='below'):
+    """
+    Add a column to table "lineages" for each rank in ``occurring``
+    lacking one, and update the order of ranks in table
+    "lineage_ranks". Returns the ordered list of ranks.
+    """
+
+    current = [rank for rank, in conn.execute(
+        'SELECT rank FROM lineage_ranks ORDER BY position')]
+    ordered = order_ranks(current, occurring, undef_prefix)
+    if ordered != current:
+        for rank in ordered:
+            if rank not in current:
+                conn.execute(
+                    'ALTER TABLE lineages ADD COLUMN "{}" TEXT'.format(rank))
+        conn.execute('DELETE FROM lineage_ranks')
+        conn.execute('INSERT INTO lineage_ranks (position, rank) VALUES (?, ?)',
+                     list(enumerate(ordered)))
+
+    return ordered
+
+
+def update_lineages(engine, tax_id, no_rank='no_rank', undef_prefix='below',
+                    chunk_size=5000):
+    """
+    Replace the rows of table "lineages" (see ``build_lineages``) for
+    tax_id and each node below it, given the row for its parent. Ranks
+    are named as in Taxonomy: a node with rank ``no_rank`` is given the
+    rank of its parent prefixed by ``undef_prefix``. Returns the number
+    of rows written.
+    """
+
+    # walks the subtree depth first, accumulating the (rank, tax_id)
+    # pairs of the lineage of each node above it in "path"
+    subtree_query = """
+    WITH RECURSIVE subtree(tax_id, parent_id, rank, depth, path) AS (
+        SELECT tax_id, parent_id,
+               CASE WHEN rank = :no_rank THEN :prefix || :parent_rank
+                    ELSE rank END,
+               0, ''
+        FROM nodes
+        WHERE tax_id = :tax_id
+        UNION ALL
+        SELECT nodes.tax_id, nodes.parent_id,
+               CASE WHEN nodes.rank = :no_rank THEN :prefix || subtree.rank
+                    ELSE nodes.rank END,
+               subtree.depth + 1,
+               subtree.path || subtree.rank || char(9) ||
+                   subtree.tax_id || char(9)
+        FROM subtree
+            JOIN nodes ON nodes.parent_id = subtree.tax_id
+        WHERE nodes.tax_id != nodes.parent_id
+        ORDER BY 4 DESC
+    )
+    """
+
+    with transaction(engine) as conn:
+        parent = conn.execute("""SELECT lineages.*
+            FROM nodes
+                JOIN lineages ON lineages.tax_id = CAST(nodes.parent_id AS TEXT)
+            WHERE nodes.tax_id = ? AND nodes.parent_id != nodes.tax_id""",
+                              [tax_id]).first()
+        seed, parent_rank = {}, None
+        if parent is not None:
+            parent_rank = parent['rank']
+            seed = dict((k, v) for k, v in parent.items()
+                        if k not in LINEAGE_COLUMNS and v is not None)
+
+        params = {'tax_id': tax_id, 'no_rank': no_rank,
+                  'prefix': undef_prefix + '_', 'parent_rank': parent_rank}
+        ranks = add_lineage_ranks(conn, [rank for rank, in conn.execute(
+            subtree_query + 'SELECT DISTINCT rank FROM subtree', params)],
+            undef_prefix)
+
+        columns = LINEAGE_COLUMNS + ranks
+        insert = 'INSERT OR REPLACE INTO lineages ({}) VALUES ({})'.format(
+            ', '.join('"{}"'.format(c) for c in columns),
+            ', '.join('?' * len(columns)))
+        result = conn.execute(subtree_query + """
+        SELECT CAST(subtree.tax_id AS TEXT), CAST(subtree.parent_id AS TEXT),
+               subtree.rank, names.tax_name, subtree.path
+        FROM subtree
+            LEFT JOIN names ON names.tax_id = subtree.tax_id
+                AND names.is_primary = 1""", params)
+
+        count = 0
+        while True:
+            chunk = result.fetchmany(chunk_size)
+            if not chunk:
+                break
+            rows = []
+            for _tax_id, _parent_id, rank, tax_name, path in chunk:
+                path = path.split('\t')
+                lineage = dict(seed)
+                lineage.update(zip(path[:-1:2], path[1::2]))
+                lineage[rank] = _tax_id
+                row = [_tax_id, _parent_id, rank, tax_name]
+                row.extend(lineage.get(r) for r in ranks)
+                rows.append(row)
+            conn.execute(insert, rows)
+            count += len(rows)
+
+    return count
+
+
+def build_lineages(engine, ranks=RANKS, no_rank='no_rank',
+                   undef_prefix='below'):
+    """
+    Create (or replace) the table "lineages", containing a row for
+    each node with the columns of ``LINEAGE_COLUMNS`` followed by a
+    column for each rank giving the tax_id of the node of that rank in
+    its lineage, and the table "lineage_ranks" listing the rank of each
+    column in order. Ranks are named as in the output of
+    ``Taxonomy.write_table``, so ``taxit taxtable`` can write its output
+    using a single query of these tables.
+
+    Nodes that are not below a root (a node that is its own parent)
+    are omitted.
+    """
+
+    with transaction(engine) as conn:
+        conn.execute('DROP TABLE IF EXISTS lineages')
+        conn.execute('DROP TABLE IF EXISTS lineage_ranks')
+        conn.execute("""CREATE TABLE lineage_ranks (
+            position INTEGER PRIMARY KEY,
+            rank TEXT NOT NULL UNIQUE
+        )""")
+        conn.execute("""CREATE TABLE lineages (
+            tax_id TEXT PRIMARY KEY,
+            parent_id TEXT,
+            rank TEXT,
+            tax_name TEXT
+        )""")
+        logging.info("Creating table lineages")
+        add_lineage_ranks(conn, ranks, undef_prefix)
+        roots = [tax_id for tax_id, in conn.execute(
+            'SELECT tax_id FROM nodes WHERE tax_id = parent_id')]
+        count = sum(update_lineages(conn, tax_id, no_rank, undef_prefix)
+                    for tax_id in roots)
+        logging.info("Inserted %d rows into lineages", count)
+
+
+NORMALIZE_REGEX = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize_name(tax_name):
+    """
+    Return ``tax_name`` case-folded, with each run of whitespace,
+    punctuation and underscores replaced by a single space and leading
+    and trailing spaces removed, so that (for example) "Escherichia
+    coli", "escherichia_coli " and "[Escherichia] coli" are equivalent.
+    """
+
+    if not isinstance(tax_name, unicode):
+        tax_name = tax_name.decode('utf-8')
+    return NORMALIZE_REGEX.sub(' ', tax_name).strip().lower()
+
+
+def build_name_index(engine):
+    """
+    Create (or replace) the table "normalized_names", mapping the
+    normalized form of each name (see ``normalize_name``) to each
+    distinct value of names.tax_name. ``Taxonomy.match_names`` uses
+    this table if it exists to find names differing only in case,
+    whitespace or punctuation using an index rather than a scan of
+    table "names".
+    """
+
+    with transaction(engine) as conn:
+        conn.connection.create_function('normalize_name', 1, normalize_name)
+        conn.execute('DROP TABLE IF EXISTS normalized_names')
+        conn.execute("""CREATE TABLE normalized_names (
+            normalized TEXT NOT NULL,
+            tax_name TEXT NOT NULL,
+            PRIMARY KEY (normalized, tax_name)
+        ) WITHOUT ROWID""")
+        logging.info("Creating table normalized_names")
+        conn.execute("""INSERT OR IGNORE INTO normalized_names
+            SELECT normalize_name(tax_name), tax_name
+            FROM (SELECT DISTINCT tax_name FROM names)
+            WHERE tax_name IS NOT NULL""")
+        count = conn.execute('SELECT COUNT(*) FROM normalized_names').scalar()
+        logging.info("Inserted %d rows into normalized_names", count)
+
+
+# length of the substrings of names indexed by build_fuzzy_index
+GRAM_SIZE = 3
+# array typecode of the name ids in name_grams.ids
+GRAM_ID_TYPECODE = 'i'
+
+
+def name_grams(normalized, size=GRAM_SIZE):
+    """
+    Return the set of substrings of length ``size`` of a normalized
+    name (see ``normalize_name``) padded with ``size - 1`` spaces at
+    each end.
+    """
+
+    padded = ' ' * (size - 1) + normalized + ' ' * (size - 1)
+    return set(padded[i:i + size] for i in xrange(len(padded) - size + 1))
+
+
+def build_fuzzy_index(engine):
+    """
+    Create (or replace) the tables "fuzzy_names", numbering each
+    distinct normalized name in table "normalized_names" (which is
+    created if necessary, see ``build_name_index``), and "name_grams",
+    mapping each substring of the normalized names (see
+    ``name_grams``) to the number of names containing it and an array
+    of their ids. ``Taxonomy.fuzzy_match_names`` uses these tables to
+    find names similar to a given name by reading the ids of only its
+    least frequent substrings.
+
+    The arrays are built in memory and stored in the byte order of
+    this machine.
+    """
+
+    with transaction(engine) as conn:
+        if not has_table(conn, 'normalized_names'):
+            build_name_index(conn)
+        conn.execute('DROP TABLE IF EXISTS fuzzy_names')
+        conn.execute('DROP TABLE IF EXISTS name_grams')
+        conn.execute("""CREATE TABLE fuzzy_names (
+            id INTEGER PRIMARY KEY,
+            normalized TEXT NOT NULL UNIQUE
+        )""")
+        conn.execute("""CREATE TABLE name_grams (
+            gram TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            ids BLOB NOT NULL
+        ) WITHOUT ROWID""")
+        logging.info("Creating tables fuzzy_names and name_grams")
+        conn.execute("""INSERT INTO fuzzy_names (normalized)
+            SELECT DISTINCT normalized FROM normalized_names
+            ORDER BY normalized""")
+
+        postings = collections.defaultdict(
+            lambda: array.array(GRAM_ID_TYPECODE))
+        result = conn.execute('SELECT id, normalized FROM fuzzy_names')
+        while True:
+            rows = result.fetchmany(10000)
+            if not rows:
+                break
+            for name_id, normalized in rows:
+                for gram in name_grams(normalized):
+                    postings[gram].append(name_id)
+
+        conn.execute('INSERT INTO name_grams VALUES (?, ?, ?)', [
+            (gram, len(ids), buffer(ids.tostring()))
+            for gram, ids in postings.iteritems()])
+        logging.info("Inserted %d rows into name_grams", len(postings))
+
+
+def add_fuzzy_name(bind, tax_name):
+    """
+    Add ``tax_name`` to the tables created by ``build_fuzzy_index``
+    unless its normalized form is already present.
+    """
+
+    normalized = normalize_name(tax_name)
+    with transaction(bind) as conn:
+        result = conn.execute(
+            'INSERT OR IGNORE INTO fuzzy_names (normalized) VALUES (?)',
+            [normalized])
+        if not result.rowcount:
+            return
+        name_id = result.lastrowid
+        for gram in name_grams(normalized):
+            ids = array.array(GRAM_ID_TYPECODE)
+            row = conn.execute('SELECT ids FROM name_grams WHERE gram = ?',
+                               [gram]).first()
+            if row is not None:
+                ids.fromstring(str(row[0]))
+            ids.append(name_id)
+            conn.execute('INSERT OR REPLACE INTO name_grams VALUES (?, ?, ?)',
+                         [gram, len(ids), buffer(ids.tostring())])
 
 
 def do_insert(engine, tablename, rows, maxrows=None,
@@ -378,13 +1739,56 @@ def do_insert(engine, tablename, rows, maxrows=None,
     with engine.begin() as conn:
         count = 0
         for chunk in partition(rows, chunk_size):
-            result = conn.execute(insert, chunk)
-            count += result.rowcount
+            conn.execute(insert, chunk)
+            count += len(chunk)
         logging.info("Inserted %d rows into %s", count, tablename)
 
     return True
 
 
+def bulk_insert(connection, tablename, rows, maxrows=None,
+                add=True, chunk_size=5000):
+    """
+    Insert rows into a table using ``executemany`` on DB-API connection
+    ``connection``; indexes defined for the table are dropped first if
+    the table is empty (see ``create_indexes``). Do not perform the
+    insert if add is False and table already contains data.
+    """
+
+    cursor = connection.cursor()
+    has_data = cursor.execute(
+        'SELECT 1 FROM {} LIMIT 1'.format(tablename)).fetchone()
+
+    if not add and has_data:
+        log.info(
+            'Table "%s" already contains data; load not performed.' %
+            tablename)
+        return False
+    if maxrows:
+        rows = itertools.islice(rows, maxrows)
+
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return True
+
+    if not has_data:
+        drop_indexes(connection, tablename)
+
+    columns = sorted(first.keys())
+    insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        tablename, ', '.join(columns), ', '.join(':' + c for c in columns))
+    count = 0
+    for chunk in partition(itertools.chain([first], rows), chunk_size):
+        cursor.executemany(insert, chunk)
+        count += len(chunk)
+    connection.commit()
+    logging.info("Inserted %d rows into %s", count, tablename)
+
+    return True
+
+
 def fetch_data(dest_dir='.', clobber=False, url=DATA_URL):
     """
     Download data from NCBI required to generate local taxonomy
@@ -420,45 +1824,150 @@ def fetch_data(dest_dir='.', clobber=False, url=DATA_URL):
     return (fout, downloaded)
 
 
-def read_archive(archive, fname):
+def read_archive_chunks(archive, fname, chunk_size=CHUNK_SIZE):
+    """
+    Return an iterator of lists of complete lines from a file in a zip
+    archive. The file is decompressed ``chunk_size`` bytes at a time,
+    so memory use is bounded by the chunk size rather than by the size
+    of the file.
+
+    * archive - path to the zip archive.
+    * fname - name of the compressed file within the archive.
+    * chunk_size - number of bytes to decompress at a time.
+    """
+
+    with zipfile.ZipFile(archive, 'r') as zfile:
+        handle = zfile.open(fname)
+        try:
+            remainder = ''
+            while True:
+                chunk = handle.read(chunk_size)
+                if not chunk:
+                    break
+                # split on the last newline; the partial line that
+                # follows it is carried over to the next chunk
+                end = chunk.rfind('\n')
+                if end == -1:
+                    remainder += chunk
+                    continue
+                lines = (remainder + chunk[:end + 1]).splitlines()
+                remainder = chunk[end + 1:]
+                yield lines
+            if remainder:
+                yield remainder.splitlines()
+        finally:
+            handle.close()
+
+
+def read_archive(archive, fname, chunk_size=CHUNK_SIZE):
     """
-    Return an iterator of rows from a zip archive.
+    Return an iterator of rows from a zip archive. Rows are produced
+    as the archive is decompressed (see ``read_archive_chunks``).
 
     * archive - path to the zip archive.
     * fname - name of the compressed file within the archive.
+    * chunk_size - number of bytes to decompress at a time.
     """
 
-    zfile = zipfile.ZipFile(archive, 'r')
-    for line in zfile.read(fname).splitlines():
-        yield line.rstrip('\t|\n').split('\t|\t')
+    for lines in read_archive_chunks(archive, fname, chunk_size):
+        for line in lines:
+            yield dmp_row(line)
 
 
 def read_dmp(fname):
     for line in open(fname, 'rU'):
-        yield line.rstrip('\t|\n').split('\t|\t')
+        yield dmp_row(line)
+
+
+def dmp_row(line):
+    """
+    Split a line of a taxdmp file into a list of fields.
+    """
+
+    return line.rstrip('\t|\n').split('\t|\t')
+
+
+def parse_lines(fname, lines, first=True):
+    """
+    Return a list of rows parsed from ``lines`` of taxdmp file
+    ``fname`` ready to insert into the corresponding table (ie,
+    "nodes.dmp" into "nodes"). ``first`` indicates that ``lines``
+    begins at the start of the file.
+    """
+
+    rows = (dmp_row(line) for line in lines)
+    if fname == 'nodes.dmp':
+        rows = read_nodes(rows, ncbi_source_id=NCBI_SOURCE['id'],
+                          first_is_root=first)
+    elif fname == 'names.dmp':
+        rows = read_names(rows, unclassified_regex=UNCLASSIFIED_CLASSIFIER)
+    elif fname == 'merged.dmp':
+        rows = (dict(zip(['old_tax_id', 'new_tax_id'], row)) for row in rows)
+    else:
+        raise ValueError('no parser for "{}"'.format(fname))
+
+    return list(rows)
+
+
+def parse_archive(archive, fname, pool=None, queue_size=4,
+                  chunk_size=CHUNK_SIZE):
+    """
+    Return an iterator of rows from taxdmp file ``fname`` in zip
+    archive ``archive`` ready to insert into the corresponding table
+    (see ``parse_lines``).
+
+    If ``pool`` (a ``multiprocessing.Pool``) is provided, chunks of the
+    file are parsed by its worker processes. No more than
+    ``queue_size`` chunks are parsed or waiting to be consumed at a
+    time, and rows are returned in the order in which they appear in
+    the file.
+    """
+
+    chunks = read_archive_chunks(archive, fname, chunk_size)
+
+    if pool is None:
+        for i, lines in enumerate(chunks):
+            for row in parse_lines(fname, lines, first=i == 0):
+                yield row
+        return
+
+    pending = collections.deque()
+    for i, lines in enumerate(chunks):
+        if len(pending) >= queue_size:
+            for row in pending.popleft().get():
+                yield row
+        pending.append(
+            pool.apply_async(parse_lines, (fname, lines, i == 0)))
+
+    while pending:
+        for row in pending.popleft().get():
+            yield row
 
 
-def read_nodes(rows, ncbi_source_id):
+def read_nodes(rows, ncbi_source_id, first_is_root=True):
     """
     Return an iterator of rows ready to insert into table "nodes".
 
     * rows - iterator of lists (eg, output from read_archive or read_dmp)
-    * root_name - string identifying the root node (replaces NCBI's default).
+    * ncbi_source_id - value of "source_id" for each node
+    * first_is_root - if True, the first row is assumed to be the root
+      and its rank is set to "root".
     """
 
     keys = 'tax_id parent_id rank embl_code division_id'.split()
     idx = dict((k, i) for i, k in enumerate(keys))
     rank = idx['rank']
 
-    # assume the first row is the root
-    row = rows.next()
-    row[rank] = 'root'
-    rows = itertools.chain([row], rows)
+    if first_is_root:
+        # assume the first row is the root
+        row = rows.next()
+        row[rank] = 'root'
+        rows = itertools.chain([row], rows)
 
-    colnames = keys + ['source_id']
     for r in rows:
-        row = dict(zip(colnames, r))
-        assert len(row) == len(colnames)
+        row = dict(zip(keys, r))
+        assert len(row) == len(keys)
+        row['source_id'] = ncbi_source_id
 
         # replace whitespace in "rank" with underscore
         row['rank'] = '_'.join(row['rank'].split())
@@ -475,7 +1984,9 @@ def read_names(rows, unclassified_regex=None):
     None.
 
     * rows - iterator of lists (eg, output from read_archive or read_dmp)
-    * unclassified_regex - a compiled re matching "unclassified" names
+    * unclassified_regex - a compiled re matching "unclassified" names,
+      or any object with an equivalent ``search`` method (for example,
+      ``UNCLASSIFIED_CLASSIFIER``)
     """
 
     keys = 'tax_id tax_name unique_name name_class'.split()
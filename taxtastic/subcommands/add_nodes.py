@@ -20,7 +20,6 @@ from taxtastic.taxonomy import Taxonomy
 from taxtastic.utils import get_new_nodes
 
 from sqlalchemy import create_engine
-from sqlalchemy.exc import IntegrityError
 
 import logging
 log = logging.getLogger(__name__)
@@ -65,15 +64,13 @@ def action(args):
     tax = Taxonomy(engine, ncbi.RANKS)
 
     log.warning('adding new nodes')
-    nodes = get_new_nodes(new_nodes)
-    for d in nodes:
-        if source_name:
+    nodes = list(get_new_nodes(new_nodes))
+    if source_name:
+        for d in nodes:
             d['source_name'] = source_name
-            try:
-                tax.add_node(**d)
-            except IntegrityError:
-                log.info('node with tax_id %(tax_id)s already exists' % d)
-            else:
-                log.info('added new node with tax_id %(tax_id)s' % d)
+
+    # existing nodes are skipped and logged by add_nodes
+    for tax_id in tax.add_nodes(nodes, skip_existing=True):
+        log.info('added new node with tax_id %s' % tax_id)
 
     engine.dispose()
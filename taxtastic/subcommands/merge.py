@@ -93,16 +93,10 @@ def action(args):
 
     writer = csv.writer(args.out_file)
 
-    for t in taxids:
-        try:
-            tax._node(t)
-        except ValueError:
-            # Check for merged
-            m = tax._get_merged(t)
-            if m and m != t:
-                writer.writerow([t, m])
-            else:
-                writer.writerow([t, None])
+    for t, m in tax.resolve_tax_ids(taxids).items():
+        if m != t:
+            # merged (m is the new tax_id) or unknown (m is None)
+            writer.writerow([t, m])
 
     engine.dispose()
     return 0
@@ -3,9 +3,10 @@
 Download the current version of the NCBI taxonomy and load it into
 ``database_file`` as an SQLite3 database.  If ``database_file``
 already exists, it will fail and leave it untouched unless you specify
-``-x`` or ``--clobber``.  The NCBI taxonomy will be downloaded into
-the same directory as ``database_file`` will be created in unless you
-specify ``-p`` or ``--download-dir``.
+``-x`` or ``--clobber``, or ``--update`` to apply only the differences
+between the database and the current version.  The NCBI taxonomy will
+be downloaded into the same directory as ``database_file`` will be
+created in unless you specify ``-p`` or ``--download-dir``.
 
 """
 # This file is part of taxtastic.
@@ -23,6 +24,7 @@ specify ``-p`` or ``--download-dir``.
 #    You should have received a copy of the GNU General Public License
 #    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
 import os
 import logging
 import taxtastic
@@ -64,6 +66,69 @@ def build_parser(parser):
         and/or re-create the database even if one or both already
         exists. [%(default)s]""")
 
+    parser.add_argument(
+        '--update', action='store_true', default=False,
+        help="""Update an existing database to match the taxdump file
+        (which is downloaded again unless --taxdump-file is
+        given). Only rows that differ are modified, and nodes added
+        using "taxit add_nodes" are kept. [%(default)s]""")
+
+    parser.add_argument(
+        '--bulk-load', action='store_true', default=False,
+        help="""Load the data using a single non-durable connection
+        and create indexes after the data is loaded. Much faster, but
+        a database left by an interrupted load may be corrupt.
+        [%(default)s]""")
+
+    parser.add_argument(
+        '--workers', type=int, default=1, metavar='N',
+        help="""Number of processes used to parse the taxdump
+        files. Values greater than 1 parse the files in parallel with
+        loading them into the database. [%(default)s]""")
+
+    parser.add_argument(
+        '--compact', action='store_true', default=False,
+        help="""Create a smaller database storing tax_ids as integers
+        and ranks and name classes in lookup tables. The tables
+        "nodes", "names" and "merged" are provided as views, so the
+        database can be used like any other. [%(default)s]""")
+
+    parser.add_argument(
+        '--ancestors', action='store_true', default=False,
+        help="""Create a table "ancestors" listing every ancestor of
+        each node, which allows lineages to be fetched using a single
+        query. The table is much larger than the other tables; once
+        created, it is kept up to date by --update. [%(default)s]""")
+
+    parser.add_argument(
+        '--lineages', action='store_true', default=False,
+        help="""Create a table "lineages" containing the lineage of
+        each node with a column for each rank, which allows "taxit
+        taxtable" to write its output using a single query. Once
+        created, it is kept up to date by --update. [%(default)s]""")
+
+    parser.add_argument(
+        '--normalized-names', action='store_true', default=False,
+        help="""Create a table "normalized_names" indexing names by a
+        case-folded form with whitespace and punctuation normalized,
+        which allows names to be matched loosely without scanning the
+        table "names" (see "taxit taxids --normalize-names"). Once
+        created, it is kept up to date by --update. [%(default)s]""")
+
+    parser.add_argument(
+        '--fuzzy-names', action='store_true', default=False,
+        help="""Create tables "fuzzy_names" and "name_grams" indexing
+        substrings of names, which allow names to be matched to similar
+        names (see "taxit taxids --fuzzy-matches"). Implies
+        --normalized-names. Once created, they are kept up to date by
+        --update. [%(default)s]""")
+
+    parser.add_argument(
+        '--missing-primary-report', type=argparse.FileType('w'),
+        metavar='FILE',
+        help="""Write a CSV file listing tax_ids lacking a primary name
+        and the name chosen for each""")
+
     parser.add_argument(
         '--preserve-inconsistent-taxonomies',
         action='store_true', default=False,
@@ -73,8 +138,9 @@ def build_parser(parser):
 
 def action(args):
     dbname = args.database_file
+    exists = os.access(args.database_file, os.F_OK)
 
-    if not os.access(args.database_file, os.F_OK) or args.clobber:
+    if not exists or args.clobber or args.update:
         if args.taxdump_file:
             zfile = args.taxdump_file
         else:
@@ -82,11 +148,34 @@ def action(args):
             zip_dest = args.download_dir or pth or '.'
             zfile, _ = taxtastic.ncbi.fetch_data(
                 dest_dir=zip_dest,
-                clobber=args.clobber,
+                clobber=args.clobber or args.update,
                 url=args.taxdump_url)
-        msg = 'creating new database in {} using data in {}'
-        log.warning(msg.format(dbname, zfile))
-        engine = taxtastic.ncbi.db_connect(dbname, clobber=True)
-        taxtastic.ncbi.db_load(engine, zfile)
+
+        if exists and args.update and not args.clobber:
+            msg = 'updating database in {} using data in {}'
+            log.warning(msg.format(dbname, zfile))
+            engine = taxtastic.ncbi.db_connect(dbname)
+            taxtastic.ncbi.db_update(
+                engine, zfile, workers=args.workers,
+                primary_report=args.missing_primary_report)
+        else:
+            msg = 'creating new database in {} using data in {}'
+            log.warning(msg.format(dbname, zfile))
+            engine = taxtastic.ncbi.db_connect(
+                dbname, clobber=True, compact=args.compact)
+            taxtastic.ncbi.db_load(
+                engine, zfile, bulk=args.bulk_load, workers=args.workers,
+                primary_report=args.missing_primary_report)
+
+        if args.ancestors and not taxtastic.ncbi.has_table(engine, 'ancestors'):
+            taxtastic.ncbi.build_ancestors(engine)
+        if args.lineages and not taxtastic.ncbi.has_table(engine, 'lineages'):
+            taxtastic.ncbi.build_lineages(engine)
+        if args.normalized_names and not taxtastic.ncbi.has_table(
+                engine, 'normalized_names'):
+            taxtastic.ncbi.build_name_index(engine)
+        if args.fuzzy_names and not taxtastic.ncbi.has_table(
+                engine, 'name_grams'):
+            taxtastic.ncbi.build_fuzzy_index(engine)
     else:
         log.warning('taxonomy database already exists in %s' % dbname)
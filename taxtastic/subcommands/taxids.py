@@ -29,43 +29,12 @@ import sys
 
 from sqlalchemy import create_engine
 
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import Taxonomy, InMemoryTaxonomy
 from taxtastic import ncbi
 
 log = logging.getLogger(__name__)
 
 
-def get_children(engine, parent_ids, rank='species'):
-    """
-    Recursively fetch children of tax_ids in `parent_ids` until the
-    rank of `rank`
-    """
-
-    if not parent_ids:
-        return []
-
-    cmd = """
-    select tax_id, tax_name, rank from nodes join names using (tax_id)
-    where parent_id = "%s"
-    and is_primary = 1
-    """
-
-    species = []
-    for parent_id in parent_ids:
-        result = engine.execute(cmd % parent_id)
-        keys = result.keys()
-        rows = [dict(zip(keys, row)) for row in result.fetchall()]
-        species.extend([r for r in rows
-                        if r['rank'] == rank and 'sp.' not in r['tax_name']])
-
-        others = [r for r in rows if r['rank'] not in (rank, 'no_rank')]
-        if others:
-            _, s = get_children(engine, [r['tax_id'] for r in others])
-            species.extend(s)
-
-    return keys, species
-
-
 def build_parser(parser):
 
     parser.add_argument(
@@ -74,6 +43,20 @@ def build_parser(parser):
         help='Filename of sqlite database [%(default)s].',
         metavar='FILE', required=True)
 
+    parser.add_argument(
+        '--in-memory',
+        action='store_true',
+        help="""Load the taxonomy into memory before looking up
+        names, which is faster when there are many of them.""")
+
+    parser.add_argument(
+        '--normalize-names',
+        action='store_true',
+        help="""Match names not found exactly to names differing only
+        in case, whitespace or punctuation. This is much faster if
+        the database was created using "taxit new_database
+        --normalized-names".""")
+
     input_group = parser.add_argument_group(
         "Input options").add_mutually_exclusive_group()
 
@@ -88,6 +71,20 @@ def build_parser(parser):
         help=('list of taxonomic names provided as a comma-delimited '
               'list on the command line'))
 
+    fuzzy_group = parser.add_argument_group("Fuzzy matching options")
+    fuzzy_group.add_argument(
+        '--fuzzy-matches', metavar='FILE', type=argparse.FileType('w'),
+        help="""Write a csv file listing similar names for each name
+        that is not found. Requires a database created using "taxit
+        new_database --fuzzy-names".""")
+    fuzzy_group.add_argument(
+        '--max-distance', metavar='N', type=int, default=2,
+        help="""maximum edit distance of similar names [%(default)s]""")
+    fuzzy_group.add_argument(
+        '--max-candidates', metavar='N', type=int, default=5,
+        help="""maximum number of similar names listed for each name
+        [%(default)s]""")
+
     output_group = parser.add_argument_group(
         "Output options").add_mutually_exclusive_group()
     output_group.add_argument(
@@ -105,7 +102,10 @@ def action(args):
     outfile = args.outfile
 
     engine = create_engine('sqlite:///%s' % dbfile, echo=False)
-    tax = Taxonomy(engine, ncbi.RANKS)
+    if args.in_memory:
+        tax = InMemoryTaxonomy(engine, ncbi.RANKS)
+    else:
+        tax = Taxonomy(engine, ncbi.RANKS)
 
     names = []
     if taxnames_file:
@@ -116,17 +116,27 @@ def action(args):
     if taxnames:
         names += [x.strip() for x in taxnames.split(',')]
 
+    found, missing, ambiguous = tax.primary_from_names(
+        names, normalize=args.normalize_names)
+    for name, tax_ids in ambiguous.items():
+        log.warning('%s matches more than one tax_id (%s); using %s',
+                    name, ', '.join(tax_ids), found[name][0])
+
+    if args.fuzzy_matches:
+        tax.write_fuzzy_matches(missing, args.fuzzy_matches,
+                                limit=args.max_candidates,
+                                max_distance=args.max_distance)
+
     taxa = {}
     for name in set(names):
         tax_id, tax_name, is_primary, rank, note = '', '', '', '', ''
 
-        try:
-            tax_id, tax_name, is_primary = tax.primary_from_name(name)
-        except ValueError:
-            note = 'not found'
-        else:
+        if name in found:
+            tax_id, tax_name, is_primary = found[name]
             parent, rank = tax._node(tax_id)
             note = '' if is_primary else 'not primary'
+        else:
+            note = 'not found'
 
         if note:
             log.warning(
@@ -134,9 +144,14 @@ def action(args):
 
         if rank == 'species':
             taxa[tax_id] = dict(tax_id=tax_id, tax_name=tax_name, rank=rank)
-        else:
-            keys, rows = get_children(engine, [tax_id])
-            taxa.update(dict((row['tax_id'], row) for row in rows))
+        elif tax_id:
+            species = list(tax.descendants(tax_id, rank='species'))
+            names = tax.primary_from_ids(species)
+            for species_id, species_name in names.items():
+                if 'sp.' not in species_name:
+                    taxa[species_id] = dict(tax_id=species_id,
+                                            tax_name=species_name,
+                                            rank='species')
 
     for d in sorted(taxa.values(), key=lambda x: x['tax_name']):
         outfile.write('%(tax_id)s # %(tax_name)s\n' % d)
@@ -47,7 +47,7 @@ import logging
 import re
 
 from taxtastic import ncbi
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import Taxonomy, InMemoryTaxonomy
 from taxtastic.utils import getlines
 
 from sqlalchemy import create_engine
@@ -69,6 +69,18 @@ def build_parser(parser):
         action='store_true',
         help='Show all ranks in output file.')
 
+    parser.add_argument(
+        '--in-memory',
+        action='store_true',
+        help="""Load the taxonomy into memory before looking up
+        tax_ids, which is faster when there are many of them.""")
+    parser.add_argument(
+        '--lineage-store',
+        metavar='FILE',
+        help="""Save lineages in FILE for use by later runs using the
+        same taxonomy database. Saved lineages are discarded if the
+        database changes.""")
+
     input_group = parser.add_argument_group("Input options")
 
     input_group.add_argument(
@@ -111,7 +123,11 @@ def build_parser(parser):
 def action(args):
     engine = create_engine(
         'sqlite:///%s' % args.database_file, echo=args.verbosity > 2)
-    tax = Taxonomy(engine, ncbi.RANKS)
+    if args.in_memory:
+        tax = InMemoryTaxonomy(engine, ncbi.RANKS,
+                               lineage_store=args.lineage_store)
+    else:
+        tax = Taxonomy(engine, ncbi.RANKS, lineage_store=args.lineage_store)
 
     if any([args.taxids, args.taxnames, args.seq_info]):
         taxids = set()
@@ -133,20 +149,36 @@ def action(args):
             return "Some taxids were invalid.  Exiting."
 
         if args.taxnames:
-            for taxname in getlines(args.taxnames):
-                for name in re.split(r'\s*[,;]\s*', taxname):
-                    tax_id, primary_name, is_primary = tax.primary_from_name(
-                        name.strip())
-                    taxids.add(tax_id)
+            names = [name.strip()
+                     for taxname in getlines(args.taxnames)
+                     for name in re.split(r'\s*[,;]\s*', taxname)]
+            found, missing, ambiguous = tax.primary_from_names(names)
+            if missing:
+                msg = '"{}" not found in names.tax_names'.format(missing[0])
+                raise ValueError(msg)
+            for name, tax_ids in ambiguous.items():
+                log.warning('%s matches more than one tax_id (%s); using %s',
+                            name, ', '.join(tax_ids), found[name][0])
+            taxids.update(tax_id for tax_id, _, _ in found.values())
+    else:
+        taxids = None
+
+    if tax.lineage_table is not None:
+        # lineages were computed when the database was created
+        tax.write_lineage_table(taxids, csvfile=args.out_file, full=args.full)
     else:
-        taxids = set(tax.tax_ids())
+        if taxids is None:
+            taxids = set(tax.tax_ids())
 
-    # Extract all the taxids to be exported in the CSV file.
-    taxids_to_export = set()
-    for t in taxids:
-        taxids_to_export.update([y for (x, y) in tax._get_lineage(t)])
+        # Extract all the taxids to be exported in the CSV file.
+        taxids_to_export = set()
+        for lineage in tax.lineages(taxids).values():
+            taxids_to_export.update([y for (x, y) in lineage])
 
-    tax.write_table(taxids_to_export, csvfile=args.out_file, full=args.full)
+        tax.write_table(taxids_to_export, csvfile=args.out_file,
+                        full=args.full)
+        tax.save_lineages()
+        tax.log_cache_stats()
 
     engine.dispose()
     return 0
@@ -154,13 +186,11 @@ def action(args):
 
 def are_valid(tax_ids, tax):
     valid = True
+    resolved = tax.resolve_tax_ids(tax_ids)
     for t in tax_ids:
-        try:
-            tax._node(t)
-        except ValueError:
-            # Check for merged
-            m = tax._get_merged(t)
-            if m and m != t:
+        m = resolved[t]
+        if m != t:
+            if m:
                 msg = ("Taxid {0} has been replaced by {1}. "
                        "Please update your records").format(t, m)
                 print >> sys.stderr, msg
@@ -20,6 +20,7 @@ passed to ``taxit create --seq-info``
 TODO: refactor to simplify the action function.
 """
 
+import argparse
 import csv
 import logging
 import pandas
@@ -28,7 +29,7 @@ import sys
 
 from sqlalchemy.sql import select
 
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import Taxonomy, InMemoryTaxonomy
 from taxtastic import ncbi, utils
 
 log = logging.getLogger(__name__)
@@ -68,10 +69,37 @@ def build_parser(parser):
         '--name-column',
         help=('column with taxon name(s) to help '
               'find tax_ids. ex: organism name'))
+    parser.add_argument(
+        '--fuzzy-matches',
+        metavar='FILE', type=argparse.FileType('w'),
+        help="""write a csv file listing similar names for each name in
+        --name-column of a row whose tax_id remains unknown. Requires a
+        database created using "taxit new_database --fuzzy-names".""")
+    parser.add_argument(
+        '--max-distance',
+        metavar='N', type=int, default=2,
+        help="""maximum edit distance of similar names [%(default)s]""")
+    parser.add_argument(
+        '--max-candidates',
+        metavar='N', type=int, default=5,
+        help="""maximum number of similar names listed for each name
+        [%(default)s]""")
     parser.add_argument(
         '--append-lineage',
         help=('rank to append to seq_info'))
 
+    parser.add_argument(
+        '--in-memory',
+        action='store_true',
+        help="""Load the taxonomy into memory before looking up
+        tax_ids, which is faster when there are many of them.""")
+    parser.add_argument(
+        '--lineage-store',
+        metavar='FILE',
+        help="""Save lineages in FILE for use by later runs using the
+        same taxonomy database. Saved lineages are discarded if the
+        database changes.""")
+
 
 def species_is_classified(tax_id, taxonomy):
     """
@@ -110,46 +138,57 @@ def action(args):
         if args.name_column not in columns:
             msg = '"No "' + args.name_column + '" column'
             raise ValueError(msg)
+    elif args.fuzzy_matches:
+        raise ValueError('--fuzzy-matches requires --name-column')
 
     con = 'sqlite:///{0}'.format(args.database_file)
     e = sqlalchemy.create_engine(con)
-    tax = Taxonomy(e, ncbi.RANKS)
+    if args.in_memory:
+        tax = InMemoryTaxonomy(e, ncbi.RANKS,
+                               lineage_store=args.lineage_store)
+    else:
+        tax = Taxonomy(e, ncbi.RANKS, lineage_store=args.lineage_store)
 
-    merged = pandas.read_sql_table('merged', con, index_col='old_tax_id')
     log.info('updating tax_ids')
-    rows = rows.join(merged, on=args.taxid_column)
-
-    # overwrite tax_ids where there is a new_tax_id
-    inew_tax_ids = ~rows['new_tax_id'].isnull()
-    rows.loc[inew_tax_ids, args.taxid_column] = \
-        rows[inew_tax_ids]['new_tax_id']
-    rows = rows.drop('new_tax_id', axis=1)
+    resolved = tax.resolve_tax_ids(rows[args.taxid_column].dropna())
 
-    log.info('loading names table')
-    names = pandas.read_sql_table(
-        'names', con, columns=['tax_id', 'tax_name', 'is_primary'])
+    # overwrite tax_ids that have been merged into a new_tax_id
+    rows[args.taxid_column] = rows[args.taxid_column].map(
+        lambda t: resolved.get(t) or t)
+    valid = set(t for t in resolved.values() if t)
 
     if args.name_column:
         """
         use the args.name_column to do a string comparison with
         names.tax_name column to find a suitable tax_id
         """
-        unknowns = rows[~rows[args.taxid_column].isin(names['tax_id'])]
+        unknowns = rows[~rows[args.taxid_column].isin(valid)]
 
         if not unknowns.empty:
             """
             Take any tax_id associated with a string match
             to tax_name prioritizing is_primary=True
             """
+            log.info('loading names table')
+            names = pandas.read_sql_query(
+                'SELECT CAST(tax_id AS TEXT) AS tax_id, tax_name, is_primary '
+                'FROM names', con)
             unknowns = unknowns.drop(args.taxid_column, axis=1)
             names = names.sort_values('is_primary', ascending=False)
             names = names.drop_duplicates(subset='tax_name', keep='first')
             names = names.set_index('tax_name')
             found = unknowns.join(names, on=args.name_column, how='inner')
             rows.loc[found.index, args.taxid_column] = found['tax_id']
+            valid.update(found['tax_id'])
+
+    if args.fuzzy_matches:
+        unknowns = rows[~rows[args.taxid_column].isin(valid)]
+        tax.write_fuzzy_matches(
+            unknowns[args.name_column].dropna().unique(), args.fuzzy_matches,
+            limit=args.max_candidates, max_distance=args.max_distance)
 
     if not args.ignore_unknowns:
-        unknowns = rows[~rows[args.taxid_column].isin(names['tax_id'])]
+        unknowns = rows[~rows[args.taxid_column].isin(valid)]
         if args.unknowns:
             """
             Output unknown tax_ids
@@ -189,17 +228,41 @@ def action(args):
         else:
             columns.append(args.append_lineage)
 
-        def add_rank_column(row):
-            try:
-                lineage = tax.lineage(row[args.taxid_column])
-            except ValueError as e:
-                log.warn(e)
-                lineage = {}
-            row[args.append_lineage] = lineage.get(args.append_lineage, None)
-            return row
+        def warn_unknown(known):
+            for tax_id in rows[args.taxid_column].dropna():
+                if tax_id not in known:
+                    log.warn('value "{}" not found in nodes.tax_id'.format(
+                        tax_id))
+
+        def add_rank_column(tax_id):
+            if tax_id not in lineages:
+                return None
+            return dict(lineages[tax_id]).get(args.append_lineage, None)
 
         msg = 'appending {} column'.format(args.append_lineage)
-        rows = utils.apply_df_status(add_rank_column, rows, msg)
+        if tax.lineage_table is not None:
+            # read the column from the table of lineages
+            log.info(msg)
+            fields = 'tax_id'
+            if args.append_lineage in tax.lineage_table.c:
+                fields += ', "{}"'.format(args.append_lineage)
+            lineages = pandas.read_sql_query(
+                'SELECT {} FROM lineages'.format(fields),
+                con, index_col='tax_id')
+            warn_unknown(lineages.index)
+            if args.append_lineage in lineages.columns:
+                rows = rows.join(lineages, on=args.taxid_column)
+            else:
+                rows[args.append_lineage] = None
+        else:
+            log.info(msg)
+            lineages = tax.lineages(
+                rows[args.taxid_column].dropna().unique(),
+                ignore_missing=True)
+            warn_unknown(lineages)
+            rows[args.append_lineage] = rows[args.taxid_column].map(
+                add_rank_column)
+            tax.save_lineages()
 
     # output seq_info with new tax_ids
     rows.to_csv(
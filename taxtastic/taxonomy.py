@@ -12,23 +12,627 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+import array
+import collections
+import contextlib
 import csv
+import hashlib
 import itertools
+import heapq
+import json
 import logging
+import marshal
+import os
+import sqlite3
+import tempfile
+import threading
+import urllib
+from multiprocessing.pool import ThreadPool
 
 import sqlalchemy
-from sqlalchemy import MetaData, and_, or_
+from sqlalchemy import MetaData, and_
 from sqlalchemy.sql import select
 
-from . import ncbi
+from . import ncbi, utils
 
 log = logging.getLogger(__name__)
 
 
+class LRUCache(collections.MutableMapping):
+    """
+    A mapping holding at most ``maxsize`` items (or any number if
+    ``maxsize`` is None); when full, the least recently used item is
+    evicted. Counts hits and misses of lookups by key, and evictions.
+    Membership tests are not counted and do not affect the order of
+    eviction.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def _store(self, key, value):
+        self._data[key] = value
+
+    def _load(self, value):
+        return value
+
+    def __getitem__(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self._data[key] = value
+        self.hits += 1
+        return self._load(value)
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._store(key, value)
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        """
+        Returns a dict of counts of hits, misses and evictions and the
+        current and maximum size.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self),
+                'maxsize': self.maxsize}
+
+
+class LineageCache(LRUCache):
+    """
+    An LRUCache of lineages, each a list of (rank, tax_id) tuples
+    ending with the node identified by the key. Each lineage is stored
+    as a tuple (rank, tax_id, parent) where parent is the stored
+    lineage of the parent node, so lineages stored after that of an
+    ancestor share its storage rather than copying it.
+    """
+
+    def __init__(self, maxsize=None):
+        super(LineageCache, self).__init__(maxsize)
+        # returns the stored lineage of a tax_id, or None; replaced by
+        # StripedCache to share lineages between its stripes
+        self.cells = self._data.get
+
+    def _store(self, key, lineage):
+        parent = None
+        if len(lineage) > 1:
+            rank, tax_id = lineage[-2]
+            cell = self.cells(tax_id)
+            if cell is not None and cell[:2] == (rank, tax_id):
+                parent = cell
+            else:
+                for rank, tax_id in lineage[:-1]:
+                    parent = (rank, tax_id, parent)
+        rank, tax_id = lineage[-1]
+        self._data[key] = (rank, tax_id, parent)
+
+    def _load(self, cell):
+        lineage = []
+        while cell is not None:
+            lineage.append(cell[:2])
+            cell = cell[2]
+        lineage.reverse()
+        return lineage
+
+
+class OverlayCache(LRUCache):
+    """
+    An LRUCache in front of ``base``, another cache: lookups of keys
+    not found in this cache are answered by base, but items are only
+    stored in this cache, so base is never modified.
+    """
+
+    def __init__(self, base, maxsize=None):
+        super(OverlayCache, self).__init__(maxsize)
+        self.base = base
+
+    def __getitem__(self, key):
+        try:
+            return super(OverlayCache, self).__getitem__(key)
+        except KeyError:
+            return self.base[key]
+
+    def __contains__(self, key):
+        return key in self._data or key in self.base
+
+
+class LineageOverlay(OverlayCache, LineageCache):
+    """
+    An OverlayCache of lineages, stored as by LineageCache.
+    """
+
+
+class StripedCache(collections.MutableMapping):
+    """
+    A thread-safe cache made of ``stripes`` caches, each created by
+    ``factory(maxsize / stripes)`` and guarded by its own lock. Keys
+    are assigned to stripes by their hash, so threads using different
+    keys rarely wait for each other. Statistics are summed over the
+    stripes. Lineages stored in a stripe of LineageCaches share the
+    storage of their ancestors in any stripe.
+    """
+
+    def __init__(self, factory, maxsize=None, stripes=16):
+        self.maxsize = maxsize
+        size = None if maxsize is None else max(1, maxsize // stripes)
+        self._stripes = [(factory(size), threading.Lock())
+                         for _ in xrange(stripes)]
+        for cache, _ in self._stripes:
+            if isinstance(cache, LineageCache):
+                cache.cells = self._cell
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _cell(self, key):
+        """
+        Returns the stored lineage of key, or None, without locking
+        its stripe (which would risk a deadlock with the thread
+        storing a lineage): looking up a key in a dict is atomic, and
+        stored lineages are never modified.
+        """
+        cache, _ = self._stripe(key)
+        return cache._data.get(key)
+
+    def __getitem__(self, key):
+        cache, lock = self._stripe(key)
+        with lock:
+            return cache[key]
+
+    def __setitem__(self, key, value):
+        cache, lock = self._stripe(key)
+        with lock:
+            cache[key] = value
+
+    def __delitem__(self, key):
+        cache, lock = self._stripe(key)
+        with lock:
+            del cache[key]
+
+    def __contains__(self, key):
+        cache, lock = self._stripe(key)
+        with lock:
+            return key in cache
+
+    def pop(self, key, *default):
+        cache, lock = self._stripe(key)
+        with lock:
+            return cache.pop(key, *default)
+
+    def __iter__(self):
+        keys = []
+        for cache, lock in self._stripes:
+            with lock:
+                keys.extend(cache)
+        return iter(keys)
+
+    def __len__(self):
+        return sum(len(cache) for cache, _ in self._stripes)
+
+    def clear(self):
+        for cache, lock in self._stripes:
+            with lock:
+                cache.clear()
+
+    def stats(self):
+        """
+        Returns the sums of LRUCache.stats of the stripes.
+        """
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0}
+        for cache, lock in self._stripes:
+            with lock:
+                for key, value in cache.stats().items():
+                    if key in stats:
+                        stats[key] += value
+        stats['maxsize'] = self.maxsize
+        return stats
+
+
+class LineageStore(object):
+    """
+    Lineages built by Taxonomy, and its list of ranks, saved in the
+    SQLite database ``filename`` for use by later instances.
+
+    The contents are tied to the taxonomy database of ``engine`` by
+    its size, modification time and a hash of tables nodes and
+    merged, and to ``settings`` (a string identifying the options
+    used to build lineages). If the database or settings have changed
+    since the contents were saved, the contents are discarded when
+    the store is opened. The hash is only computed when the size or
+    modification time have changed.
+
+    The store uses write-ahead logging, so it can be read by any
+    number of processes while another saves lineages. Lineages
+    added using ``add`` are saved by ``flush``, which is called
+    when ``flush_size`` are waiting to be saved.
+    """
+
+    def __init__(self, filename, engine, settings='', flush_size=10000):
+        if engine.url.get_backend_name() != 'sqlite':
+            raise ValueError('a lineage store requires a sqlite database')
+
+        self.filename = filename
+        self.flush_size = flush_size
+        self.pending = {}
+        self.hits = self.misses = 0
+
+        # the connection may be used by any thread holding the lock
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, timeout=60,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS lineages (
+                tax_id TEXT PRIMARY KEY,
+                lineage TEXT
+            )""")
+
+        self._validate(engine, engine.url.database, settings)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def _meta(self):
+        with self._lock:
+            return dict(self.conn.execute('SELECT key, value FROM meta'))
+
+    @staticmethod
+    def content_hash(engine):
+        """
+        Returns a hash of the contents of tables nodes and merged.
+        """
+        digest = hashlib.sha1()
+        for query in ['SELECT tax_id, parent_id, rank FROM nodes '
+                      'ORDER BY tax_id',
+                      'SELECT old_tax_id, new_tax_id FROM merged '
+                      'ORDER BY old_tax_id']:
+            result = engine.execute(query)
+            while True:
+                rows = result.fetchmany(10000)
+                if not rows:
+                    break
+                for row in rows:
+                    digest.update(repr(tuple(row)))
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def _validate(self, engine, dbname, settings):
+        stat = os.stat(dbname)
+        expected = {'size': str(stat.st_size),
+                    'mtime': repr(stat.st_mtime),
+                    'settings': settings}
+        meta = self._meta()
+        if all(meta.get(k) == v for k, v in expected.items()):
+            return
+
+        log.info('checking lineages in %s', self.filename)
+        expected['hash'] = self.content_hash(engine)
+        with self._transaction() as conn:
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+            if (meta.get('hash'), meta.get('settings')) != (
+                    expected['hash'], settings):
+                log.info('taxonomy has changed; discarding lineages in %s',
+                         self.filename)
+                conn.execute('DELETE FROM lineages')
+                conn.execute('DELETE FROM meta')
+            conn.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                expected.items())
+
+    def ranks(self):
+        """
+        Returns the list of ranks saved with the lineages.
+        """
+        ranks = self._meta().get('ranks')
+        return json.loads(ranks) if ranks else []
+
+    def get_many(self, tax_ids, chunk_size=500):
+        """
+        Returns a dict of the saved lineages of tax_ids.
+        """
+        output = {}
+        with self._lock:
+            for chunk in ncbi.partition(iter(set(tax_ids)), chunk_size):
+                result = self.conn.execute(
+                    'SELECT tax_id, lineage FROM lineages WHERE tax_id IN '
+                    '({})'.format(', '.join('?' * len(chunk))), chunk)
+                for tax_id, lineage in result:
+                    output[tax_id] = [tuple(node)
+                                      for node in json.loads(lineage)]
+                self.misses += len(chunk)
+            self.hits += len(output)
+            self.misses -= len(output)
+        return output
+
+    def add(self, tax_id, lineage):
+        with self._lock:
+            self.pending[tax_id] = lineage
+
+    def flush(self, ranks, undef_prefix='below'):
+        """
+        Saves lineages added since the last call, and ``ranks`` merged
+        with the saved list of ranks (see ``ncbi.order_ranks``).
+        """
+        with self._lock:
+            with self._transaction() as conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO lineages (tax_id, lineage) '
+                    'VALUES (?, ?)',
+                    ((tax_id, json.dumps(lineage))
+                     for tax_id, lineage in self.pending.items()))
+                saved = conn.execute(
+                    "SELECT value FROM meta WHERE key = 'ranks'").fetchone()
+                saved = json.loads(saved[0]) if saved else []
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) "
+                    "VALUES ('ranks', ?)",
+                    [json.dumps(ncbi.order_ranks(saved, ranks,
+                                                 undef_prefix))])
+            log.info('saved %d lineages to %s', len(self.pending),
+                     self.filename)
+            self.pending = {}
+
+    def clear(self):
+        """
+        Discards all lineages, for example after the taxonomy changes.
+        """
+        with self._transaction() as conn:
+            self.pending = {}
+            conn.execute('DELETE FROM lineages')
+            conn.execute('DELETE FROM meta')
+
+    def close(self):
+        self.conn.close()
+
+
+class LCAIndex(object):
+    """
+    Lowest common ancestors of nodes of a taxonomy, found in constant
+    time using an Euler tour of the taxonomy: the lowest common
+    ancestor of a set of nodes is the shallowest node in the tour
+    between the first visits of any two of them.
+
+    Each position of the tour holds ``depth << bits | index`` for the
+    index of the node visited, so that the minimum of a range of the
+    tour identifies the shallowest node in it. Minima of blocks of
+    ``block_size`` positions are kept in a sparse table, so a query
+    takes the minimum of at most two partial blocks and two entries
+    of the table. The trees of all roots (nodes that are their own
+    parents) hang from a virtual node at depth 0, so that nodes in
+    different trees have no common ancestor.
+
+    Ranks of nodes with rank ``no_rank`` are renamed as in
+    Taxonomy._get_lineage (``below_<parent rank>``).
+    """
+
+    # version of the format written by save
+    FORMAT = 1
+
+    def __init__(self, tax_ids, rank_names, rank_ids, tour, first,
+                 block_size=64):
+        self.tax_ids = tax_ids
+        self.index = dict((tax_id, i) for i, tax_id in enumerate(tax_ids))
+        self.rank_names = rank_names
+        self.rank_ids = rank_ids
+        # keys of the Euler tour, and the position of the first visit
+        # of each node (or -1 if it is not below a root)
+        self.tour = tour
+        self.first = first
+        self.bits = len(tax_ids).bit_length()
+        self.mask = (1 << self.bits) - 1
+        self.block_size = block_size
+
+        # table[k][i] is the minimum of blocks i to i + 2 ** k - 1
+        blocks = array.array('l', (
+            min(tour[i:i + block_size])
+            for i in xrange(0, len(tour), block_size)))
+        self.table = [blocks]
+        width = 1
+        while 2 * width <= len(blocks):
+            prev = self.table[-1]
+            self.table.append(array.array('l', itertools.imap(
+                min, prev[:len(prev) - width], prev[width:])))
+            width *= 2
+
+    @classmethod
+    def from_nodes(cls, rows, no_rank='no_rank', undef_prefix='below',
+                   block_size=64):
+        """
+        Builds the index from rows (tax_id, parent_id, rank) of table
+        nodes.
+        """
+
+        rows = list(rows)
+        tax_ids = [tax_id for tax_id, _, _ in rows]
+        index = dict((tax_id, i) for i, tax_id in enumerate(tax_ids))
+        n = len(tax_ids)
+        bits = n.bit_length()
+
+        rank_names = []
+        rank_lookup = {}
+
+        def rank_id(rank):
+            if rank not in rank_lookup:
+                rank_lookup[rank] = len(rank_names)
+                rank_names.append(rank)
+            return rank_lookup[rank]
+
+        # children of each node, as in InMemoryTaxonomy
+        roots = []
+        parents = array.array('l', [-1] * n)
+        for i, (tax_id, parent_id, _) in enumerate(rows):
+            if parent_id == tax_id:
+                roots.append(i)
+            else:
+                parents[i] = index.get(parent_id, -1)
+        offsets = array.array('l', [0] * (n + 1))
+        for p in parents:
+            if p != -1:
+                offsets[p + 1] += 1
+        for i in xrange(n):
+            offsets[i + 1] += offsets[i]
+        fill = array.array('l', offsets)
+        children = array.array('l', [0] * offsets[n])
+        for i, p in enumerate(parents):
+            if p != -1:
+                children[fill[p]] = i
+                fill[p] += 1
+        del fill, parents
+
+        prefix = undef_prefix + '_'
+        rank_ids = array.array('l', [-1] * n)
+        first = array.array('l', [-1] * n)
+        tour = array.array('l', [n])  # the virtual root
+        for root in roots:
+            rank_ids[root] = rank_id(rows[root][2])
+            first[root] = len(tour)
+            tour.append(1 << bits | root)
+            # stack of (node, position of its next child)
+            stack = [[root, offsets[root]]]
+            while stack:
+                top = stack[-1]
+                node, pos = top
+                if pos == offsets[node + 1]:
+                    stack.pop()
+                    tour.append(len(stack) << bits | (
+                        stack[-1][0] if stack else n))
+                    continue
+                top[1] += 1
+                child = children[pos]
+                rank = rows[child][2]
+                if rank == no_rank:
+                    rank = prefix + rank_names[rank_ids[node]]
+                rank_ids[child] = rank_id(rank)
+                first[child] = len(tour)
+                stack.append([child, offsets[child]])
+                tour.append(len(stack) << bits | child)
+
+        return cls(tax_ids, rank_names, rank_ids, tour, first,
+                   block_size=block_size)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns (index, meta) read from a file written by save, or
+        (None, {}) if the file was written in another format.
+        """
+
+        with open(filename, 'rb') as f:
+            data = marshal.load(f)
+        if data.get('format') != cls.FORMAT:
+            return None, {}
+
+        arrays = {}
+        for key in ['rank_ids', 'tour', 'first']:
+            arrays[key] = array.array('l')
+            arrays[key].fromstring(data[key])
+        index = cls(data['tax_ids'], data['rank_names'],
+                    block_size=data['block_size'], **arrays)
+        return index, data['meta']
+
+    def save(self, filename, meta):
+        """
+        Writes the index and the dict of strings meta to filename.
+        """
+
+        data = {'format': self.FORMAT, 'meta': meta,
+                'tax_ids': self.tax_ids, 'rank_names': self.rank_names,
+                'block_size': self.block_size,
+                'rank_ids': self.rank_ids.tostring(),
+                'tour': self.tour.tostring(),
+                'first': self.first.tostring()}
+        with open(filename, 'wb') as f:
+            marshal.dump(data, f)
+
+    def _min(self, start, stop):
+        """
+        Returns the minimum of self.tour[start:stop + 1].
+        """
+
+        size = self.block_size
+        lo, hi = start // size + 1, stop // size - 1
+        if lo > hi:
+            return min(self.tour[start:stop + 1])
+        k = (hi - lo + 1).bit_length() - 1
+        table = self.table[k]
+        return min(min(self.tour[start:lo * size]),
+                   min(self.tour[(hi + 1) * size:stop + 1]),
+                   table[lo], table[hi - (1 << k) + 1])
+
+    def lca(self, tax_ids):
+        """
+        Returns (rank, tax_id) of the lowest common ancestor of
+        tax_ids, or None if they have none.
+
+        Raises ValueError if tax_ids is empty or a tax_id is not found
+        in the taxonomy (or not below a root).
+        """
+
+        positions = []
+        for tax_id in tax_ids:
+            i = self.index.get(tax_id)
+            if i is None or self.first[i] == -1:
+                msg = 'value "{}" not found in nodes.tax_id'.format(tax_id)
+                raise ValueError(msg)
+            positions.append(self.first[i])
+        if not positions:
+            raise ValueError('lowest common ancestor of no tax_ids')
+
+        i = self._min(min(positions), max(positions)) & self.mask
+        if i == len(self.tax_ids):
+            return None
+        return self.rank_names[self.rank_ids[i]], self.tax_ids[i]
+
+    def lca_many(self, tax_id_sets):
+        """
+        Returns a list of the lowest common ancestor (see lca) of each
+        of tax_id_sets.
+        """
+        return [self.lca(tax_ids) for tax_ids in tax_id_sets]
+
+
 class Taxonomy(object):
 
     def __init__(self, engine, ranks=ncbi.RANKS,
-                 NO_RANK='no_rank', undef_prefix='below'):
+                 NO_RANK='no_rank', undef_prefix='below', cache_size=None,
+                 lineage_store=None, debug=False, thread_safe=False,
+                 pool_size=8, pool_timeout=30):
         """
         The Taxonomy class defines an object providing an interface to
         the taxonomy database.
@@ -40,6 +644,24 @@ class Taxonomy(object):
           a specific rank in the taxonomy.
         * undef_prefix - string prepended to name of parent
           rank to create new labels for undefined ranks.
+        * cache_size - maximum number of lineages, nodes and primary
+          names each to keep in memory, or None for no limit (see
+          cache_stats).
+        * lineage_store - name of a file in which to save lineages
+          for use by later instances (see LineageStore and
+          save_lineages); lineages and ranks are read from it if it
+          exists and the taxonomy has not changed.
+        * debug - if True, check that the nodes returned by child_of,
+          children_of, species_below and nary_subtree (and their batch
+          versions) are below the given tax_id, at the cost of a
+          lineage for each.
+        * thread_safe - if True, the instance may be shared by threads
+          (see map_lineages): caches are divided into stripes with a
+          lock each, and a sqlite database file is queried through a
+          pool of at most pool_size read-only connections that may be
+          used by any thread, waiting at most pool_timeout seconds for
+          a connection (see _read_only_engine). Nodes can't be added
+          using such an instance.
 
         Example:
         >>> from sqlalchemy import create_engine
@@ -56,22 +678,59 @@ class Taxonomy(object):
 
         log.debug('using database ' + str(engine.url))
 
+        self.thread_safe = thread_safe
+        if thread_safe and engine.url.get_backend_name() == 'sqlite':
+            engine = self._read_only_engine(engine, pool_size, pool_timeout)
+
         self.engine = engine
         self.meta = MetaData()
         self.meta.bind = self.engine
-        self.meta.reflect()
+        # nodes, names and merged are views in the compact schema
+        self.meta.reflect(views=True)
+
+        # tax_ids are strings regardless of the schema
+        for tablename, columns in ncbi.TAX_ID_COLUMNS.items():
+            if tablename in self.meta.tables:
+                for column in columns:
+                    self.meta.tables[tablename].c[column].type = ncbi.TaxId()
 
         self.nodes = self.meta.tables['nodes']
         self.names = self.meta.tables['names']
         self.source = self.meta.tables['source']
         self.merged = self.meta.tables['merged']
 
+        # optional closure table (see ncbi.build_ancestors); None if absent
+        self.ancestors = self.meta.tables.get('ancestors')
+        # read lineages from table ancestors rather than from nodes
+        self._lineages_from_ancestors = self.ancestors is not None
+        # optional table of ranked lineages (see ncbi.build_lineages)
+        self.lineage_table = self.meta.tables.get('lineages')
+        # optional index of normalized names (see ncbi.build_name_index)
+        self.name_index = self.meta.tables.get('normalized_names')
+        # optional index of substrings of names for fuzzy matching (see
+        # ncbi.build_fuzzy_index)
+        self.name_grams = self.meta.tables.get('name_grams')
+
         self.ranks = ranks
         self.rankset = set(self.ranks)
+        # held while ranks are added (see _add_rank)
+        self._rank_lock = threading.RLock()
+
+        def cache(factory):
+            if thread_safe:
+                return StripedCache(factory, cache_size)
+            return factory(cache_size)
 
         # keys: tax_id
         # vals: lineage represented as a list of tuples: (rank, tax_id)
-        self.cached = {}
+        self.cached = cache(LineageCache)
+        # keys: tax_id; vals: (parent_id, rank)
+        self.node_cache = cache(LRUCache)
+        # keys: tax_id; vals: primary tax_name
+        self.name_cache = cache(LRUCache)
+        # tax_ids of each lineage built so far (see write_table); None
+        # while write_table is building lineages
+        self.seen = set()
 
         # keys: tax_id
         # vals: lineage represented as a dict of {rank:tax_id}
@@ -79,15 +738,131 @@ class Taxonomy(object):
 
         self.NO_RANK = NO_RANK
         self.undef_prefix = undef_prefix
+        self.debug = debug
+        # built by lca_index
+        self._lca_index = None
+
+        self.lineage_store = None
+        if lineage_store:
+            self.lineage_store = LineageStore(
+                lineage_store, engine,
+                settings=json.dumps([NO_RANK, undef_prefix]))
+            self.ranks[:] = ncbi.order_ranks(
+                self.ranks, self.lineage_store.ranks(), undef_prefix)
+            self.rankset = set(self.ranks)
+
+    @staticmethod
+    def _read_only_engine(engine, pool_size, pool_timeout):
+        """
+        Returns an engine for the sqlite database file of engine that
+        opens it read-only (as a URI with mode=ro, so that temporary
+        tables may still be created), keeping at most pool_size
+        connections usable by any thread. Only the url, echo and
+        execution options of engine are kept.
+
+        Raises ValueError if engine is not for a database file or if
+        sqlite was built without support for URI filenames.
+        """
+
+        database = engine.url.database
+        if not database or database == ':memory:':
+            raise ValueError(
+                'thread_safe requires a sqlite database file, not {}'.format(
+                    engine.url))
+        conn = sqlite3.connect(':memory:')
+        try:
+            options = [option for option, in conn.execute(
+                'PRAGMA compile_options')]
+        finally:
+            conn.close()
+        if not any(option.startswith('USE_URI') for option in options):
+            raise ValueError(
+                'thread_safe requires sqlite with URI filenames')
+
+        uri = 'file:{}?mode=ro'.format(
+            urllib.quote(os.path.abspath(database)))
+
+        def connect():
+            return sqlite3.connect(uri, check_same_thread=False)
+
+        return sqlalchemy.create_engine(
+            engine.url, creator=connect, poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=pool_size, max_overflow=0, pool_timeout=pool_timeout,
+            echo=engine.echo, execution_options=engine.get_execution_options())
+
+    def save_lineages(self):
+        """
+        Save lineages built since the last call in self.lineage_store,
+        if any.
+        """
+        if self.lineage_store is not None:
+            self.lineage_store.flush(self.ranks, self.undef_prefix)
+
+    def cache_stats(self):
+        """
+        Returns a dict of the statistics of each cache (see
+        LRUCache.stats) keyed by 'lineage', 'node' and 'name'.
+        """
+        stats = {'lineage': self.cached.stats(),
+                 'node': self.node_cache.stats(),
+                 'name': self.name_cache.stats()}
+        if self.lineage_store is not None:
+            stats['lineage_store'] = {
+                'hits': self.lineage_store.hits,
+                'misses': self.lineage_store.misses,
+                'evictions': 0, 'size': None, 'maxsize': None}
+        return stats
+
+    def log_cache_stats(self, level=logging.INFO):
+        for name, stats in sorted(self.cache_stats().items()):
+            log.log(level, '%s cache: %s hits, %s misses, %s evictions, '
+                    'size %s (max %s)', name, stats['hits'], stats['misses'],
+                    stats['evictions'], stats['size'], stats['maxsize'])
+
+    def _cache_lineage(self, tax_id, lineage, store=True):
+        self.cached[tax_id] = lineage
+        if self.seen is not None:
+            self.seen.add(tax_id)
+        if store and self.lineage_store is not None:
+            self.lineage_store.add(tax_id, lineage)
+            if len(self.lineage_store.pending) >= \
+                    self.lineage_store.flush_size:
+                self.save_lineages()
+
+    def _cached_lineages(self, tax_ids):
+        """
+        Returns a dict of the lineages of tax_ids found in self.cached
+        or self.lineage_store.
+        """
+        output = {}
+        for tax_id in tax_ids:
+            lineage = self.cached.get(tax_id)
+            if lineage is not None:
+                output[tax_id] = lineage
+        if self.lineage_store is not None:
+            stored = self.lineage_store.get_many(
+                t for t in tax_ids if t not in output)
+            for tax_id, lineage in stored.items():
+                self._cache_lineage(tax_id, lineage, store=False)
+            output.update(stored)
+        return output
 
     def _add_rank(self, rank, parent_rank):
         """
         inserts rank into self.ranks.
+
+        The list is replaced in a single step, so that other threads
+        see either the old or the new list of ranks.
         """
 
-        if rank not in self.rankset:
-            self.ranks.insert(self.ranks.index(parent_rank) + 1, rank)
-        self.rankset = set(self.ranks)
+        if rank in self.rankset:
+            return
+        with self._rank_lock:
+            if rank not in self.rankset:
+                ranks = list(self.ranks)
+                ranks.insert(ranks.index(parent_rank) + 1, rank)
+                self.ranks[:] = ranks
+                self.rankset = set(ranks)
 
     def _node(self, tax_id):
         """
@@ -96,6 +871,10 @@ class Taxonomy(object):
         FIXME: expand return rank to include custom 'below' ranks built when
                get_lineage is caled
         """
+        output = self.node_cache.get(tax_id)
+        if output is not None:
+            return output
+
         s = select([self.nodes.c.parent_id, self.nodes.c.rank],
                    self.nodes.c.tax_id == tax_id)
         res = s.execute()
@@ -104,6 +883,8 @@ class Taxonomy(object):
             msg = 'value "{}" not found in nodes.tax_id'.format(tax_id)
             raise ValueError(msg)
         else:
+            output = tuple(output)
+            self.node_cache[tax_id] = output
             return output  # parent_id, rank
 
     def primary_from_id(self, tax_id):
@@ -111,6 +892,10 @@ class Taxonomy(object):
         Returns primary taxonomic name associated with tax_id
         """
 
+        output = self.name_cache.get(tax_id)
+        if output is not None:
+            return output
+
         s = select([self.names.c.tax_name],
                    and_(self.names.c.tax_id == tax_id,
                         self.names.c.is_primary == 1))
@@ -121,13 +906,55 @@ class Taxonomy(object):
             msg = 'value "{}" not found in names.tax_id'.format(tax_id)
             raise ValueError(msg)
         else:
+            self.name_cache[tax_id] = output[0]
             return output[0]
 
-    def primary_from_name(self, tax_name):
+    def primary_from_ids(self, tax_ids, chunk_size=500):
+        """
+        Returns a dict mapping each of tax_ids to its primary name (see
+        primary_from_id), fetching uncached names in chunks of
+        chunk_size.
+
+        Raises ValueError if a tax_id has no primary name.
+        """
+
+        output = {}
+        for tax_id in tax_ids:
+            if tax_id in self.name_cache:
+                output[tax_id] = self.name_cache[tax_id]
+
+        nm = self.names
+        pending = set(tax_ids) - set(output)
+        for chunk in ncbi.partition(iter(pending), chunk_size):
+            s = select([nm.c.tax_id, nm.c.tax_name],
+                       and_(nm.c.tax_id.in_(chunk), nm.c.is_primary == 1))
+            for tax_id, tax_name in s.execute():
+                output.setdefault(tax_id, tax_name)
+
+        for tax_id in pending:
+            if tax_id not in output:
+                msg = 'value "{}" not found in names.tax_id'.format(tax_id)
+                raise ValueError(msg)
+            self.name_cache[tax_id] = output[tax_id]
+        return output
+
+    def primary_from_name(self, tax_name, normalize=False):
         """
         Return tax_id and primary tax_name corresponding to tax_name.
+        A name of more than one node is resolved as by
+        primary_from_names. If normalize is True and tax_name is not
+        found, names differing only in case, whitespace or punctuation
+        are used (see primary_from_names).
         """
 
+        if normalize:
+            found, missing, _ = self.primary_from_names(
+                [tax_name], normalize=True)
+            if missing:
+                msg = '"{}" not found in names.tax_names'.format(tax_name)
+                raise ValueError(msg)
+            return found[tax_name]
+
         names = self.names
 
         s1 = select([names.c.tax_id, names.c.is_primary],
@@ -135,12 +962,16 @@ class Taxonomy(object):
 
         log.debug(str(s1))
 
-        res = s1.execute().fetchone()
-        if res:
-            tax_id, is_primary = res
-        else:
+        # keys: tax_id; vals: (is_primary, )
+        matches = {}
+        for tax_id, is_primary in s1.execute():
+            if is_primary or tax_id not in matches:
+                matches[tax_id] = (bool(is_primary), )
+        if not matches:
             msg = '"{}" not found in names.tax_names'.format(tax_name)
             raise ValueError(msg)
+        tax_id = self._choose_node(matches)
+        is_primary, = matches[tax_id]
 
         if not is_primary:
             s2 = select([names.c.tax_name],
@@ -150,6 +981,283 @@ class Taxonomy(object):
 
         return tax_id, tax_name, bool(is_primary)
 
+    def primary_from_names(self, tax_names, normalize=False):
+        """
+        Resolve many names at once using a single join of a temporary
+        table against names. Returns a tuple (found, missing,
+        ambiguous): found is a dict mapping each name in
+        names.tax_name to a tuple (tax_id, primary tax_name,
+        is_primary) like the output of primary_from_name; missing is
+        a list of the names not found; and ambiguous is a dict mapping
+        each name of more than one node to a list of their tax_ids.
+        An ambiguous name is resolved to the node of which it is the
+        primary name, if any, and otherwise to the lowest tax_id
+        (compared numerically; see _choose_node).
+
+        If normalize is True, each name not found in names.tax_name
+        is replaced by the names differing from it only in case,
+        whitespace or punctuation (see match_names).
+        """
+
+        tax_names = list(collections.OrderedDict.fromkeys(tax_names))
+        nodes = self._name_nodes(tax_names)
+        candidates = dict((tax_name, [tax_name]) for tax_name in tax_names)
+        if normalize:
+            unmatched = [t for t in tax_names if t not in nodes]
+            candidates.update(self.match_names(unmatched))
+            nodes.update(self._name_nodes(set(
+                itertools.chain.from_iterable(candidates.values()))))
+
+        found, missing, ambiguous = {}, [], {}
+        for tax_name in tax_names:
+            # keys: tax_id; vals: (is_primary, primary tax_name)
+            matches = {}
+            for name in candidates[tax_name]:
+                for tax_id, match in nodes.get(name, {}).items():
+                    if match[0] or tax_id not in matches:
+                        matches[tax_id] = match
+            if not matches:
+                missing.append(tax_name)
+                continue
+            if len(matches) > 1:
+                ambiguous[tax_name] = sorted(matches)
+            tax_id = self._choose_node(matches)
+            is_primary, primary_name = matches[tax_id]
+            found[tax_name] = (tax_id, primary_name, is_primary)
+        return found, missing, ambiguous
+
+    @staticmethod
+    def _choose_node(matches):
+        """
+        Returns the tax_id of the node that a name shared by several
+        nodes refers to, given a dict matches mapping each tax_id to a
+        tuple starting with is_primary: the node of which the name is
+        the primary name, if any, or otherwise the node with the lowest
+        tax_id (see _tax_id_key).
+        """
+
+        return min(matches, key=lambda t: (
+            not matches[t][0], Taxonomy._tax_id_key(t)))
+
+    @staticmethod
+    def _tax_id_key(tax_id):
+        """
+        Sort key ordering numeric tax_ids as numbers, before any
+        others, which are ordered as strings.
+        """
+
+        numeric = tax_id.isdigit()
+        return not numeric, int(tax_id) if numeric else 0, tax_id
+
+    def _name_nodes(self, tax_names):
+        """
+        Returns a dict mapping each of tax_names found in
+        names.tax_name to a dict {tax_id: (is_primary, primary
+        tax_name)} describing each node with that name.
+        """
+
+        tax_names = set(tax_names)
+        nodes = collections.defaultdict(dict)
+        if not tax_names:
+            return nodes
+
+        with self.engine.connect() as conn:
+            conn.execute('CREATE TEMPORARY TABLE name_lookup '
+                         '(tax_name TEXT PRIMARY KEY)')
+            try:
+                conn.execute('INSERT INTO name_lookup VALUES (?)',
+                             [[name] for name in tax_names])
+                rows = conn.execute("""SELECT l.tax_name,
+                        names.tax_id,
+                        names.is_primary,
+                        p.tax_name
+                    FROM name_lookup l
+                        JOIN names ON names.tax_name = l.tax_name
+                        LEFT JOIN names p
+                            ON p.tax_id = names.tax_id AND p.is_primary = 1""")
+                for tax_name, tax_id, is_primary, primary_name in rows:
+                    # tax_ids may be stored as integers (see TaxId)
+                    tax_id = unicode(tax_id)
+                    if is_primary:
+                        nodes[tax_name][tax_id] = (True, tax_name)
+                    else:
+                        nodes[tax_name].setdefault(
+                            tax_id, (False, primary_name))
+            finally:
+                conn.execute('DROP TABLE name_lookup')
+
+        return nodes
+
+    def match_names(self, tax_names):
+        """
+        Returns a dict mapping each of tax_names to a sorted list of
+        the values of names.tax_name with the same normalized form
+        (see ``ncbi.normalize_name``). Table "normalized_names" is
+        used if it exists (see ``ncbi.build_name_index``); otherwise
+        every name in table "names" is read and normalized.
+        """
+
+        normalized = collections.defaultdict(list)
+        for tax_name in set(tax_names):
+            normalized[ncbi.normalize_name(tax_name)].append(tax_name)
+        matches = dict((tax_name, []) for tax_name in set(tax_names))
+        if not matches:
+            return matches
+
+        with self.engine.connect() as conn:
+            if self.name_index is not None:
+                conn.execute('CREATE TEMPORARY TABLE name_match '
+                             '(normalized TEXT PRIMARY KEY)')
+                try:
+                    conn.execute('INSERT INTO name_match VALUES (?)',
+                                 [[n] for n in normalized])
+                    rows = conn.execute("""SELECT normalized, tax_name
+                        FROM name_match
+                            JOIN normalized_names USING (normalized)
+                        ORDER BY normalized, tax_name""").fetchall()
+                finally:
+                    conn.execute('DROP TABLE name_match')
+            else:
+                log.info('no table "normalized_names"; scanning names')
+                rows = sorted(
+                    (ncbi.normalize_name(name), name) for name, in
+                    conn.execute('SELECT DISTINCT tax_name FROM names')
+                    if name is not None)
+
+        for key, name in rows:
+            for tax_name in normalized.get(key, []):
+                matches[tax_name].append(name)
+        return matches
+
+    def fuzzy_match_names(self, tax_names, limit=5, max_distance=2):
+        """
+        Returns a dict mapping each of tax_names to a list of up to
+        ``limit`` tuples (tax_name, distance) giving the values of
+        names.tax_name whose normalized forms (see
+        ``ncbi.normalize_name``) are within an edit distance of
+        ``max_distance`` of the normalized form of the name, ordered
+        by distance and then by name.
+
+        Uses the tables created by ``ncbi.build_fuzzy_index``. A name
+        within distance d of another contains all but at most
+        ``ncbi.GRAM_SIZE * d`` of the substrings of the other (see
+        ``ncbi.name_grams``), so only names containing one of the
+        ``ncbi.GRAM_SIZE * d + 1`` least frequent substrings of each
+        name are compared with it. For names too short to have that
+        many substrings, the maximum distance is reduced accordingly.
+
+        Raises ValueError if the tables do not exist.
+        """
+
+        if self.name_grams is None:
+            raise ValueError('table "name_grams" not found; create it '
+                             'using "taxit new_database --fuzzy-names"')
+
+        queries = dict((tax_name, ncbi.normalize_name(tax_name))
+                       for tax_name in set(tax_names))
+        grams = dict((q, ncbi.name_grams(q)) for q in set(queries.values()))
+
+        with self.engine.connect() as conn:
+            counts = self._select_in(
+                conn, 'SELECT gram, count FROM name_grams WHERE gram IN ({})',
+                set(itertools.chain.from_iterable(grams.values())))
+
+            # keys: normalized name; vals: (max distance, its least
+            # frequent substrings)
+            prefixes = {}
+            for query, query_grams in grams.items():
+                distance = min(max_distance,
+                               (len(query_grams) - 1) // ncbi.GRAM_SIZE)
+                prefixes[query] = (distance, sorted(
+                    query_grams, key=lambda g: (counts.get(g, 0), g)
+                )[:ncbi.GRAM_SIZE * distance + 1])
+
+            postings = self._select_in(
+                conn, 'SELECT gram, ids FROM name_grams WHERE gram IN ({})',
+                set(g for _, prefix in prefixes.values() for g in prefix
+                    if g in counts))
+            # keys: normalized name; vals: (max distance, ids of names
+            # containing one of its least frequent substrings)
+            candidates = {}
+            for query, (distance, prefix) in prefixes.items():
+                ids = set()
+                for gram in prefix:
+                    if gram in postings:
+                        ids.update(array.array(ncbi.GRAM_ID_TYPECODE,
+                                               str(postings[gram])))
+                candidates[query] = (distance, ids)
+
+            strings = self._select_in(
+                conn, 'SELECT id, normalized FROM fuzzy_names WHERE id IN ({})',
+                set(itertools.chain.from_iterable(
+                    ids for _, ids in candidates.values())))
+
+            # keys: normalized name; vals: [(distance, normalized), ...]
+            similar = {}
+            for query, (distance, ids) in candidates.items():
+                similar[query] = []
+                for name_id in ids:
+                    normalized = strings[name_id]
+                    d = utils.edit_distance(query, normalized, distance)
+                    if d <= distance:
+                        similar[query].append((d, normalized))
+
+            # keys: normalized name; vals: names with that form
+            names = collections.defaultdict(list)
+            found = set(normalized for matches in similar.values()
+                        for _, normalized in matches)
+            for chunk in ncbi.partition(iter(found), 500):
+                rows = conn.execute(
+                    'SELECT normalized, tax_name FROM normalized_names '
+                    'WHERE normalized IN ({})'.format(
+                        ', '.join(['?'] * len(chunk))), chunk)
+                for normalized, tax_name in rows:
+                    names[normalized].append(tax_name)
+
+        output = {}
+        for tax_name, query in queries.items():
+            matches = sorted((distance, name)
+                             for distance, normalized in similar[query]
+                             for name in names[normalized])
+            output[tax_name] = [(name, distance)
+                                for distance, name in matches[:limit]]
+        return output
+
+    def write_fuzzy_matches(self, tax_names, csvfile, limit=5,
+                            max_distance=2):
+        """
+        Write a csv file listing the candidates for each of tax_names
+        found by fuzzy_match_names, with the tax_id chosen for each
+        candidate by primary_from_names.
+        """
+
+        matches = self.fuzzy_match_names(
+            tax_names, limit=limit, max_distance=max_distance)
+        found, _, _ = self.primary_from_names(
+            name for candidates in matches.values()
+            for name, _ in candidates)
+
+        writer = csv.writer(csvfile)
+        writer.writerow(['name', 'tax_name', 'distance', 'tax_id'])
+        for tax_name in sorted(matches):
+            for name, distance in matches[tax_name]:
+                writer.writerow([tax_name, name, distance, found[name][0]])
+
+    @staticmethod
+    def _select_in(conn, query, values, chunk_size=500):
+        """
+        Returns a dict of the rows (key, value) returned by ``query``
+        for each chunk of ``values``, which replace the "{}" in
+        ``query`` as a list of parameters.
+        """
+
+        output = {}
+        for chunk in ncbi.partition(iter(values), chunk_size):
+            rows = conn.execute(
+                query.format(', '.join(['?'] * len(chunk))), chunk)
+            output.update((key, value) for key, value in rows)
+        return output
+
     def _get_merged(self, old_tax_id):
         """Returns tax_id into which `old_tax_id` has been merged.
 
@@ -194,10 +1302,12 @@ class Taxonomy(object):
 
         prefix = self.undef_prefix + '_'
 
-        lineage = self.cached.get(tax_id)
+        lineage = self._cached_lineages([tax_id]).get(tax_id)
 
         if lineage:
             log.debug('{} tax_id "{}" is cached'.format(indent, tax_id))
+        elif self._lineages_from_ancestors:
+            lineage = self._get_lineage_from_ancestors(tax_id)
         else:
             msg = '{} reconstructing lineage of tax_id "{}"'
             msg = msg.format(indent, tax_id)
@@ -219,7 +1329,7 @@ class Taxonomy(object):
                     self._add_rank(_rank, _parent_rank)
 
                     lineage[i] = (_rank, _tax_id)
-                    self.cached[_tax_id] = lineage
+                    self._cache_lineage(_tax_id, lineage)
                     msg = ('renamed undefined rank to {} in '
                            'element {} of lineage of {}')
                     msg = msg.format(_rank, i, tax_id)
@@ -227,10 +1337,306 @@ class Taxonomy(object):
 
                 _parent_rank = _rank
 
-            self.cached[tax_id] = lineage
+            self._cache_lineage(tax_id, lineage)
 
         return lineage
 
+    def _get_lineage_from_ancestors(self, tax_id):
+        """
+        Returns the lineage of tax_id using a single query of table
+        "ancestors", with the same result and side effects as the
+        recursive implementation in _get_lineage: undefined ranks are
+        renamed and the lineage of each ancestor is cached.
+        """
+        a = self.ancestors
+        s = select([a.c.ancestor_id, self.nodes.c.rank],
+                   and_(a.c.tax_id == tax_id,
+                        self.nodes.c.tax_id == a.c.ancestor_id))
+        s = s.order_by(a.c.depth.desc())
+        nodes = s.execute().fetchall()
+        if not nodes:
+            msg = 'value "{}" not found in nodes.tax_id'.format(tax_id)
+            raise ValueError(msg)
+
+        prefix = self.undef_prefix + '_'
+        lineage = []
+        _parent_rank = None
+        for _tax_id, _rank in nodes:
+            if _rank == self.NO_RANK:
+                _rank = prefix + _parent_rank
+                self._add_rank(_rank, _parent_rank)
+            lineage = lineage + [(_rank, _tax_id)]
+            if _tax_id not in self.cached:
+                self._cache_lineage(_tax_id, lineage)
+            _parent_rank = _rank
+
+        return lineage
+
+    def _get_merged_many(self, tax_ids, chunk_size=500):
+        """
+        Returns a dict mapping each obsolete tax_id in tax_ids to the
+        tax_id into which it has been merged (see _get_merged).
+        """
+        merged = {}
+        m = self.merged
+        for chunk in ncbi.partition(iter(set(tax_ids)), chunk_size):
+            s = select([m.c.old_tax_id, m.c.new_tax_id],
+                       m.c.old_tax_id.in_(chunk))
+            for old_tax_id, new_tax_id in s.execute():
+                if old_tax_id in merged:
+                    msg = ('There is more than one value '
+                           'for merged.old_tax_id = "{}"').format(old_tax_id)
+                    raise ValueError(msg)
+                merged[old_tax_id] = new_tax_id
+        return merged
+
+    def resolve_tax_ids(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids to itself if it is found
+        in nodes.tax_id, to the tax_id into which it has been merged if
+        it is obsolete (see _get_merged), or to None if it is unknown.
+        All tax_ids are classified with a single join of a temporary
+        table against nodes and merged.
+        """
+        tax_ids = set(tax_ids)
+        resolved = dict.fromkeys(tax_ids)
+        if not tax_ids:
+            return resolved
+
+        with self.engine.connect() as conn:
+            conn.execute('CREATE TEMPORARY TABLE resolve_tax_ids '
+                         '(tax_id {} PRIMARY KEY)'.format(
+                             ncbi.tax_id_type(conn)))
+            try:
+                conn.execute('INSERT INTO resolve_tax_ids VALUES (?)',
+                             [[t] for t in tax_ids])
+                rows = conn.execute("""SELECT r.tax_id,
+                        nodes.tax_id IS NOT NULL,
+                        merged.new_tax_id
+                    FROM resolve_tax_ids r
+                        LEFT JOIN nodes ON nodes.tax_id = r.tax_id
+                        LEFT JOIN merged ON merged.old_tax_id = r.tax_id""")
+                merged = set()
+                for tax_id, is_node, new_tax_id in rows:
+                    # tax_ids may be stored as integers (see TaxId)
+                    tax_id = unicode(tax_id)
+                    if is_node:
+                        resolved[tax_id] = tax_id
+                        continue
+                    if tax_id in merged:
+                        msg = ('There is more than one value '
+                               'for merged.old_tax_id = "{}"').format(tax_id)
+                        raise ValueError(msg)
+                    merged.add(tax_id)
+                    if new_tax_id is not None:
+                        new_tax_id = unicode(new_tax_id)
+                        if new_tax_id != tax_id:
+                            resolved[tax_id] = new_tax_id
+            finally:
+                conn.execute('DROP TABLE resolve_tax_ids')
+
+        return resolved
+
+    def lineages(self, tax_ids, merge_obsolete=True, ignore_missing=False,
+                 chunk_size=500):
+        """
+        Returns a dict mapping each of tax_ids to its lineage, as
+        returned by _get_lineage. Obsolete tax_ids are resolved using a
+        query for each chunk of chunk_size tax_ids, and nodes are
+        fetched one level of the taxonomy at a time, so the number of
+        queries depends on the depth of the taxonomy rather than on the
+        number of tax_ids. Lineages are cached as in _get_lineage.
+
+        Raises ValueError if a tax_id is not found in nodes.tax_id
+        unless ignore_missing is True, in which case it is omitted
+        from the output.
+        """
+        tax_ids = list(tax_ids)
+        merged = self._get_merged_many(tax_ids) if merge_obsolete else {}
+
+        # keys: tax_id; vals: (parent_id, rank) of each uncached node
+        nodes = {}
+        # keys: tax_id; vals: lineage of each cached node, which is
+        # kept here in case it is evicted while building lineages below
+        known = {}
+        missing = set()
+        pending = set(merged.get(t, t) for t in tax_ids)
+        n = self.nodes
+        while pending:
+            known.update(self._cached_lineages(pending))
+            pending -= set(known)
+            found = set()
+            for chunk in ncbi.partition(iter(pending), chunk_size):
+                s = select([n.c.tax_id, n.c.parent_id, n.c.rank],
+                           n.c.tax_id.in_(chunk))
+                for tax_id, parent_id, rank in s.execute():
+                    nodes[tax_id] = (parent_id, rank)
+                    found.add(tax_id)
+            missing |= pending - found
+            pending = set(nodes[t][0] for t in found
+                          if nodes[t][0] != t) - set(nodes) - set(known)
+
+        if missing and not ignore_missing:
+            msg = 'value "{}" not found in nodes.tax_id'.format(
+                sorted(missing)[0])
+            raise ValueError(msg)
+
+        prefix = self.undef_prefix + '_'
+        output = {}
+        for tax_id in tax_ids:
+            target = merged.get(tax_id, tax_id)
+            # walk up to a cached node or the root, then build the
+            # lineage of each node on the path back down
+            path = []
+            _tax_id = target
+            while _tax_id not in known and _tax_id in nodes:
+                path.append(_tax_id)
+                parent_id = nodes[_tax_id][0]
+                if parent_id == _tax_id:
+                    break
+                _tax_id = parent_id
+            else:
+                if _tax_id not in known:
+                    # tax_id or one of its ancestors is missing
+                    continue
+
+            for _tax_id in reversed(path):
+                parent_id, _rank = nodes[_tax_id]
+                lineage = [] if parent_id == _tax_id else known[parent_id]
+                if _rank == self.NO_RANK:
+                    _parent_rank = lineage[-1][0] if lineage else None
+                    _rank = prefix + _parent_rank
+                    self._add_rank(_rank, _parent_rank)
+                known[_tax_id] = lineage + [(_rank, _tax_id)]
+                self._cache_lineage(_tax_id, known[_tax_id])
+
+            output[tax_id] = known[target]
+
+        return output
+
+    def map_lineages(self, tax_ids, workers=4, chunk_size=500,
+                     merge_obsolete=True, ignore_missing=False):
+        """
+        Returns lineages of tax_ids as returned by lineages, dividing
+        tax_ids into chunks of chunk_size that are looked up by a pool
+        of workers threads. Threads wait for the database rather than
+        for each other, so this is faster than lineages for many
+        uncached tax_ids.
+
+        Raises ValueError if workers > 1 and the instance was not
+        created with thread_safe=True.
+        """
+
+        if workers > 1 and not self.thread_safe:
+            raise ValueError(
+                'map_lineages requires Taxonomy(thread_safe=True)')
+
+        def lineages(chunk):
+            return self.lineages(chunk, merge_obsolete=merge_obsolete,
+                                 ignore_missing=ignore_missing,
+                                 chunk_size=chunk_size)
+
+        chunks = ncbi.partition(tax_ids, chunk_size)
+        if workers <= 1:
+            results = itertools.imap(lineages, chunks)
+        else:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(lineages, chunks)
+            finally:
+                pool.close()
+                pool.join()
+
+        output = {}
+        for result in results:
+            output.update(result)
+        return output
+
+    def lca_index(self, filename=None):
+        """
+        Returns an LCAIndex of the taxonomy, building it when first
+        needed. If filename is given, the index is read from it if it
+        was saved for the current contents of the database (checked
+        as for LineageStore), and is otherwise built and saved there.
+        """
+
+        if self._lca_index is not None:
+            return self._lca_index
+
+        index, meta = None, {}
+        if filename:
+            if self.engine.url.get_backend_name() != 'sqlite':
+                raise ValueError('a saved index requires a sqlite database')
+            stat = os.stat(self.engine.url.database)
+            meta = {'size': str(stat.st_size),
+                    'mtime': repr(stat.st_mtime),
+                    'settings': json.dumps([self.NO_RANK,
+                                            self.undef_prefix])}
+            if os.path.exists(filename):
+                index, saved = LCAIndex.load(filename)
+                if any(saved.get(k) != v for k, v in meta.items()):
+                    meta['hash'] = LineageStore.content_hash(self.engine)
+                    if (saved.get('hash'), saved.get('settings')) != (
+                            meta['hash'], meta['settings']):
+                        log.info('taxonomy has changed; rebuilding %s',
+                                 filename)
+                        index = None
+                    else:
+                        index.save(filename, meta)
+                elif index is not None:
+                    meta['hash'] = saved['hash']
+
+        if index is None:
+            log.info('building lowest common ancestor index')
+            n = self.nodes
+            index = LCAIndex.from_nodes(
+                select([n.c.tax_id, n.c.parent_id, n.c.rank]).execute(),
+                no_rank=self.NO_RANK, undef_prefix=self.undef_prefix)
+            if filename:
+                meta.setdefault('hash', LineageStore.content_hash(
+                    self.engine))
+                index.save(filename, meta)
+
+        self._lca_index = index
+        return index
+
+    def lca(self, tax_ids):
+        """
+        Returns (rank, tax_id) of the lowest common ancestor of
+        tax_ids (see lca_many).
+        """
+        return self.lca_many([tax_ids])[0]
+
+    def lca_many(self, tax_id_sets):
+        """
+        Returns a list of (rank, tax_id) of the lowest common ancestor
+        of each of tax_id_sets, or None for a set with no common
+        ancestor, using lca_index. Obsolete tax_ids are first resolved
+        with a query for each chunk of tax_ids, and ranks are named
+        as in lineages (undefined ranks are added to self.ranks).
+
+        Raises ValueError if a set is empty or a tax_id is not found
+        in nodes.tax_id.
+        """
+
+        tax_id_sets = [list(tax_ids) for tax_ids in tax_id_sets]
+        merged = self._get_merged_many(
+            set(itertools.chain.from_iterable(tax_id_sets)))
+        output = self.lca_index().lca_many(
+            [merged.get(t, t) for t in tax_ids] for tax_ids in tax_id_sets)
+
+        prefix = self.undef_prefix + '_'
+        for rank in set(node[0] for node in output if node):
+            # add below_<rank> after below_<rank>'s parent rank
+            below = []
+            while rank.startswith(prefix) and rank not in self.rankset:
+                below.append(rank)
+                rank = rank[len(prefix):]
+            for undefined in reversed(below):
+                self._add_rank(undefined, undefined[len(prefix):])
+
+        return output
+
     def is_below(self, lower, upper):
         return lower in self.ranks_below(upper)
 
@@ -242,11 +1648,15 @@ class Taxonomy(object):
             log.error(err)
         return below
 
-    def synonyms(self, tax_id=None, tax_name=None):
+    def synonyms(self, tax_id=None, tax_name=None, normalize=False):
         if not bool(tax_id) ^ bool(tax_name):
             raise ValueError(
                 'Exactly one of tax_id and tax_name may be provided.')
 
+        if tax_name and normalize:
+            tax_id, _, _ = self.primary_from_name(tax_name, normalize=True)
+            tax_name = None
+
         names = self.names
 
         if tax_name:
@@ -280,16 +1690,18 @@ class Taxonomy(object):
         if tax_name:
             tax_id, primary_name, is_primary = self.primary_from_name(tax_name)
 
-        ldict = dict(self._get_lineage(tax_id))
+        lineage = self._get_lineage(tax_id)
+        ldict = dict(lineage)
 
         ldict['tax_id'] = tax_id
         ldict['parent_id'], _ = self._node(tax_id)
-        ldict['rank'] = self.cached[tax_id][-1][0]
+        ldict['rank'] = lineage[-1][0]
         ldict['tax_name'] = self.primary_from_id(tax_id)
 
         return ldict
 
-    def write_table(self, taxa=None, csvfile=None, full=False):
+    def write_table(self, taxa=None, csvfile=None, full=False,
+                    buffer_size=100000):
         """
         Represent the currently defined taxonomic lineages as a rectangular
         array with columns named "tax_id","rank","tax_name", followed
@@ -297,31 +1709,114 @@ class Taxonomy(object):
         specific ranks.
 
          * taxa - list of taxids to include in the output; if none are
-           provided, use self.cached.keys()
-           (ie, those taxa loaded into the cache).
+           provided, use self.seen
+           (ie, those taxa whose lineages have been built so far).
          * csvfile - an open file-like object
            (see "csvfile" argument to csv.writer)
          * full - if True (the default), includes a column
                   for each rank in self.ranks; otherwise, omits ranks (columns)
                   the are undefined for all taxa.
+         * buffer_size - number of rows built and sorted at a time;
+           if there are more taxa, each sorted batch of rows is saved
+           in a temporary file and the batches are merged.
+
+        Rows are ordered by rank, then by tax_name, then by their
+        order in taxa. Lineages and names found in the caches are
+        used, but those looked up while writing are kept in caches of
+        at most buffer_size items (see _overlay_caches) and are not
+        added to self.seen, so memory used does not grow with the
+        number of taxa.
         """
 
         if not taxa:
-            taxa = self.cached.keys()
-            lin = self.cached.values()
-        else:
-            lin = [self._get_lineage(tax_id) for tax_id in taxa]
+            taxa = list(self.seen)
+
+        with self._overlay_caches(buffer_size):
+            runs, represented = self._sorted_rows(taxa, buffer_size)
+        self._write_rows(runs, represented, csvfile, full)
+
+    def _sorted_rows(self, taxa, buffer_size):
+        """
+        Build the rows of write_table for taxa, buffer_size at a
+        time. Returns a list of runs, each an iterator over sorted
+        (rank ordinal, tax_name, position, row) tuples, and the set of
+        ranks represented in the lineages of taxa.
+        """
+
+        runs = []
+        # the most recent batch, which is only saved to a file if
+        # there is another
+        batch = None
+        position = itertools.count()
+        represented = set()
+        for chunk in ncbi.partition(iter(taxa), buffer_size):
+            if batch is not None:
+                runs.append(self._save_rows(batch))
+            lineages = self.lineages(chunk)
+            names = self.primary_from_ids(chunk)
+            # ranks may be added while building lineages, but ranks
+            # already present keep their order
+            ordinals = dict((rank, i) for i, rank in enumerate(self.ranks))
+            batch = []
+            for tax_id in chunk:
+                lineage = lineages[tax_id]
+                if lineage[-1][1] != tax_id:
+                    # tax_id is obsolete
+                    msg = 'value "{}" not found in nodes.tax_id'.format(
+                        tax_id)
+                    raise ValueError(msg)
+                represented.update(rank for rank, _ in lineage)
+                row = dict(lineage)
+                row['tax_id'] = tax_id
+                # the root is its own parent
+                row['parent_id'] = (
+                    lineage[-2][1] if len(lineage) > 1 else tax_id)
+                row['rank'] = lineage[-1][0]
+                row['tax_name'] = names[tax_id]
+                batch.append((ordinals[row['rank']], row['tax_name'],
+                              next(position), row))
+            batch.sort()
+        if batch is not None:
+            runs.append(iter(batch))
+        return runs, represented
+
+    @contextlib.contextmanager
+    def _overlay_caches(self, size):
+        """
+        Within the block, lineages and primary names are read from
+        the caches, but those added are kept in caches of at most size
+        items placed in front of them (see OverlayCache), and tax_ids
+        are not added to self.seen.
+        """
+
+        cached, name_cache, seen = self.cached, self.name_cache, self.seen
+
+        def overlay(cls, base):
+            if self.thread_safe:
+                return StripedCache(lambda n: cls(base, n), size)
+            return cls(base, size)
+
+        self.cached = overlay(LineageOverlay, cached)
+        self.name_cache = overlay(OverlayCache, name_cache)
+        self.seen = None
+        try:
+            yield
+        finally:
+            self.cached, self.name_cache, self.seen = (
+                cached, name_cache, seen)
+
+    def _write_rows(self, runs, represented, csvfile, full):
+        """
+        Write the rows of runs (see _sorted_rows) to csvfile, merged
+        in the order of write_table.
+        """
 
         # which ranks are actually represented?
         if full:
             ranks = self.ranks
         else:
-            represented = set(itertools.chain.from_iterable(
-                [[node[0] for node in lineage] for lineage in lin]))
             ranks = [r for r in self.ranks if r in represented]
 
-        lineages = [self.lineage(tax_id) for tax_id in taxa]
-
         fields = ['tax_id', 'parent_id', 'rank', 'tax_name'] + ranks
         writer = csv.DictWriter(csvfile, fieldnames=fields,
                                 extrasaction='ignore',
@@ -330,9 +1825,98 @@ class Taxonomy(object):
         # header row
         writer.writeheader()
 
-        for lin in sorted(lineages, key=lambda x: (
-                ranks.index(x['rank']), x['tax_name'])):
-            writer.writerow(lin)
+        # the ordinal of each rank may have changed since each run
+        # was sorted, so runs are merged by the final ordinals
+        ordinals = dict((rank, i) for i, rank in enumerate(self.ranks))
+        runs = [((ordinals[row['rank']], tax_name, i, row)
+                 for _, tax_name, i, row in run) for run in runs]
+        for _, _, _, row in heapq.merge(*runs):
+            writer.writerow(row)
+
+    @staticmethod
+    def _save_rows(rows):
+        """
+        Save rows (see write_table) to a temporary file, returning an
+        iterator over the rows read back from the file.
+        """
+
+        tmp = tempfile.TemporaryFile()
+        for row in rows:
+            marshal.dump(row, tmp)
+        tmp.seek(0)
+
+        def read():
+            with tmp:
+                while True:
+                    try:
+                        yield marshal.load(tmp)
+                    except EOFError:
+                        break
+
+        return read()
+
+    def write_lineage_table(self, tax_ids=None, csvfile=None, full=False):
+        """
+        Write the output of ``write_table`` for tax_ids and each node
+        in their lineages (or for all nodes if tax_ids is None) using
+        table "lineages" (see ``ncbi.build_lineages``). Rows are written
+        as they are read from the database. Taxa with the same rank
+        and name are ordered by tax_id.
+        """
+
+        where = ''
+        with self.engine.connect() as conn:
+            if tax_ids is not None:
+                where = 'WHERE tax_id IN (SELECT tax_id FROM lineage_export)'
+                conn.execute('CREATE TEMPORARY TABLE lineage_export '
+                             '(tax_id TEXT PRIMARY KEY)')
+            try:
+                ranks = [rank for rank, in conn.execute(
+                    'SELECT rank FROM lineage_ranks ORDER BY position')]
+                if tax_ids:
+                    conn.execute('INSERT OR IGNORE INTO lineage_export '
+                                 'VALUES (?)', [[t] for t in set(tax_ids)])
+                    # add the nodes in the lineage of each tax_id by
+                    # following parent_id, since the rank columns hold
+                    # only the lowest node of each rank
+                    conn.execute("""INSERT OR IGNORE INTO lineage_export
+                        WITH RECURSIVE up(tax_id) AS (
+                            SELECT tax_id FROM lineage_export
+                            UNION
+                            SELECT lineages.parent_id
+                            FROM up JOIN lineages USING (tax_id)
+                            WHERE lineages.parent_id IS NOT NULL)
+                        SELECT tax_id FROM up""")
+
+                represented = set(rank for rank, in conn.execute(
+                    'SELECT DISTINCT rank FROM lineages ' + where))
+                columns = ncbi.LINEAGE_COLUMNS + [
+                    r for r in ranks if r in represented]
+                if full:
+                    # as in write_table, include a column for each
+                    # rank in self.ranks
+                    ranks = ncbi.order_ranks(self.ranks, columns[4:],
+                                             self.undef_prefix)
+                else:
+                    ranks = columns[4:]
+
+                fields = ['tax_id', 'parent_id', 'rank', 'tax_name'] + ranks
+                writer = csv.DictWriter(csvfile, fieldnames=fields,
+                                        quoting=csv.QUOTE_NONNUMERIC)
+                writer.writeheader()
+
+                rows = conn.execute("""SELECT {}
+                    FROM lineages
+                        JOIN lineage_ranks USING (rank)
+                    {}
+                    ORDER BY lineage_ranks.position, tax_name, tax_id""".format(
+                    ', '.join('"{}"'.format(c) for c in columns), where))
+                for row in rows:
+                    writer.writerow(dict(
+                        (k, v) for k, v in zip(columns, row) if v is not None))
+            finally:
+                if tax_ids is not None:
+                    conn.execute('DROP TABLE lineage_export')
 
     def add_source(self, name, description=None):
         """
@@ -363,6 +1947,21 @@ class Taxonomy(object):
         if not source_id:
             source_id, source_is_new = self.add_source(name=source_name)
 
+        self._insert_node(tax_id, parent_id, rank, tax_name, children,
+                          source_id)
+
+        lineage = self.lineage(tax_id)
+
+        log.debug(lineage)
+        return lineage
+
+    def _insert_node(self, tax_id, parent_id, rank, tax_name, children,
+                     source_id):
+        """
+        Write a new node to the database, updating the optional
+        tables and the caches of lineages below it.
+        """
+
         self.nodes.insert().execute(tax_id=tax_id,
                                     parent_id=parent_id,
                                     rank=rank,
@@ -371,17 +1970,199 @@ class Taxonomy(object):
         self.names.insert().execute(tax_id=tax_id,
                                     tax_name=tax_name,
                                     is_primary=1)
+        if self.name_index is not None:
+            self.name_index.insert().prefix_with('OR IGNORE').execute(
+                normalized=ncbi.normalize_name(tax_name), tax_name=tax_name)
+        if self.name_grams is not None:
+            ncbi.add_fuzzy_name(self.engine, tax_name)
+        self._lca_index = None
 
         if children:
             for child in children:
                 ret = self.nodes.update(self.nodes.c.tax_id == child, {
                                         'parent_id': tax_id})
                 ret.execute()
+                self.node_cache.pop(child, None)
+            # lineages below the new node have changed
+            self.cached.clear()
+            if self.lineage_store is not None:
+                self.lineage_store.clear()
 
-        lineage = self.lineage(tax_id)
+        if self.ancestors is not None:
+            self._add_ancestors(tax_id, parent_id, children or [])
 
-        log.debug(lineage)
-        return lineage
+        if self.lineage_table is not None:
+            ncbi.update_lineages(self.engine, tax_id,
+                                 no_rank=self.NO_RANK,
+                                 undef_prefix=self.undef_prefix)
+
+    def add_nodes(self, rows, skip_existing=False, lineages=False):
+        """
+        Add many nodes to the taxonomy in a single transaction. Each
+        of rows is a dict of the arguments of add_node. Rows are
+        inserted in topological order, so a row may name another row
+        as its parent, and nodes, names and the new parent of each of
+        children are each written with a single statement.
+
+        Raises ValueError if a parent_id is neither in nodes.tax_id
+        nor in rows, if rows contain a cycle, or if a tax_id is
+        already in nodes.tax_id (unless skip_existing is True, in
+        which case that row is skipped).
+
+        Returns a list of the tax_ids added, or, if lineages is True,
+        a dict mapping each of them to its lineage (see lineages).
+        """
+
+        added = [row['tax_id'] for row in
+                 self._insert_nodes(rows, skip_existing=skip_existing)]
+        return self.lineages(added) if lineages else added
+
+    def _insert_nodes(self, rows, skip_existing=False):
+        """
+        Insert rows (see add_nodes), returning the rows inserted in
+        the order they were inserted.
+        """
+
+        new = collections.OrderedDict()
+        for row in rows:
+            if row['tax_id'] in new:
+                msg = 'tax_id "{}" appears more than once'.format(
+                    row['tax_id'])
+                raise ValueError(msg)
+            if not (row.get('source_id') or row.get('source_name')):
+                raise ValueError(
+                    'Taxonomy.add_nodes requires source_id or source_name')
+            new[row['tax_id']] = dict(row)
+
+        resolved = self.resolve_tax_ids(new)
+        for tax_id in new.keys():
+            if resolved[tax_id] == tax_id:
+                if not skip_existing:
+                    msg = 'tax_id "{}" already in nodes.tax_id'.format(
+                        tax_id)
+                    raise ValueError(msg)
+                log.info('node with tax_id %s already exists', tax_id)
+                del new[tax_id]
+
+        # order rows so that each parent precedes its children
+        ordered = []
+        for tax_id in list(new):
+            path = []
+            while tax_id in new and tax_id not in path:
+                path.append(tax_id)
+                parent_id = new[tax_id]['parent_id']
+                if parent_id == tax_id:
+                    break
+                tax_id = parent_id
+            else:
+                if tax_id in path:
+                    msg = 'tax_id "{}" is its own ancestor'.format(tax_id)
+                    raise ValueError(msg)
+            ordered.extend(new.pop(t) for t in reversed(path))
+
+        parents = set(row['parent_id'] for row in ordered)
+        parents -= set(row['tax_id'] for row in ordered)
+        resolved = self.resolve_tax_ids(parents)
+        for parent_id in sorted(parents):
+            if resolved[parent_id] != parent_id:
+                msg = 'parent_id "{}" not found in nodes.tax_id'.format(
+                    parent_id)
+                raise ValueError(msg)
+
+        if not ordered:
+            return ordered
+
+        source_ids = {}
+        for row in ordered:
+            if not row.get('source_id'):
+                name = row['source_name']
+                if name not in source_ids:
+                    source_ids[name], _ = self.add_source(name=name)
+                row['source_id'] = source_ids[name]
+
+        reparented = [(row['tax_id'], child) for row in ordered
+                      for child in row.get('children') or []]
+        update = self.nodes.update().where(
+            self.nodes.c.tax_id == sqlalchemy.bindparam('child')).values(
+                parent_id=sqlalchemy.bindparam('new_parent_id'))
+
+        with self.engine.begin() as conn:
+            conn.execute(self.nodes.insert(), [
+                {'tax_id': row['tax_id'],
+                 'parent_id': row['parent_id'],
+                 'rank': row['rank'],
+                 'source_id': row['source_id']}
+                for row in ordered])
+            conn.execute(self.names.insert(), [
+                {'tax_id': row['tax_id'],
+                 'tax_name': row['tax_name'],
+                 'is_primary': 1}
+                for row in ordered])
+            if reparented:
+                conn.execute(update, [
+                    {'new_parent_id': parent_id, 'child': child}
+                    for parent_id, child in reparented])
+
+            if self.name_index is not None:
+                conn.execute(
+                    self.name_index.insert().prefix_with('OR IGNORE'), [
+                        {'normalized': ncbi.normalize_name(row['tax_name']),
+                         'tax_name': row['tax_name']}
+                        for row in ordered])
+            if self.name_grams is not None:
+                for row in ordered:
+                    ncbi.add_fuzzy_name(conn, row['tax_name'])
+            if self.ancestors is not None:
+                for row in ordered:
+                    self._add_ancestors(row['tax_id'], row['parent_id'],
+                                        row.get('children') or [],
+                                        bind=conn)
+            if self.lineage_table is not None:
+                tax_ids = set(row['tax_id'] for row in ordered)
+                for row in ordered:
+                    if row['parent_id'] not in tax_ids:
+                        ncbi.update_lineages(conn, row['tax_id'],
+                                             no_rank=self.NO_RANK,
+                                             undef_prefix=self.undef_prefix)
+        self._lca_index = None
+
+        if reparented:
+            for _, child in reparented:
+                self.node_cache.pop(child, None)
+            # lineages below the new nodes have changed
+            self.cached.clear()
+            if self.lineage_store is not None:
+                self.lineage_store.clear()
+
+        return ordered
+
+    def _add_ancestors(self, tax_id, parent_id, children, bind=None):
+        """
+        Update table "ancestors" for a new node tax_id with parent
+        parent_id, moving the subtree of each of children below it.
+        """
+        with ncbi.transaction(bind or self.engine) as conn:
+            conn.execute("""INSERT INTO ancestors (tax_id, ancestor_id, depth)
+                SELECT ?, ?, 0
+                UNION ALL
+                SELECT ?, ancestor_id, depth + 1 FROM ancestors
+                WHERE tax_id = ?""", [tax_id, tax_id, tax_id, parent_id])
+
+            for child in children:
+                # replace the ancestors of child and its descendants
+                # with tax_id and its ancestors
+                conn.execute("""DELETE FROM ancestors
+                    WHERE tax_id IN (
+                        SELECT tax_id FROM ancestors WHERE ancestor_id = ?)
+                    AND depth > (
+                        SELECT depth FROM ancestors sub
+                        WHERE sub.tax_id = ancestors.tax_id
+                            AND sub.ancestor_id = ?)""", [child, child])
+                conn.execute("""INSERT INTO ancestors (tax_id, ancestor_id, depth)
+                    SELECT sub.tax_id, up.ancestor_id, sub.depth + up.depth + 1
+                    FROM ancestors sub
+                        JOIN ancestors up ON up.tax_id = ?
+                    WHERE sub.ancestor_id = ?""", [tax_id, child])
 
     def sibling_of(self, tax_id):
         """Return None or a tax_id of a sibling of *tax_id*.
@@ -409,6 +2190,13 @@ class Taxonomy(object):
     def is_ancestor_of(self, node, ancestor):
         if node is None or ancestor is None:
             return False
+        if self.ancestors is not None:
+            # raises ValueError for an unknown node, as does lineage
+            self._node(node)
+            a = self.ancestors
+            s = select([a.c.depth], and_(a.c.tax_id == node,
+                                         a.c.ancestor_id == ancestor))
+            return s.execute().fetchone() is not None
         l = self.lineage(node)
         return ancestor in l.values()
 
@@ -430,6 +2218,152 @@ class Taxonomy(object):
         ids = [t[0] for t in fetch]
         return ids
 
+    def descendants(self, tax_id, rank=None, valid_only=False):
+        """
+        Returns an iterator over the tax_ids of all nodes below tax_id
+        (closest first), optionally only those with rank and with
+        nodes.is_valid set. Nodes are read from table "ancestors" if
+        present, or otherwise using a single recursive query of nodes.
+
+        Raises ValueError if tax_id is not in nodes.tax_id.
+        """
+
+        self._node(tax_id)
+
+        params = [tax_id]
+        if self.ancestors is not None:
+            query = """SELECT nodes.tax_id
+                FROM ancestors
+                    JOIN nodes ON nodes.tax_id = ancestors.tax_id"""
+            where = ['ancestors.ancestor_id = ?', 'ancestors.depth > 0']
+            order = ' ORDER BY ancestors.depth'
+        else:
+            # the recursive query is a subquery since sqlite3 in
+            # python 2 returns no result for an empty query starting
+            # with WITH
+            query = """SELECT nodes.tax_id
+                FROM (
+                    WITH RECURSIVE subtree(tax_id) AS (
+                        SELECT tax_id FROM nodes
+                        WHERE parent_id = ? AND tax_id != parent_id
+                        UNION ALL
+                        SELECT nodes.tax_id
+                        FROM subtree
+                            JOIN nodes ON nodes.parent_id = subtree.tax_id
+                        WHERE nodes.tax_id != nodes.parent_id
+                    )
+                    SELECT tax_id FROM subtree
+                ) subtree
+                    JOIN nodes ON nodes.tax_id = subtree.tax_id"""
+            where = []
+            order = ''
+
+        if rank is not None:
+            where.append('nodes.rank = ?')
+            params.append(rank)
+        # databases created by older versions have no column is_valid
+        if valid_only and 'is_valid' in self.nodes.c:
+            where.append('nodes.is_valid')
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+
+        return self._iter_tax_ids(query + order, params)
+
+    def _iter_tax_ids(self, query, params):
+        with self.engine.connect() as conn:
+            for tax_id, in conn.execute(query, params):
+                # tax_ids may be stored as integers (see TaxId)
+                yield unicode(tax_id)
+
+    def _nodes(self, tax_ids, chunk_size=500):
+        """
+        Returns a dict mapping each of tax_ids found in nodes.tax_id
+        to (parent_id, rank), as returned by _node, using a query for
+        each chunk of chunk_size uncached tax_ids.
+        """
+
+        output = {}
+        pending = []
+        for tax_id in set(tax_ids):
+            node = self.node_cache.get(tax_id)
+            if node is None:
+                pending.append(tax_id)
+            else:
+                output[tax_id] = node
+
+        n = self.nodes
+        for chunk in ncbi.partition(iter(pending), chunk_size):
+            s = select([n.c.tax_id, n.c.parent_id, n.c.rank],
+                       n.c.tax_id.in_(chunk))
+            for tax_id, parent_id, rank in s.execute():
+                output[tax_id] = self.node_cache[tax_id] = (parent_id, rank)
+
+        return output
+
+    def _children_many(self, tax_ids, n=None, chunk_size=500):
+        """
+        Returns a dict mapping each of tax_ids to a list of (tax_id,
+        rank) of at most n of its children having a rank in
+        ranks_below(rank of tax_id), or of any rank if the rank of
+        tax_id is not in self.ranks, ordered by tax_id (see
+        _tax_id_key). Children of each chunk of chunk_size tax_ids are
+        fetched with a single query and filtered using the position of
+        each rank in self.ranks.
+
+        Raises ValueError if a tax_id is not found in nodes.tax_id.
+        """
+
+        tax_ids = set(tax_ids)
+        nodes = self._nodes(tax_ids)
+        for tax_id in tax_ids:
+            if tax_id not in nodes:
+                msg = 'value "{}" not found in nodes.tax_id'.format(tax_id)
+                raise ValueError(msg)
+
+        ordinals = dict((rank, i) for i, rank in enumerate(self.ranks))
+        lowest = dict((tax_id, ordinals.get(rank))
+                      for tax_id, (_, rank) in nodes.items())
+
+        output = dict((tax_id, []) for tax_id in tax_ids)
+        c = self.nodes.c
+        for chunk in ncbi.partition(iter(tax_ids), chunk_size):
+            s = select([c.parent_id, c.tax_id, c.rank],
+                       and_(c.parent_id.in_(chunk), c.tax_id != c.parent_id))
+            for parent_id, tax_id, rank in s.execute():
+                below = lowest[parent_id]
+                if below is None or ordinals.get(rank, -1) >= below:
+                    output[parent_id].append((tax_id, rank))
+        for children in output.values():
+            children.sort(key=lambda child: self._tax_id_key(child[0]))
+            if n is not None:
+                del children[n:]
+        return output
+
+    def _check_below(self, pairs):
+        """
+        Consistency check used in debug mode: for each (tax_id,
+        descendants) in pairs, tax_id is an ancestor of each of
+        descendants.
+        """
+
+        for tax_id, descendants in pairs:
+            for t in descendants:
+                assert self.is_ancestor_of(t, tax_id), (t, tax_id)
+
+    def children_of_many(self, tax_ids, n=None):
+        """
+        Returns a dict mapping each of tax_ids to a list of at most n
+        of its children (see child_of), using a query for each chunk
+        of tax_ids.
+        """
+
+        output = dict(
+            (tax_id, [child for child, _ in children])
+            for tax_id, children in self._children_many(tax_ids, n).items())
+        if self.debug:
+            self._check_below(output.items())
+        return output
+
     def child_of(self, tax_id):
         """Return None or a tax id of a child of *tax_id*.
 
@@ -440,41 +2374,19 @@ class Taxonomy(object):
         """
         if tax_id is None:
             return None
-        parent_id, rank = self._node(tax_id)
-        s = select([self.nodes.c.tax_id],
-                   and_(self.nodes.c.parent_id == tax_id,
-                        or_(*[self.nodes.c.rank == r
-                              for r in self.ranks_below(rank)])))
-        res = s.execute()
-        output = res.fetchone()
-        if not output:
+        children = self.children_of_many([tax_id], 1)[tax_id]
+        if not children:
             msg = ('No children of tax_id {} with '
                    'rank below {} found in database')
-            msg = msg.format(tax_id, rank)
+            msg = msg.format(tax_id, self.rank(tax_id))
             log.warning(msg)
             return None
-        else:
-            r = output[0]
-            assert self.is_ancestor_of(r, tax_id)
-            return r
+        return children[0]
 
     def children_of(self, tax_id, n):
         if tax_id is None:
             return None
-        parent_id, rank = self._node(tax_id)
-        s = select([self.nodes.c.tax_id],
-                   and_(self.nodes.c.parent_id == tax_id,
-                        or_(*[self.nodes.c.rank == r
-                              for r in self.ranks_below(rank)]))).limit(n)
-        res = s.execute()
-        output = res.fetchall()
-        if not output:
-            return []
-        else:
-            r = [x[0] for x in output]
-            for x in r:
-                assert self.is_ancestor_of(x, tax_id)
-            return r
+        return self.children_of_many([tax_id], n)[tax_id]
 
     def parent_id(self, tax_id, rank=None):
         parent_id, tax_rank = self._node(tax_id)
@@ -495,27 +2407,473 @@ class Taxonomy(object):
         """
         if tax_id is None:
             return None
-        parent_id, rank = self._node(tax_id)
-        if rank == 'species':
-            return [tax_id]
-        else:
-            children = self.children_of(tax_id, 2)
-            species_taxids = []
-            for t in children:
-                species_taxids.extend(self.nary_subtree(t, n))
-            return species_taxids
+        return self.nary_subtree_many([tax_id], n)[tax_id]
+
+    def nary_subtree_many(self, tax_ids, n=2):
+        """
+        Returns a dict mapping each of tax_ids to its nary_subtree,
+        fetching the children of all nodes at each level of the
+        subtrees with a query for each chunk of nodes.
+
+        Raises ValueError if a tax_id is not found in nodes.tax_id.
+        """
+
+        tax_ids = set(tax_ids)
+        ranks = dict((tax_id, rank) for tax_id, (_, rank)
+                     in self._nodes(tax_ids).items())
+        children = {}
+        pending = [t for t in tax_ids if ranks.get(t) != 'species']
+        while pending:
+            found = self._children_many(pending, n)
+            children.update(
+                (t, [child for child, _ in found[t]]) for t in found)
+            pending = []
+            for child, rank in itertools.chain.from_iterable(found.values()):
+                ranks[child] = rank
+                if rank != 'species':
+                    pending.append(child)
+
+        def subtree(tax_id):
+            if ranks[tax_id] == 'species':
+                return [tax_id]
+            return list(itertools.chain.from_iterable(
+                subtree(t) for t in children[tax_id]))
+
+        output = dict((tax_id, subtree(tax_id)) for tax_id in tax_ids)
+        if self.debug:
+            self._check_below(output.items())
+        return output
 
     def species_below(self, tax_id):
         if tax_id is None:
             return None
+        return self.species_below_many([tax_id])[tax_id]
+
+    def species_below_many(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids to a species at or
+        below it, or to None if there is none or the tax_id is not in
+        nodes.tax_id. Species are found by following the first child
+        (see child_of) of each tax_id, fetching the children of all
+        tax_ids at each level of the taxonomy with a query for each
+        chunk of tax_ids.
+        """
+
+        tax_ids = set(t for t in tax_ids if t is not None)
+        nodes = self._nodes(tax_ids)
+        output = dict.fromkeys(tax_ids)
+        # keys: tax_id; vals: node reached from tax_id so far
+        pending = {}
+        for tax_id, (_, rank) in nodes.items():
+            if rank == 'species':
+                output[tax_id] = tax_id
+            else:
+                pending[tax_id] = tax_id
+
+        while pending:
+            children = self._children_many(set(pending.values()), 1)
+            for tax_id, node in pending.items():
+                if not children[node]:
+                    del pending[tax_id]
+                    continue
+                child, rank = children[node][0]
+                if rank == 'species':
+                    output[tax_id] = child
+                    del pending[tax_id]
+                else:
+                    pending[tax_id] = child
+
+        if self.debug:
+            self._check_below((tax_id, [species])
+                              for tax_id, species in output.items()
+                              if species is not None)
+        return output
+
+
+class InMemoryTaxonomy(Taxonomy):
+
+    def __init__(self, engine, ranks=ncbi.RANKS,
+                 NO_RANK='no_rank', undef_prefix='below', cache_size=None,
+                 lineage_store=None, debug=False, thread_safe=False,
+                 pool_size=8, pool_timeout=30):
+        """
+        A Taxonomy that loads tables nodes, names and merged into
+        memory when it is created, so that lineages, names and the
+        relationships between nodes are found without querying the
+        database. Arguments are as for Taxonomy.
+
+        Nodes are stored in arrays indexed by the position of each
+        tax_id in self._tax_ids; the names of each node are stored
+        contiguously, starting at self._name_offsets[index]. Nodes
+        added using add_node are written to the database and added to
+        memory.
+        """
+
+        super(InMemoryTaxonomy, self).__init__(
+            engine, ranks, NO_RANK=NO_RANK, undef_prefix=undef_prefix,
+            cache_size=cache_size, lineage_store=lineage_store,
+            debug=debug, thread_safe=thread_safe, pool_size=pool_size,
+            pool_timeout=pool_timeout)
+        # lineages are built from the nodes in memory
+        self._lineages_from_ancestors = False
+        self.load()
+
+    def load(self):
+        """
+        Read nodes, names and merged into memory using a query of each
+        table.
+        """
+
+        log.info('loading taxonomy into memory')
+
+        n = self.nodes
+        rows = select([n.c.tax_id, n.c.parent_id, n.c.rank]).execute()
+        rows = rows.fetchall()
+
+        self._tax_ids = [tax_id for tax_id, _, _ in rows]
+        self._index = dict((tax_id, i) for i, tax_id
+                           in enumerate(self._tax_ids))
+
+        # index of the parent of each node, or -1 if the parent is
+        # not in nodes (in which case its tax_id is in self._orphans)
+        self._parents = array.array('l')
+        self._orphans = {}
+        # rank of each node, as an index into self._rank_names
+        self._rank_ids = array.array('l')
+        self._rank_names = []
+        for i, (tax_id, parent_id, rank) in enumerate(rows):
+            parent = self._index.get(parent_id, -1)
+            if parent == -1:
+                self._orphans[i] = parent_id
+            self._parents.append(parent)
+            self._rank_ids.append(self._rank_id(rank))
+        del rows
+
+        # names, grouped by node
+        nm = self.names
+        rows = select([nm.c.tax_id, nm.c.tax_name, nm.c.is_primary])
+        rows = [(self._index[tax_id], tax_name, is_primary)
+                for tax_id, tax_name, is_primary in rows.execute()
+                if tax_id in self._index]
+        self._name_offsets = self._offsets(
+            len(self._tax_ids), (i for i, _, _ in rows))
+        fill = array.array('l', self._name_offsets)
+        self._name_strings = [None] * len(rows)
+        self._name_primary = array.array('b', [0] * len(rows))
+        self._primary = [None] * len(self._tax_ids)
+        # keys: tax_name; vals: (index, is_primary) of the first
+        # matching row, as selected by primary_from_name
+        self._name_lookup = {}
+        # keys: tax_name; vals: [(index, is_primary), ...] of further
+        # rows matching names of more than one node
+        self._homonyms = collections.defaultdict(list)
+        # keys: normalized name; vals: names; built by match_names
+        self._normalized = None
+        for i, tax_name, is_primary in rows:
+            self._name_strings[fill[i]] = tax_name
+            self._name_primary[fill[i]] = is_primary
+            fill[i] += 1
+            if is_primary:
+                self._primary[i] = tax_name
+            if tax_name not in self._name_lookup:
+                self._name_lookup[tax_name] = (i, is_primary)
+            elif self._name_lookup[tax_name][0] != i:
+                self._homonyms[tax_name].append((i, is_primary))
+        del rows
+
+        m = self.merged
+        self._merged = {}
+        self._merged_duplicates = set()
+        for old_tax_id, new_tax_id in select(
+                [m.c.old_tax_id, m.c.new_tax_id]).execute():
+            if old_tax_id in self._merged:
+                self._merged_duplicates.add(old_tax_id)
+            self._merged[old_tax_id] = new_tax_id
+
+        # children of each node are indexed when first needed
+        self._child_offsets = None
+        self._children = None
+
+        log.info('loaded %d nodes and %d names',
+                 len(self._tax_ids), len(self._name_strings))
+
+    @staticmethod
+    def _offsets(size, indices):
+        """
+        Returns an array of size + 1 offsets such that the items
+        belonging to each index in indices occupy positions
+        offsets[index] to offsets[index + 1] of an array.
+        """
+        offsets = array.array('l', [0] * (size + 1))
+        for i in indices:
+            offsets[i + 1] += 1
+        for i in xrange(size):
+            offsets[i + 1] += offsets[i]
+        return offsets
+
+    def _rank_id(self, rank):
         try:
-            parent_id, rank = self._node(tax_id)
+            return self._rank_names.index(rank)
         except ValueError:
-            return None
-        if rank == 'species':
-            return tax_id
+            self._rank_names.append(rank)
+            return len(self._rank_names) - 1
+
+    def _get_index(self, tax_id):
+        try:
+            return self._index[tax_id]
+        except KeyError:
+            msg = 'value "{}" not found in nodes.tax_id'.format(tax_id)
+            raise ValueError(msg)
+
+    def _parent_of(self, i):
+        parent = self._parents[i]
+        if parent == -1:
+            return self._orphans[i]
+        return self._tax_ids[parent]
+
+    def _child_indices(self, i):
+        """
+        Returns the indices of the children of the node at index i.
+        """
+        if self._child_offsets is None:
+            parents = [(p, c) for c, p in enumerate(self._parents)
+                       if p not in (-1, c)]
+            offsets = self._offsets(
+                len(self._tax_ids), (p for p, _ in parents))
+            fill = array.array('l', offsets)
+            children = array.array('l', [0] * len(parents))
+            for p, c in parents:
+                children[fill[p]] = c
+                fill[p] += 1
+            # set offsets last, since other threads test them
+            self._children = children
+            self._child_offsets = offsets
+        return self._children[
+            self._child_offsets[i]:self._child_offsets[i + 1]]
+
+    def _node(self, tax_id):
+        """
+        Returns parent_id, rank
+        """
+        i = self._get_index(tax_id)
+        return self._parent_of(i), self._rank_names[self._rank_ids[i]]
+
+    def primary_from_id(self, tax_id):
+        i = self._index.get(tax_id)
+        tax_name = None if i is None else self._primary[i]
+        if tax_name is None:
+            msg = 'value "{}" not found in names.tax_id'.format(tax_id)
+            raise ValueError(msg)
+        return tax_name
+
+    def primary_from_ids(self, tax_ids, chunk_size=None):
+        return dict((tax_id, self.primary_from_id(tax_id))
+                    for tax_id in tax_ids)
+
+    def primary_from_name(self, tax_name, normalize=False):
+        if normalize:
+            return super(InMemoryTaxonomy, self).primary_from_name(
+                tax_name, normalize=True)
+
+        try:
+            i, is_primary = self._name_lookup[tax_name]
+        except KeyError:
+            msg = '"{}" not found in names.tax_names'.format(tax_name)
+            raise ValueError(msg)
+
+        if tax_name in self._homonyms:
+            matches = self._name_nodes([tax_name])[tax_name]
+            tax_id = self._choose_node(matches)
+            is_primary, primary_name = matches[tax_id]
+            return tax_id, primary_name, is_primary
+
+        if not is_primary:
+            tax_name = self._primary[i]
+
+        return self._tax_ids[i], tax_name, bool(is_primary)
+
+    def _name_nodes(self, tax_names):
+        nodes = {}
+        for tax_name in set(tax_names):
+            if tax_name not in self._name_lookup:
+                continue
+            rows = [self._name_lookup[tax_name]]
+            rows.extend(self._homonyms.get(tax_name, []))
+            matches = nodes[tax_name] = {}
+            for i, is_primary in rows:
+                tax_id = self._tax_ids[i]
+                if is_primary:
+                    matches[tax_id] = (True, tax_name)
+                else:
+                    matches.setdefault(tax_id, (False, self._primary[i]))
+        return nodes
+
+    def match_names(self, tax_names):
+        if self._normalized is None:
+            normalized = collections.defaultdict(list)
+            for name in sorted(self._name_lookup):
+                if name is not None:
+                    normalized[ncbi.normalize_name(name)].append(name)
+            self._normalized = normalized
+        return dict(
+            (tax_name, list(self._normalized.get(
+                ncbi.normalize_name(tax_name), [])))
+            for tax_name in tax_names)
+
+    def _get_merged(self, old_tax_id):
+        if old_tax_id in self._merged_duplicates:
+            msg = ('There is more than one value '
+                   'for merged.old_tax_id = "{}"').format(old_tax_id)
+            raise ValueError(msg)
+        return self._merged.get(old_tax_id, old_tax_id)
+
+    def resolve_tax_ids(self, tax_ids):
+        resolved = {}
+        for tax_id in tax_ids:
+            if tax_id in self._index:
+                resolved[tax_id] = tax_id
+            else:
+                new_tax_id = self._get_merged(tax_id)
+                resolved[tax_id] = None if new_tax_id == tax_id else new_tax_id
+        return resolved
+
+    def lineages(self, tax_ids, merge_obsolete=True, ignore_missing=False,
+                 chunk_size=None):
+        output = {}
+        for tax_id in tax_ids:
+            try:
+                output[tax_id] = self._get_lineage(
+                    tax_id, merge_obsolete=merge_obsolete)
+            except ValueError:
+                if not ignore_missing:
+                    raise
+        return output
+
+    def synonyms(self, tax_id=None, tax_name=None, normalize=False):
+        if not bool(tax_id) ^ bool(tax_name):
+            raise ValueError(
+                'Exactly one of tax_id and tax_name may be provided.')
+
+        if tax_name and normalize:
+            tax_id, _, _ = self.primary_from_name(tax_name, normalize=True)
+            tax_name = None
+
+        if tax_name:
+            try:
+                i, _ = self._name_lookup[tax_name]
+            except KeyError:
+                msg = '"{}" not found in names.tax_names'.format(tax_name)
+                raise ValueError(msg)
+        elif tax_id in self._index:
+            i = self._index[tax_id]
         else:
-            c = self.child_of(tax_id)
-            newc = self.species_below(c)
-            assert self.is_ancestor_of(newc, tax_id)
-            return newc
+            i = None
+
+        if i is None or self._name_offsets[i] == self._name_offsets[i + 1]:
+            raise ValueError('"{}" not found in names.tax_id'.format(tax_id))
+
+        start, stop = self._name_offsets[i], self._name_offsets[i + 1]
+        return [(self._name_strings[j], self._name_primary[j])
+                for j in xrange(start, stop)]
+
+    def sibling_of(self, tax_id):
+        if tax_id is None:
+            return None
+        i = self._get_index(tax_id)
+        parent = self._parents[i]
+        rank_id = self._rank_ids[i]
+        siblings = self._child_indices(parent) if parent != -1 else []
+        for j in siblings:
+            if j != i and self._rank_ids[j] == rank_id:
+                return self._tax_ids[j]
+
+        msg = 'No sibling of tax_id {} with rank {} found in taxonomy'
+        msg = msg.format(tax_id, self._rank_names[rank_id])
+        log.warning(msg)
+        return None
+
+    def _nodes(self, tax_ids, chunk_size=None):
+        return dict((tax_id, self._node(tax_id)) for tax_id in tax_ids
+                    if tax_id in self._index)
+
+    def _children_many(self, tax_ids, n=None, chunk_size=None):
+        ordinals = dict((rank, i) for i, rank in enumerate(self.ranks))
+        output = {}
+        for tax_id in set(tax_ids):
+            i = self._get_index(tax_id)
+            below = ordinals.get(self._rank_names[self._rank_ids[i]])
+            children = output[tax_id] = []
+            for j in self._child_indices(i):
+                rank = self._rank_names[self._rank_ids[j]]
+                if below is None or ordinals.get(rank, -1) >= below:
+                    children.append((self._tax_ids[j], rank))
+            children.sort(key=lambda child: self._tax_id_key(child[0]))
+            if n is not None:
+                del children[n:]
+        return output
+
+    def descendants(self, tax_id, rank=None, valid_only=False):
+        if valid_only:
+            # nodes.is_valid is not loaded into memory
+            return super(InMemoryTaxonomy, self).descendants(
+                tax_id, rank=rank, valid_only=valid_only)
+
+        queue = collections.deque(self._child_indices(
+            self._get_index(tax_id)))
+        rank_id = None
+        if rank is not None:
+            if rank not in self._rank_names:
+                return iter([])
+            rank_id = self._rank_names.index(rank)
+        return self._iter_descendants(queue, rank_id)
+
+    def _iter_descendants(self, queue, rank_id):
+        while queue:
+            i = queue.popleft()
+            if rank_id is None or self._rank_ids[i] == rank_id:
+                yield self._tax_ids[i]
+            queue.extend(self._child_indices(i))
+
+    def tax_ids(self):
+        return list(self._tax_ids)
+
+    def _insert_node(self, tax_id, parent_id, rank, tax_name, children,
+                     source_id):
+        super(InMemoryTaxonomy, self)._insert_node(
+            tax_id, parent_id, rank, tax_name, children, source_id)
+        self._add_to_memory(tax_id, parent_id, rank, tax_name, children)
+
+    def _insert_nodes(self, rows, skip_existing=False):
+        ordered = super(InMemoryTaxonomy, self)._insert_nodes(
+            rows, skip_existing=skip_existing)
+        for row in ordered:
+            self._add_to_memory(row['tax_id'], row['parent_id'], row['rank'],
+                                row['tax_name'], row.get('children'))
+        return ordered
+
+    def _add_to_memory(self, tax_id, parent_id, rank, tax_name, children):
+        """
+        Append a new node to the arrays in memory, once it has been
+        written to the database.
+        """
+
+        i = len(self._tax_ids)
+        self._tax_ids.append(tax_id)
+        self._index[tax_id] = i
+        parent = self._index.get(parent_id, -1)
+        if parent == -1:
+            self._orphans[i] = parent_id
+        self._parents.append(parent)
+        self._rank_ids.append(self._rank_id(rank))
+
+        self._name_strings.append(tax_name)
+        self._name_primary.append(1)
+        self._name_offsets.append(len(self._name_strings))
+        self._primary.append(tax_name)
+        if self._name_lookup.setdefault(tax_name, (i, True))[0] != i:
+            self._homonyms[tax_name].append((i, True))
+        self._normalized = None
+
+        for child in children or []:
+            self._parents[self._index[child]] = i
+        self._child_offsets = None
@@ -19,6 +19,11 @@ import re
 import subprocess
 import sys
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 log = logging
 
 
@@ -39,6 +44,22 @@ def apply_df_status(func, df, msg=''):
     return df.drop(tmp_column, axis=1)
 
 
+def peak_memory():
+    """
+    Return the peak resident set size of the current process in MB, or
+    None if it can't be determined on this platform.
+    """
+
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on OS X and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        maxrss /= 1024.0
+    return maxrss / 1024.0
+
+
 def get_new_nodes(fname):
     """
     Return an iterator of dicts given a .csv-format file.
@@ -73,6 +94,33 @@ def getlines(fname):
                 yield line.split('#', 1)[0].strip()
 
 
+def edit_distance(a, b, limit=None):
+    """
+    Returns the Levenshtein distance between strings a and b. If
+    limit is provided, returns limit + 1 as soon as the distance is
+    known to exceed limit.
+    """
+
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+
+    previous = range(len(b) + 1)
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+
+    distance = previous[-1]
+    return distance if limit is None else min(distance, limit + 1)
+
+
 def try_set_fields(d, regex, text, hook=lambda x: x):
     v = re.search(regex, text, re.MULTILINE)
     if v:
@@ -0,0 +1,147 @@
+import random
+import shutil
+import threading
+from os import path
+
+import sqlalchemy
+from sqlalchemy import create_engine
+
+import config
+from config import TestBase
+
+import taxtastic.ncbi
+from taxtastic.batching import BatchingTaxonomy, Future
+from taxtastic.taxonomy import Taxonomy
+
+RANKS = list(taxtastic.ncbi.RANKS)
+
+
+class TestFuture(TestBase):
+
+    def test01(self):
+        future = Future()
+        done = []
+        future.add_done_callback(done.append)
+        self.assertFalse(future.done())
+        self.assertRaises(RuntimeError, future.result, 0.01)
+        future.set_result(1)
+        self.assertEqual(done, [future])
+        self.assertEqual(future.result(), 1)
+        future.add_done_callback(done.append)
+        self.assertEqual(len(done), 2)
+
+        future = Future()
+        future.set_exception(ValueError('foo'))
+        self.assertRaises(ValueError, future.result)
+
+
+class TestBatchingTaxonomy(TestBase):
+    """
+    Lookups by many threads at once
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(config.ncbi_master_db, self.dbname)
+        self.engine = create_engine('sqlite:///%s' % self.dbname)
+        self.expected = Taxonomy(self.engine, list(RANKS))
+        self.tax_ids = self.expected.tax_ids()
+        self.names = [self.expected.primary_from_id(t)
+                      for t in self.tax_ids]
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def expect(self, method, *args):
+        try:
+            return getattr(self.expected, method)(*args)
+        except ValueError as err:
+            return type(err)
+
+    def test01(self):
+        tax = Taxonomy(self.engine, list(RANKS), thread_safe=True,
+                       pool_size=4)
+        lookups = BatchingTaxonomy(tax, workers=4, batch_size=50)
+        errors = []
+
+        def client(seed):
+            rand = random.Random(seed)
+            try:
+                futures = []
+                for _ in range(200):
+                    if rand.random() < 0.5:
+                        tax_id = rand.choice(self.tax_ids + ['1761', 'foo'])
+                        futures.append(
+                            (lookups.get_lineage(tax_id),
+                             self.expect('_get_lineage', tax_id)))
+                    else:
+                        name = rand.choice(self.names + ['foo'])
+                        futures.append(
+                            (lookups.primary_from_name(name),
+                             self.expect('primary_from_name', name)))
+                for future, expected in futures:
+                    try:
+                        result = future.result(60)
+                    except ValueError as err:
+                        result = type(err)
+                    self.assertEqual(result, expected)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=client, args=(i, ))
+                   for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        lookups.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(lookups.requests, 50 * 200)
+        self.assertTrue(lookups.coalesced > 0)
+        self.assertTrue(lookups.batches < lookups.requests / 10)
+        self.assertEqual(lookups._futures, {})
+        self.assertRaises(ValueError, lookups.get_lineage, '1280')
+
+    def test02(self):
+        """
+        no more than pool_size connections are used at once
+        """
+
+        tax = Taxonomy(self.engine, list(RANKS), thread_safe=True,
+                       pool_size=2)
+        lock = threading.Lock()
+        connections = {'open': 0, 'most': 0}
+
+        def checkout(*args):
+            with lock:
+                connections['open'] += 1
+                connections['most'] = max(connections['most'],
+                                          connections['open'])
+
+        def checkin(*args):
+            with lock:
+                connections['open'] -= 1
+
+        sqlalchemy.event.listen(tax.engine, 'checkout', checkout)
+        sqlalchemy.event.listen(tax.engine, 'checkin', checkin)
+        with BatchingTaxonomy(tax, workers=8, batch_size=5) as lookups:
+            futures = dict((tax_id, lookups.get_lineage(tax_id))
+                           for tax_id in self.tax_ids)
+            names = dict((name, lookups.primary_from_name(name))
+                         for name in self.names)
+        for tax_id, future in futures.items():
+            self.assertEqual(future.result(60),
+                             self.expected._get_lineage(tax_id))
+        for name, future in names.items():
+            self.assertEqual(future.result(60),
+                             self.expected.primary_from_name(name))
+        self.assertTrue(lookups.batches > 8)
+        self.assertEqual(connections['most'], 2)
+
+    def test03(self):
+        self.assertRaises(ValueError, BatchingTaxonomy, self.expected)
+        with BatchingTaxonomy(self.expected, workers=1) as lookups:
+            future = lookups.get_lineage('1280')
+            self.assertEqual(future.result(60),
+                             self.expected._get_lineage('1280'))
@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
+import csv
 import re
 import os
 from os import path
 import logging
+import multiprocessing
+import zipfile
 
 import taxtastic
 import taxtastic.ncbi
-from taxtastic.ncbi import read_names, read_archive, UNCLASSIFIED_REGEX
+from taxtastic.taxonomy import Taxonomy
+from taxtastic.ncbi import read_names, read_archive, read_archive_chunks, \
+    parse_archive, UNCLASSIFIED_REGEX
 
 from . import config
 from .config import TestBase
@@ -90,6 +95,442 @@ class TestLoadData(TestBase):
             self.assertEqual(self.maxrows, len(list(result)))
 
 
+class TestBulkLoad(TestBase):
+
+    compact = False
+
+    def setUp(self):
+        outdir = self.mkoutdir()
+        self.dbname = os.path.join(outdir, 'taxonomy.db')
+        self.bulk_dbname = os.path.join(outdir, 'bulk_taxonomy.db')
+
+    def dump(self, engine):
+        with engine.begin() as conn:
+            return dict(
+                (table, conn.execute(
+                    'select * from {} order by 1'.format(table)).fetchall())
+                for table in ['nodes', 'names', 'merged'])
+
+    def indexes(self, engine):
+        with engine.begin() as conn:
+            return set(tuple(row) for row in conn.execute(
+                "select name, sql from sqlite_master where type = 'index'"))
+
+    def test01(self):
+        """
+        a bulk load produces the same data and indexes as a regular load
+        """
+
+        engine = taxtastic.ncbi.db_connect(self.dbname, compact=self.compact)
+        taxtastic.ncbi.db_load(engine, ncbi_data)
+
+        bulk_engine = taxtastic.ncbi.db_connect(
+            self.bulk_dbname, compact=self.compact)
+        taxtastic.ncbi.db_load(bulk_engine, ncbi_data, bulk=True)
+
+        self.assertEqual(self.dump(engine), self.dump(bulk_engine))
+        self.assertEqual(self.indexes(engine), self.indexes(bulk_engine))
+
+        with bulk_engine.begin() as conn:
+            result = conn.execute(
+                "select 1 from sqlite_master where name = 'sqlite_stat1'")
+            self.assertTrue(result.fetchone())
+
+    def test02(self):
+        """
+        data is not loaded a second time
+        """
+
+        engine = taxtastic.ncbi.db_connect(
+            self.bulk_dbname, compact=self.compact)
+        taxtastic.ncbi.db_load(engine, ncbi_data, bulk=True)
+        before = self.dump(engine)
+        taxtastic.ncbi.db_load(engine, ncbi_data, bulk=True)
+        self.assertEqual(before, self.dump(engine))
+
+
+class TestCompactBulkLoad(TestBulkLoad):
+
+    compact = True
+
+
+class TestCompactLoad(TestBulkLoad):
+
+    def test01(self):
+        """
+        the compact schema provides the same data as the default schema
+        """
+
+        engine = taxtastic.ncbi.db_connect(self.dbname)
+        taxtastic.ncbi.db_load(engine, ncbi_data)
+
+        compact_engine = taxtastic.ncbi.db_connect(
+            self.bulk_dbname, compact=True)
+        taxtastic.ncbi.db_load(compact_engine, ncbi_data)
+        self.assertTrue(taxtastic.ncbi.is_compact(compact_engine))
+
+        def text(engine):
+            return dict(
+                (table, sorted(tuple(None if value is None else unicode(value)
+                                     for value in row) for row in rows))
+                for table, rows in self.dump(engine).items())
+
+        self.assertEqual(text(engine), text(compact_engine))
+
+    def test02(self):
+        """
+        an existing database keeps its schema
+        """
+
+        engine = taxtastic.ncbi.db_connect(self.dbname, compact=True)
+        engine = taxtastic.ncbi.db_connect(self.dbname)
+        self.assertTrue(taxtastic.ncbi.is_compact(engine))
+
+        engine = taxtastic.ncbi.db_connect(ncbi_master_db, compact=True)
+        self.assertFalse(taxtastic.ncbi.is_compact(engine))
+
+
+class TestParallelLoad(TestBulkLoad):
+
+    def test01(self):
+        """
+        a parallel load produces the same data as a serial load
+        """
+
+        engine = taxtastic.ncbi.db_connect(self.dbname)
+        taxtastic.ncbi.db_load(engine, ncbi_data)
+
+        parallel_engine = taxtastic.ncbi.db_connect(self.bulk_dbname)
+        taxtastic.ncbi.db_load(parallel_engine, ncbi_data, workers=2)
+
+        self.assertEqual(self.dump(engine), self.dump(parallel_engine))
+
+    def test02(self):
+        """
+        rows parsed by a pool are identical to rows parsed serially
+        """
+
+        pool = multiprocessing.Pool(2)
+        try:
+            for fname in ['nodes.dmp', 'names.dmp', 'merged.dmp']:
+                rows = list(parse_archive(ncbi_data, fname, chunk_size=100))
+                parallel_rows = list(parse_archive(
+                    ncbi_data, fname, pool, queue_size=2, chunk_size=100))
+                self.assertEqual(rows, parallel_rows)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class TestUpdate(TestBase):
+    """
+    Update a database loaded from ncbi_data using a modified archive
+    """
+
+    compact = False
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+        self.old_archive = os.path.join(self.outdir, 'old_taxdmp.zip')
+        self.archive = os.path.join(self.outdir, 'taxdmp.zip')
+
+        old = zipfile.ZipFile(ncbi_data)
+        nodes = old.read('nodes.dmp').splitlines(True)
+        names = old.read('names.dmp').splitlines(True)
+        merged = old.read('merged.dmp').splitlines(True)
+
+        # attach nodes with missing parents to the root
+        tax_ids = set(line.split('\t')[0] for line in nodes)
+        for i, line in enumerate(nodes):
+            parent_id = line.split('\t')[2]
+            if parent_id not in tax_ids:
+                nodes[i] = line.replace(parent_id, '1', 1)
+        self.write(self.old_archive, nodes, names, merged)
+
+        # 14 is merged into 13; 7 is moved; 9 changes rank; 21 is new
+        nodes = [line for line in nodes if not line.startswith('14\t')]
+        nodes = [line.replace('7\t|\t6\t', '7\t|\t1\t')
+                 .replace('9\t|\t1\t|\tspecies', '9\t|\t1\t|\tgenus')
+                 for line in nodes]
+        nodes.append(nodes[-1].replace('20\t|\t1\t|\tgenus',
+                                       '21\t|\t20\t|\tspecies'))
+        names = [line.replace('Pelobacter carbinolicus\t', 'Pelobacter sp.\t')
+                 for line in names if not line.startswith('14\t')]
+        names.append('21\t|\tPhenylobacterium immobile\t|\t\t|\t'
+                     'scientific name\t|\n')
+        merged = merged[1:] + ['14\t|\t13\t|\n']
+        self.write(self.archive, nodes, names, merged)
+
+    def write(self, archive, nodes, names, merged):
+        with zipfile.ZipFile(archive, 'w') as zfile:
+            for fname, lines in [('nodes.dmp', nodes), ('names.dmp', names),
+                                 ('merged.dmp', merged)]:
+                zfile.writestr(fname, ''.join(lines))
+
+    def dump(self, engine, exclude=()):
+        queries = [
+            'select cast(tax_id as text), cast(parent_id as text), rank, '
+            'embl_code, division_id, source_id, is_valid from nodes',
+            'select cast(tax_id as text), tax_name, unique_name, name_class, '
+            'is_primary, is_classified from names',
+            'select cast(old_tax_id as text), cast(new_tax_id as text) '
+            'from merged',
+        ]
+        with engine.begin() as conn:
+            return [sorted(tuple(row) for row in conn.execute(query)
+                           if row[0] not in exclude)
+                    for query in queries]
+
+    def load(self, archive, dbname):
+        engine = taxtastic.ncbi.db_connect(
+            os.path.join(self.outdir, dbname), compact=self.compact)
+        taxtastic.ncbi.db_load(engine, archive)
+        return engine
+
+    def test01(self):
+        """
+        an updated database is the same as one loaded from the new archive
+        """
+
+        engine = self.load(self.old_archive, 'taxonomy.db')
+        taxtastic.ncbi.db_update(engine, self.archive)
+        expected = self.load(self.archive, 'expected.db')
+        self.assertEqual(self.dump(engine), self.dump(expected))
+
+    def test02(self):
+        """
+        custom nodes are kept
+        """
+
+        engine = self.load(self.old_archive, 'taxonomy.db')
+        tax = Taxonomy(engine, taxtastic.ncbi.RANKS)
+        tax.add_node('custom1', parent_id='16', rank='species',
+                     tax_name='Methylophilus sp. 1', children=['17'],
+                     source_name='custom')
+        tax.add_node('custom2', parent_id='14', rank='no_rank',
+                     tax_name='Dictyoglomus thermophilum 1',
+                     source_name='custom')
+        taxtastic.ncbi.db_update(engine, self.archive)
+
+        expected = self.load(self.archive, 'expected.db')
+        custom = ['custom1', 'custom2', '17']
+        self.assertEqual(self.dump(engine, custom),
+                         self.dump(expected, custom))
+
+        with engine.begin() as conn:
+            result = dict((row[0], tuple(row[1:])) for row in conn.execute(
+                """select cast(tax_id as text), cast(parent_id as text),
+                is_valid from nodes
+                where tax_id in ('custom1', 'custom2', '17')"""))
+        self.assertEqual(result, {'custom1': ('16', 1),
+                                  'custom2': ('13', 1),
+                                  '17': ('custom1', 1)})
+
+    def test03(self):
+        """
+        nothing changes if the archive has not changed
+        """
+
+        engine = self.load(self.archive, 'taxonomy.db')
+        before = self.dump(engine)
+        taxtastic.ncbi.db_update(engine, self.archive)
+        self.assertEqual(before, self.dump(engine))
+
+    def test04(self):
+        """
+        table ancestors is rebuilt if it exists
+        """
+
+        engine = self.load(self.old_archive, 'taxonomy.db')
+        taxtastic.ncbi.build_ancestors(engine)
+        taxtastic.ncbi.db_update(engine, self.archive)
+
+        expected = self.load(self.archive, 'expected.db')
+        taxtastic.ncbi.build_ancestors(expected)
+        query = 'select * from ancestors order by tax_id, depth'
+        self.assertEqual(engine.execute(query).fetchall(),
+                         expected.execute(query).fetchall())
+
+    def test05(self):
+        """
+        table lineages is rebuilt if it exists
+        """
+
+        engine = self.load(self.old_archive, 'taxonomy.db')
+        taxtastic.ncbi.build_lineages(engine)
+        taxtastic.ncbi.db_update(engine, self.archive)
+
+        expected = self.load(self.archive, 'expected.db')
+        taxtastic.ncbi.build_lineages(expected)
+        for query in ['select * from lineage_ranks order by position',
+                      'select * from lineages order by tax_id']:
+            self.assertEqual(engine.execute(query).fetchall(),
+                             expected.execute(query).fetchall())
+
+    def test06(self):
+        """
+        table normalized_names is rebuilt if it exists
+        """
+
+        engine = self.load(self.old_archive, 'taxonomy.db')
+        taxtastic.ncbi.build_name_index(engine)
+        taxtastic.ncbi.db_update(engine, self.archive)
+
+        expected = self.load(self.archive, 'expected.db')
+        taxtastic.ncbi.build_name_index(expected)
+        query = 'select * from normalized_names order by normalized, tax_name'
+        rows = engine.execute(query).fetchall()
+        self.assertIn((u'pelobacter sp', u'Pelobacter sp.'), rows)
+        self.assertEqual(rows, expected.execute(query).fetchall())
+
+    def test07(self):
+        """
+        table name_grams is rebuilt if it exists
+        """
+
+        engine = self.load(self.old_archive, 'taxonomy.db')
+        taxtastic.ncbi.build_fuzzy_index(engine)
+        taxtastic.ncbi.db_update(engine, self.archive)
+
+        expected = self.load(self.archive, 'expected.db')
+        taxtastic.ncbi.build_fuzzy_index(expected)
+        for query in ['select * from fuzzy_names order by id',
+                      'select * from name_grams order by gram']:
+            self.assertEqual(engine.execute(query).fetchall(),
+                             expected.execute(query).fetchall())
+
+
+class TestCompactUpdate(TestUpdate):
+
+    compact = True
+
+
+class TestNormalizeName(TestBase):
+
+    def test01(self):
+        for name in ['Escherichia coli', ' escherichia_coli ',
+                     '[Escherichia]  coli', 'ESCHERICHIA-COLI.']:
+            self.assertEqual(taxtastic.ncbi.normalize_name(name),
+                             u'escherichia coli')
+        self.assertEqual(taxtastic.ncbi.normalize_name('Lactobacillus sp. 2'),
+                         u'lactobacillus sp 2')
+
+
+class TestFixMissingPrimary(TestBase):
+
+    # tax_id, tax_name, name_class, is_primary before, is_primary after
+    names = [
+        ('1', 'root', 'scientific name', 1, 1),
+        ('1', 'all', 'synonym', 0, 0),
+        ('2', 'b', 'synonym', 0, 0),
+        ('2', 'a', 'scientific name', 0, 1),
+        ('3', 'c', 'synonym', 0, 1),
+        ('3', 'd', 'scientific name', 0, 0),
+        ('3', 'e', 'scientific name', 0, 0),
+        ('4', 'f', 'synonym', 0, 1),
+        ('4', 'g', 'synonym', 0, 0),
+        ('4', 'f', 'synonym', 0, 1),
+    ]
+
+    def setUp(self):
+        outdir = self.mkoutdir()
+        self.engine = taxtastic.ncbi.db_connect(
+            os.path.join(outdir, 'taxonomy.db'))
+        self.report = os.path.join(outdir, 'report.csv')
+        with self.engine.begin() as conn:
+            conn.execute(
+                """INSERT INTO names
+                (tax_id, tax_name, unique_name, name_class, is_primary)
+                VALUES (?, ?, '', ?, ?)""", [row[:4] for row in self.names])
+
+    def test01(self):
+        with open(self.report, 'w') as report:
+            taxtastic.ncbi.fix_missing_primary(self.engine, report=report)
+
+        with self.engine.begin() as conn:
+            result = [tuple(row) for row in conn.execute(
+                'select tax_id, tax_name, name_class, is_primary '
+                'from names order by id')]
+        self.assertEqual(result, [row[:3] + row[4:] for row in self.names])
+
+        with open(self.report) as report:
+            self.assertEqual(
+                list(csv.reader(report)),
+                [['tax_id', 'tax_name', 'unique_name', 'name_class'],
+                 ['2', 'a', '', 'scientific name'],
+                 ['3', 'c', '', 'synonym'],
+                 ['4', 'f', '', 'synonym']])
+
+
+class TestUpdateSubtreeValidity(TestBase):
+
+    # tax_id, parent_id, rank, is_valid before, is_valid after
+    nodes = [
+        ('1', '1', 'root', 1, 1),
+        ('2', '1', 'species', 0, 0),
+        ('3', '2', 'no_rank', 1, 0),
+        ('4', '3', 'species', 1, 0),
+        ('5', '4', 'no_rank', 0, 1),
+        ('6', '1', 'species', 1, 1),
+        ('7', '6', 'no_rank', 0, 1),
+        ('8', '1', 'no_rank', 1, 0),
+        ('9', '8', 'species', 1, 0),
+        ('10', '9', 'no_rank', 1, 0),
+    ]
+
+    def setUp(self):
+        outdir = self.mkoutdir()
+        self.engine = taxtastic.ncbi.db_connect(
+            os.path.join(outdir, 'taxonomy.db'))
+        with self.engine.begin() as conn:
+            conn.execute(
+                """INSERT INTO nodes (tax_id, parent_id, rank, is_valid)
+                VALUES (?, ?, ?, ?)""", [row[:4] for row in self.nodes])
+            conn.execute(
+                """INSERT INTO names (tax_id, tax_name, name_class, is_primary)
+                VALUES (?, ?, ?, ?)""",
+                ['8', 'unclassified Bacteria', 'scientific name', 1])
+
+    def test01(self):
+        taxtastic.ncbi.update_subtree_validity(self.engine)
+        with self.engine.begin() as conn:
+            result = dict(tuple(row) for row in conn.execute(
+                'select tax_id, is_valid from nodes'))
+        self.assertEqual(result, dict((row[0], row[4]) for row in self.nodes))
+
+
+class TestReadArchive(TestBase):
+
+    def setUp(self):
+        self.zipfile = ncbi_data
+
+    def test01(self):
+        """
+        rows are identical regardless of chunk size
+        """
+
+        for fname in ['nodes.dmp', 'names.dmp', 'merged.dmp']:
+            lines = zipfile.ZipFile(self.zipfile).read(fname).splitlines()
+            expected = [line.rstrip('\t|\n').split('\t|\t')
+                        for line in lines]
+            for chunk_size in [1, 7, 100, 2 ** 20]:
+                rows = list(read_archive(self.zipfile, fname,
+                                         chunk_size=chunk_size))
+                self.assertEqual(expected, rows)
+
+    def test02(self):
+        """
+        chunks contain only complete lines
+        """
+
+        chunks = list(read_archive_chunks(self.zipfile, 'names.dmp',
+                                          chunk_size=100))
+        self.assertTrue(len(chunks) > 1)
+        for lines in chunks:
+            for line in lines:
+                self.assertTrue(line.endswith('\t|'))
+
+
 class TestReadNames(TestBase):
 
     def setUp(self):
@@ -115,6 +556,78 @@ class TestReadNames(TestBase):
                               for row in rows), set([None]))
 
 
+class TestNameClassifier(TestBase):
+    """
+    NameClassifier must agree with UNCLASSIFIED_REGEX
+    """
+
+    def setUp(self):
+        self.classifier = taxtastic.ncbi.NameClassifier(
+            taxtastic.ncbi.UNCLASSIFIED_REGEX_COMPONENTS)
+
+    def check(self, names):
+        for name in names:
+            self.assertEqual(
+                bool(UNCLASSIFIED_REGEX.search(name)),
+                self.classifier.search(name), name)
+
+    def test_archive_names(self):
+        self.check(row[1] for row in read_archive(ncbi_data, 'names.dmp'))
+
+    def test_database_names(self):
+        engine = taxtastic.ncbi.db_connect(ncbi_master_db)
+        with engine.begin() as conn:
+            self.check(name for name, in conn.execute(
+                'select tax_name from names'))
+
+    def test_type_strain_names(self):
+        with open(config.data_path('type_strain_names.txt')) as fp:
+            self.check(i.rstrip() for i in fp)
+
+    def test_edge_cases(self):
+        self.check([
+            '', 'Clone', 'Clones', 'XClone', 'bacteria', 'a bacteria',
+            'X bacterial', 'X bacteriales', 'Xbacterium', 'X Aga', 'Algum',
+            'X Alga', 'X algae', 'methanogen', 'methanogenic', 'methanogens',
+            'vent', 'ventral', 'Prevent', 'vector', 'cf. X', 'X cf. Y',
+            'X sp. Y', 'Xsp. Y', 'X group', 'X groups', 'Taxon', 'diazotroph',
+            'X diazotroph', '- X1', 'X 12', 'X 1', 'X-like', 'X likely'])
+
+    def test_is_classified(self):
+        self.assertEqual(
+            self.classifier.is_classified('Lactobacillus crispatus'), 1)
+        self.assertEqual(
+            self.classifier.is_classified('uncultured bacterium'), 0)
+
+    def test_read_names(self):
+        rows = read_names(rows=read_archive(ncbi_data, 'names.dmp'),
+                          unclassified_regex=UNCLASSIFIED_REGEX)
+        classifier_rows = read_names(
+            rows=read_archive(ncbi_data, 'names.dmp'),
+            unclassified_regex=self.classifier)
+        self.assertEqual(list(rows), list(classifier_rows))
+
+
+class TestRequiredLiterals(TestBase):
+
+    def test01(self):
+        self.assertEqual(taxtastic.ncbi.required_literals('strain'),
+                         (['strain'], True))
+
+    def test02(self):
+        self.assertEqual(taxtastic.ncbi.required_literals(r'\b[Gg]roup\b'),
+                         (['Group', 'group'], False))
+
+    def test03(self):
+        self.assertEqual(
+            taxtastic.ncbi.required_literals(r'.+\b[Al]g(um|a)\b'),
+            (['Aga', 'Agum', 'lga', 'lgum'], False))
+
+    def test04(self):
+        self.assertEqual(taxtastic.ncbi.required_literals(r'\d\d'),
+                         (None, False))
+
+
 class TestUnclassifiedRegex(TestBase):
     """
     Test the heuristic used to determine if a taxonomic name is meaningful.
@@ -275,6 +275,8 @@ class TestTaxtable(OutputRedirectMixin, unittest.TestCase):
                     verbosity = 0
                     out_file = h
                     full = False
+                    in_memory = False
+                    lineage_store = None
                 self.assertNotEqual(taxtable.action(_Args()), 0)
 
     def test_seqinfo(self):
@@ -288,6 +290,8 @@ class TestTaxtable(OutputRedirectMixin, unittest.TestCase):
                 out_file = tf
                 verbosity = 0
                 full = False
+                in_memory = False
+                lineage_store = None
             self.assertEqual(taxtable.action(_Args()), 0)
             # No output check at present
             self.assertTrue(tf.tell() > 0)
@@ -113,6 +113,28 @@ class TestTaxTable(TestScriptBase):
             'taxtable %(taxdb)s -o %(outfile)s -t %(datadir)s/taxids1.txt')
         self.assertTrue(path.isfile(self.outfile))
 
+    def test05(self):
+        """--in-memory gives the same output"""
+        self.cmd_ok('taxtable %(taxdb)s -o %(outfile)s -t 180164,166486')
+        with open(self.outfile) as fp:
+            expected = fp.read()
+        self.cmd_ok(
+            'taxtable %(taxdb)s -o %(outfile)s -t 180164,166486 --in-memory')
+        with open(self.outfile) as fp:
+            self.assertEqual(fp.read(), expected)
+
+    def test06(self):
+        """--lineage-store gives the same output"""
+        self.cmd_ok('taxtable %(taxdb)s -o %(outfile)s -t 180164,166486')
+        with open(self.outfile) as fp:
+            expected = fp.read()
+        self.store = path.join(self.mkoutdir(), 'lineages.db')
+        for i in range(2):
+            self.cmd_ok('taxtable %(taxdb)s -o %(outfile)s -t 180164,166486 '
+                        '--lineage-store %(store)s')
+            with open(self.outfile) as fp:
+                self.assertEqual(fp.read(), expected)
+
 
 class LonelyNodesTestCase(TestScriptBase):
 
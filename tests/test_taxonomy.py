@@ -4,14 +4,19 @@ import os
 from os import path
 import logging
 import shutil
+import threading
+from StringIO import StringIO
 
+import sqlalchemy
 from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 import config
 from config import TestBase
 
 import taxtastic
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import (Taxonomy, InMemoryTaxonomy, LineageCache,
+                                LCAIndex, StripedCache)
 import taxtastic.ncbi
 import taxtastic.utils
 
@@ -23,6 +28,10 @@ echo = False
 
 dbname = config.ncbi_master_db
 
+# Taxonomy adds ranks to the list it is given, so take a copy before
+# any tests modify it
+RANKS = list(taxtastic.ncbi.RANKS)
+
 
 class TestTaxonomyBase(TestBase):
 
@@ -107,6 +116,1111 @@ class TestAddNode(TestTaxonomyBase):
             lineage = self.tax.lineage(taxid)
             self.assertTrue(lineage['parent_id'] == new_taxid)
 
+    def test04(self):
+        """
+        add_nodes gives the same taxonomy as add_node
+        """
+
+        rows = list(taxtastic.utils.get_new_nodes(
+            os.path.join(datadir, 'new_taxa.csv')))
+        for d in rows:
+            d['source_id'] = 2
+        added = self.tax.add_nodes(reversed(rows), lineages=True)
+        self.assertEqual(sorted(added), sorted(d['tax_id'] for d in rows))
+
+        expected_db = path.join(path.dirname(self.dbname), 'expected.db')
+        shutil.copyfile(dbname, expected_db)
+        engine = create_engine('sqlite:///%s' % expected_db)
+        expected = Taxonomy(engine, taxtastic.ncbi.RANKS)
+        for d in rows:
+            expected.add_node(**d)
+        for tax_id in added.keys() + ['47770', '1587']:
+            self.assertEqual(self.tax.lineage(tax_id),
+                             expected.lineage(tax_id))
+        engine.dispose()
+
+    def test05(self):
+        """
+        add_nodes adds parents before their children
+        """
+
+        rows = [dict(tax_id='1578_2', parent_id='1578_1',
+                     rank='species_subgroup', tax_name='subgroup',
+                     children=['47770'], source_name='test'),
+                dict(tax_id='1578_1', parent_id='1578',
+                     rank='species_group', tax_name='group',
+                     children=['47770', '1587'], source_name='test')]
+        self.assertEqual(self.tax.add_nodes(rows), ['1578_1', '1578_2'])
+        self.assertEqual(self.tax.lineage('47770')['parent_id'], '1578_2')
+        self.assertEqual(self.tax.lineage('1578_2')['parent_id'], '1578_1')
+        self.assertEqual(self.tax.lineage('1587')['parent_id'], '1578_1')
+
+    def test06(self):
+        """
+        add_nodes validates all rows before adding any
+        """
+
+        row = dict(tax_id='1578_1', parent_id='1578', rank='species_group',
+                   tax_name='group', source_id=2)
+        missing = dict(row, tax_id='1578_2', parent_id='foo')
+        cycle = [dict(row, parent_id='1578_2'),
+                 dict(row, tax_id='1578_2', parent_id='1578_1')]
+        for rows in [[row, missing], [row, row], cycle,
+                     [dict(row, tax_id='1578')], [dict(row, source_id=None)]]:
+            self.assertRaises(ValueError, self.tax.add_nodes, rows)
+        self.assertRaises(ValueError, self.tax.lineage, '1578_1')
+
+        rows = [dict(row, tax_id='1578'), row]
+        self.assertEqual(self.tax.add_nodes(rows, skip_existing=True),
+                         ['1578_1'])
+        self.assertEqual(self.tax.add_nodes(rows, skip_existing=True), [])
+
+
+class TestCompactSchema(TestTaxonomyBase):
+    """
+    a database using the compact schema behaves like one using the
+    default schema
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        engine = taxtastic.ncbi.db_connect(self.dbname, compact=True)
+        conn = engine.connect()
+        conn.execute('ATTACH ? AS small', [dbname])
+        with conn.begin():
+            conn.execute("""INSERT INTO nodes
+                (tax_id, parent_id, rank, embl_code, division_id, source_id)
+                SELECT tax_id, parent_id, rank, embl_code, division_id,
+                       source_id
+                FROM small.nodes""")
+            conn.execute("""INSERT INTO names
+                (tax_id, tax_name, unique_name, name_class, is_primary)
+                SELECT tax_id, tax_name, unique_name, name_class, is_primary
+                FROM small.names""")
+            conn.execute('INSERT INTO merged SELECT * FROM small.merged')
+            conn.execute('INSERT INTO source SELECT * FROM small.source')
+        conn.close()
+        engine.dispose()
+
+        super(TestCompactSchema, self).setUp()
+        self.expected_engine = create_engine('sqlite:///%s' % dbname)
+        self.expected = Taxonomy(self.expected_engine, taxtastic.ncbi.RANKS)
+
+    def tearDown(self):
+        super(TestCompactSchema, self).tearDown()
+        self.expected_engine.dispose()
+
+    def test01(self):
+        tax_ids = self.tax.tax_ids()
+        self.assertEqual(sorted(tax_ids), sorted(self.expected.tax_ids()))
+        for tax_id in tax_ids:
+            self.assertTrue(isinstance(tax_id, basestring))
+            self.assertEqual(self.tax.lineage(tax_id),
+                             self.expected.lineage(tax_id))
+
+    def test02(self):
+        outdir = self.mkoutdir()
+        for name, tax in [('compact.csv', self.tax),
+                          ('expected.csv', self.expected)]:
+            with open(path.join(outdir, name), 'w') as fout:
+                tax.write_table(csvfile=fout, full=True)
+        with open(path.join(outdir, 'compact.csv')) as compact, \
+                open(path.join(outdir, 'expected.csv')) as expected:
+            self.assertEqual(compact.read(), expected.read())
+
+    def test03(self):
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='species_group',
+                          tax_name='Lactobacillus helveticis/crispatus',
+                          children=['47770', '1587'], source_id=2)
+        lineage = self.tax.lineage('1578_1')
+        self.assertEqual(lineage['tax_id'], '1578_1')
+        self.assertEqual(lineage['parent_id'], '1578')
+        self.assertEqual(self.tax.lineage('47770')['parent_id'], '1578_1')
+
+    def test04(self):
+        taxtastic.ncbi.build_lineages(self.engine, RANKS)
+        tax = Taxonomy(self.engine, list(RANKS))
+        expected = Taxonomy(self.expected_engine, list(RANKS))
+        outputs = []
+        for write, taxa in [(tax.write_lineage_table, None),
+                            (expected.write_table, expected.tax_ids())]:
+            output = StringIO()
+            write(taxa, csvfile=output, full=True)
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test05(self):
+        tax_ids = self.expected.tax_ids() + ['1761', 'foo']
+        self.assertEqual(self.tax.resolve_tax_ids(tax_ids),
+                         self.expected.resolve_tax_ids(tax_ids))
+        names = ['Staphylococcus aureus', 'Micrococcus aureus',
+                 'gamma-3 proteobacteria', 'foo']
+        self.assertEqual(self.tax.primary_from_names(names),
+                         self.expected.primary_from_names(names))
+
+
+class TestAncestors(TestTaxonomyBase):
+    """
+    Taxonomy gives the same results using table "ancestors"
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestAncestors, self).setUp()
+        taxtastic.ncbi.build_ancestors(self.engine)
+        self.tax = Taxonomy(self.engine, list(taxtastic.ncbi.RANKS))
+        self.expected_engine = create_engine('sqlite:///%s' % dbname)
+        self.expected = Taxonomy(self.expected_engine,
+                                 list(taxtastic.ncbi.RANKS))
+
+    def tearDown(self):
+        super(TestAncestors, self).tearDown()
+        self.expected_engine.dispose()
+
+    def ancestors(self):
+        with self.engine.begin() as conn:
+            return sorted(tuple(row) for row in conn.execute(
+                'select * from ancestors'))
+
+    def test01(self):
+        self.assertTrue(self.tax.ancestors is not None)
+        self.assertTrue(self.expected.ancestors is None)
+        tax_ids = self.expected.tax_ids()
+        for tax_id in tax_ids:
+            self.assertEqual(self.tax.lineage(tax_id),
+                             self.expected.lineage(tax_id))
+        self.assertEqual(self.tax.cached, self.expected.cached)
+        self.assertEqual(self.tax.ranks, self.expected.ranks)
+
+        for tax_id in tax_ids:
+            for rank, ancestor in self.tax.cached[tax_id][:-1]:
+                self.assertTrue(self.tax.is_ancestor_of(tax_id, ancestor))
+                self.assertEqual(self.tax.parent_id(tax_id, rank),
+                                 self.expected.parent_id(tax_id, rank))
+        self.assertFalse(self.tax.is_ancestor_of('1239', '1280'))
+        for tax in [self.tax, self.expected]:
+            self.assertRaises(ValueError, tax.is_ancestor_of, 'foo', '1239')
+            self.assertFalse(tax.is_ancestor_of('1280', 'foo'))
+
+    def test02(self):
+        species = self.tax.species_below('1239')
+        self.assertEqual(self.tax.rank(species), 'species')
+        self.assertTrue(self.expected.is_ancestor_of(species, '1239'))
+        self.assertEqual(self.tax.species_below('1280'), '1280')
+        tax_ids = self.tax.tax_ids()
+        species = self.tax.species_below_many(tax_ids)
+        in_memory = InMemoryTaxonomy(self.engine, list(taxtastic.ncbi.RANKS))
+        for tax_id in tax_ids:
+            self.assertEqual(species[tax_id], self.tax.species_below(tax_id))
+            self.assertEqual(species[tax_id],
+                             self.expected.species_below(tax_id))
+            self.assertEqual(species[tax_id], in_memory.species_below(tax_id))
+        # children are ordered by tax_id, compared numerically
+        self.assertEqual(self.tax.children_of('1239', 2), ['91061', '186801'])
+        self.assertEqual(in_memory.children_of('1239', 2),
+                         ['91061', '186801'])
+
+    def test03(self):
+        """
+        table ancestors is updated when nodes are added
+        """
+
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='species_group',
+                          tax_name='Lactobacillus helveticis/crispatus',
+                          children=['47770', '1587'], source_id=2)
+        self.tax.add_node(tax_id='1578_2', parent_id='1578_1',
+                          rank='species_subgroup', tax_name='subgroup',
+                          children=['47770'], source_id=2)
+        ancestors = self.ancestors()
+        taxtastic.ncbi.build_ancestors(self.engine)
+        self.assertEqual(ancestors, self.ancestors())
+        self.assertTrue(self.tax.is_ancestor_of('47770', '1578_1'))
+
+    def test04(self):
+        """
+        table ancestors is updated when nodes are added in bulk
+        """
+
+        self.tax.add_nodes([
+            dict(tax_id='1578_2', parent_id='1578_1',
+                 rank='species_subgroup', tax_name='subgroup',
+                 children=['47770'], source_id=2),
+            dict(tax_id='1578_1', parent_id='1578', rank='species_group',
+                 tax_name='Lactobacillus helveticis/crispatus',
+                 children=['47770', '1587'], source_id=2)])
+        ancestors = self.ancestors()
+        taxtastic.ncbi.build_ancestors(self.engine)
+        self.assertEqual(ancestors, self.ancestors())
+        self.assertTrue(self.tax.is_ancestor_of('47770', '1578_2'))
+
+
+class TestLineages(TestTaxonomyBase):
+    """
+    Taxonomy.write_lineage_table gives the output of write_table using
+    table "lineages"
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestLineages, self).setUp()
+        taxtastic.ncbi.build_lineages(self.engine, RANKS)
+        self.tax = Taxonomy(self.engine, list(RANKS))
+
+    def expected(self, tax_ids=None, full=False):
+        tax = Taxonomy(self.engine, list(RANKS))
+        taxa = set()
+        for tax_id in tax_ids or tax.tax_ids():
+            taxa.update(t for r, t in tax._get_lineage(tax_id))
+        output = StringIO()
+        tax.write_table(taxa, csvfile=output, full=full)
+        return output.getvalue()
+
+    def lineages(self):
+        with self.engine.begin() as conn:
+            ranks = [rank for rank, in conn.execute(
+                'select rank from lineage_ranks order by position')]
+            rows = sorted(
+                sorted((k, v) for k, v in row.items() if v is not None)
+                for row in conn.execute('select * from lineages'))
+        return ranks, rows
+
+    def test01(self):
+        self.assertTrue(self.tax.lineage_table is not None)
+        for tax_ids in [None, ['180164', '1280']]:
+            for full in [False, True]:
+                output = StringIO()
+                self.tax.write_lineage_table(tax_ids, csvfile=output,
+                                             full=full)
+                self.assertEqual(output.getvalue(),
+                                 self.expected(tax_ids, full))
+
+    def test02(self):
+        """
+        table lineages is updated when nodes are added
+        """
+
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='no_rank', tax_name='unranked',
+                          children=['47770', '1587'], source_id=2)
+        self.tax.add_node(tax_id='1578_2', parent_id='1578_1',
+                          rank='no_rank', tax_name='unranked 2',
+                          children=['47770'], source_id=2)
+        lineages = self.lineages()
+        self.assertIn('below_below_genus', lineages[0])
+        taxtastic.ncbi.build_lineages(self.engine, RANKS)
+        self.assertEqual(lineages, self.lineages())
+
+        output = StringIO()
+        self.tax.write_lineage_table(['47770'], csvfile=output)
+        self.assertEqual(output.getvalue(), self.expected(['47770']))
+
+    def test03(self):
+        """
+        table lineages is updated when nodes are added in bulk
+        """
+
+        self.tax.add_nodes([
+            dict(tax_id='1578_2', parent_id='1578_1',
+                 rank='no_rank', tax_name='unranked 2',
+                 children=['47770'], source_id=2),
+            dict(tax_id='1578_1', parent_id='1578',
+                 rank='no_rank', tax_name='unranked',
+                 children=['47770', '1587'], source_id=2)])
+        lineages = self.lineages()
+        self.assertIn('below_below_genus', lineages[0])
+        taxtastic.ncbi.build_lineages(self.engine, RANKS)
+        self.assertEqual(lineages, self.lineages())
+
+    def test04(self):
+        """
+        lineages with more than one node of the same rank
+        """
+
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='species_group', tax_name='group',
+                          children=['47770', '1587'], source_id=2)
+        self.tax.add_node(tax_id='1578_2', parent_id='1578_1',
+                          rank='species_group', tax_name='group 2',
+                          children=['47770'], source_id=2)
+        output = StringIO()
+        self.tax.write_lineage_table(['47770'], csvfile=output)
+        self.assertIn('"1578_1"', output.getvalue())
+        self.assertEqual(output.getvalue(), self.expected(['47770']))
+
+
+class TestBatchLineages(TestTaxonomyBase):
+    """
+    Taxonomy.lineages returns the same lineages as _get_lineage
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestBatchLineages, self).setUp()
+        self.tax = Taxonomy(self.engine, list(RANKS))
+        self.expected = Taxonomy(self.engine, list(RANKS))
+
+    def test01(self):
+        tax_ids = self.tax.tax_ids() + ['1761']  # merged into 85007
+        lineages = self.tax.lineages(tax_ids)
+        for tax_id in tax_ids:
+            self.assertEqual(lineages[tax_id],
+                             self.expected._get_lineage(tax_id))
+        self.assertEqual(self.tax.cached, self.expected.cached)
+        self.assertEqual(self.tax.ranks, self.expected.ranks)
+
+    def test02(self):
+        """
+        lineages overlapping with cached lineages
+        """
+
+        self.tax._get_lineage('1280')
+        lineages = self.tax.lineages(['1280', '1279', '180164'])
+        for tax_id in ['1280', '1279', '180164']:
+            self.assertEqual(lineages[tax_id],
+                             self.expected._get_lineage(tax_id))
+
+    def test03(self):
+        self.assertRaises(ValueError, self.tax.lineages, ['1280', 'foo'])
+        lineages = self.tax.lineages(['1280', 'foo'], ignore_missing=True)
+        self.assertEqual(lineages.keys(), ['1280'])
+
+    def test04(self):
+        resolved = self.tax.resolve_tax_ids(['1280', '1761', 'foo'])
+        self.assertEqual(resolved,
+                         {'1280': '1280', '1761': '85007', 'foo': None})
+        self.assertEqual(self.tax.resolve_tax_ids([]), {})
+
+    def test05(self):
+        names = ['Staphylococcus aureus', 'Micrococcus aureus',
+                 'gamma-3 proteobacteria', 'foo', 'foo']
+        found, missing, ambiguous = self.tax.primary_from_names(names)
+        for name in names[:2]:
+            self.assertEqual(found[name],
+                             self.expected.primary_from_name(name))
+        self.assertEqual(found['gamma-3 proteobacteria'][0], '543')
+        self.assertEqual(missing, ['foo'])
+        self.assertEqual(ambiguous, {'gamma-3 proteobacteria': ['543', '91347']})
+        self.assertEqual(self.tax.primary_from_names([]), ({}, [], {}))
+
+    def test06(self):
+        """
+        batch versions of children_of, species_below and nary_subtree
+        """
+
+        tax = Taxonomy(self.engine, list(RANKS), debug=True)
+        tax_ids = self.tax.tax_ids()
+        children = tax.children_of_many(tax_ids, 2)
+        species = tax.species_below_many(tax_ids + [None, 'foo'])
+        subtrees = tax.nary_subtree_many(tax_ids)
+        for tax_id in tax_ids:
+            self.assertEqual(children[tax_id],
+                             self.expected.children_of(tax_id, 2))
+            self.assertEqual(species[tax_id],
+                             self.expected.species_below(tax_id))
+            self.assertEqual(subtrees[tax_id],
+                             self.expected.nary_subtree(tax_id))
+        self.assertEqual(species['foo'], None)
+        self.assertEqual(species['1239'], '1280')
+        self.assertEqual(species['171551'], None)
+        self.assertEqual(children['1'], [])
+        self.assertEqual(tax.nary_subtree('1239', 1), ['1280'])
+        self.assertRaises(ValueError, tax.children_of_many, ['1280', 'foo'])
+        self.assertRaises(ValueError, tax.nary_subtree_many, ['foo'])
+
+    def test07(self):
+        """
+        names of more than one node are resolved in the same way by
+        primary_from_name and primary_from_names
+        """
+
+        dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(self.dbname, dbname)
+        engine = create_engine('sqlite:///%s' % dbname)
+        # '1239' precedes '976' as a string but not as a number
+        engine.execute(
+            "INSERT INTO names (tax_id, tax_name, is_primary) VALUES "
+            "('1239', 'foo', 0), ('976', 'foo', 0), "
+            "('1239', 'Bacteroidetes', 0), ('1239', 'bar', 0)")
+        names = ['foo', 'Bacteroidetes', 'bar']
+        expected = {'foo': ('976', 'Bacteroidetes', False),
+                    'Bacteroidetes': ('976', 'Bacteroidetes', True),
+                    'bar': ('1239', 'Firmicutes', False)}
+        for tax in [Taxonomy(engine, list(RANKS)),
+                    InMemoryTaxonomy(engine, list(RANKS))]:
+            found, missing, ambiguous = tax.primary_from_names(names)
+            self.assertEqual(found, expected)
+            self.assertEqual(ambiguous, {'foo': ['1239', '976'],
+                                         'Bacteroidetes': ['1239', '976']})
+            for name in names:
+                self.assertEqual(tax.primary_from_name(name), expected[name])
+        engine.dispose()
+
+    def test08(self):
+        tax_ids = self.tax.tax_ids()
+        expected = dict((tax_id, self.expected.primary_from_id(tax_id))
+                        for tax_id in tax_ids)
+        for tax in [self.tax, InMemoryTaxonomy(self.engine, list(RANKS))]:
+            self.assertEqual(tax.primary_from_ids(tax_ids), expected)
+            self.assertRaises(ValueError, tax.primary_from_ids, ['foo'])
+
+
+class TestWriteTable(TestTaxonomyBase):
+    """
+    write_table gives the same output when rows are merged from
+    batches saved to temporary files
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestWriteTable, self).setUp()
+
+    def write(self, taxa, full, **kwargs):
+        output = StringIO()
+        tax = Taxonomy(self.engine, list(RANKS))
+        tax.write_table(taxa, csvfile=output, full=full, **kwargs)
+        return output.getvalue()
+
+    def test01(self):
+        taxa = self.tax.tax_ids()
+        for full in [False, True]:
+            self.assertEqual(self.write(taxa, full, buffer_size=7),
+                             self.write(taxa, full))
+
+    def test02(self):
+        """
+        rows are ordered by rank and then by name
+        """
+
+        rows = self.write(['1280', '1279', '1239', '91061'], False)
+        self.assertEqual([row.split(',')[0] for row in rows.splitlines()],
+                         ['"tax_id"', '"1239"', '"91061"', '"1279"', '"1280"'])
+        self.assertRaises(ValueError, self.write, ['1761'], False)
+
+    def test03(self):
+        """
+        lineages and names looked up while writing are not kept
+        """
+
+        taxa = self.tax.tax_ids()
+        for thread_safe in [False, True]:
+            tax = Taxonomy(self.engine, list(RANKS), thread_safe=thread_safe)
+            tax.lineages(['1280'])
+            cached, seen = dict(tax.cached.items()), set(tax.seen)
+            output = StringIO()
+            tax.write_table(taxa, csvfile=output, buffer_size=7)
+            self.assertEqual(output.getvalue(), self.write(taxa, False))
+            self.assertEqual(dict(tax.cached.items()), cached)
+            self.assertEqual(tax.seen, seen)
+            self.assertEqual(len(tax.name_cache), 0)
+
+
+class TestDescendants(TestTaxonomyBase):
+    """
+    Taxonomy.descendants lists the nodes having a tax_id in their
+    lineage
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestDescendants, self).setUp()
+        # mark the subtree of genus Staphylococcus as invalid
+        self.invalid = set(['1279', '1280'])
+        with self.engine.begin() as conn:
+            conn.execute('alter table nodes add column is_valid boolean '
+                         'not null default 1')
+            conn.execute('update nodes set is_valid = 0 where tax_id in '
+                         '(?, ?)', list(self.invalid))
+        self.tax = Taxonomy(self.engine, list(RANKS))
+        self.lineages = self.tax.lineages(self.tax.tax_ids())
+
+    def expected(self, tax_id, rank=None, valid_only=False):
+        tax_ids = []
+        for t, lineage in self.lineages.items():
+            if t == tax_id or tax_id not in [a for _, a in lineage]:
+                continue
+            if rank is not None and lineage[-1][0] != rank:
+                continue
+            if not (valid_only and t in self.invalid):
+                tax_ids.append(t)
+        return sorted(tax_ids)
+
+    def check(self, tax):
+        for tax_id in ['1', '1239', '1279', '1280']:
+            self.assertEqual(sorted(tax.descendants(tax_id)),
+                             self.expected(tax_id))
+            self.assertEqual(
+                sorted(tax.descendants(tax_id, rank='species')),
+                self.expected(tax_id, rank='species'))
+            self.assertEqual(
+                sorted(tax.descendants(tax_id, valid_only=True)),
+                self.expected(tax_id, valid_only=True))
+        self.assertEqual(list(tax.descendants('1239', rank='foo')), [])
+        self.assertRaises(ValueError, tax.descendants, 'foo')
+
+    def test01(self):
+        self.check(self.tax)
+
+    def test02(self):
+        taxtastic.ncbi.build_ancestors(self.engine)
+        tax = Taxonomy(self.engine, list(RANKS))
+        self.assertTrue(tax.ancestors is not None)
+        self.check(tax)
+        # closest nodes first
+        depths = [len(self.lineages[t]) for t in tax.descendants('1239')]
+        self.assertEqual(depths, sorted(depths))
+
+    def test03(self):
+        self.check(InMemoryTaxonomy(self.engine, list(RANKS)))
+
+
+class TestLCA(TestTaxonomyBase):
+    """
+    Lowest common ancestors are the last node shared by lineages
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestLCA, self).setUp()
+        self.tax = Taxonomy(self.engine, list(RANKS))
+        self.expected = Taxonomy(self.engine, list(RANKS))
+        self.tax_ids = self.expected.tax_ids()
+        # pairs of nodes, and sets including a node and its ancestor
+        self.sets = [self.tax_ids[i::50] for i in range(50)]
+        self.sets += [['1280', '1279'], ['1280'], ['1761', '1280']]
+
+    def lca(self, tax_ids):
+        lineages = [self.expected._get_lineage(t) for t in tax_ids]
+        common = None
+        for nodes in zip(*lineages):
+            if nodes.count(nodes[0]) < len(nodes):
+                break
+            common = nodes[0]
+        return common
+
+    def test01(self):
+        expected = [self.lca(tax_ids) for tax_ids in self.sets]
+        self.assertEqual(self.tax.lca_many(self.sets), expected)
+        # undefined ranks are added in the order used by lineages
+        ranks = [r for r in self.expected.ranks if r in self.tax.rankset]
+        self.assertEqual(self.tax.ranks, ranks)
+        self.assertTrue(all(rank in ranks for rank, _ in expected))
+        self.assertEqual(self.tax.lca(['1280', '1279']),
+                         ('genus', '1279'))
+        self.assertRaises(ValueError, self.tax.lca, ['1280', 'foo'])
+        self.assertRaises(ValueError, self.tax.lca, [])
+
+    def test02(self):
+        rows = [(t, ) + self.tax._node(t) for t in self.tax_ids]
+        rows.append(('foo', 'foo', 'root'))
+        for block_size in [1, 3, 64]:
+            index = LCAIndex.from_nodes(rows, block_size=block_size)
+            for tax_ids in self.sets[:-1]:
+                self.assertEqual(index.lca(tax_ids), self.lca(tax_ids))
+            # nodes of different trees
+            self.assertEqual(index.lca(['1280', 'foo']), None)
+
+    def test03(self):
+        """
+        the index is saved and rebuilt when the taxonomy changes
+        """
+
+        filename = path.join(path.dirname(self.dbname), 'lca.bin')
+        index = self.tax.lca_index(filename)
+        self.assertTrue(path.exists(filename))
+        saved = Taxonomy(self.engine, list(RANKS)).lca_index(filename)
+        self.assertEqual(saved.tour, index.tour)
+        self.assertEqual(saved.tax_ids, index.tax_ids)
+
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='species_group', tax_name='group',
+                          children=['47770', '1587'], source_id=2)
+        self.assertEqual(self.tax.lca(['47770', '1587']),
+                         ('species_group', '1578_1'))
+        index = Taxonomy(self.engine, list(RANKS)).lca_index(filename)
+        self.assertEqual(index.lca(['47770', '1587']),
+                         ('species_group', '1578_1'))
+
+
+class TestCache(TestTaxonomyBase):
+    """
+    lookups using bounded caches
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestCache, self).setUp()
+        self.tax = Taxonomy(self.engine, list(RANKS), cache_size=5)
+        self.expected = Taxonomy(self.engine, list(RANKS))
+
+    def test01(self):
+        tax_ids = self.expected.tax_ids()
+        for tax_id in tax_ids:
+            self.assertEqual(self.tax.lineage(tax_id),
+                             self.expected.lineage(tax_id))
+        self.assertEqual(self.tax.lineages(tax_ids),
+                         self.expected.lineages(tax_ids))
+
+        stats = self.tax.cache_stats()
+        for name in ['lineage', 'node', 'name']:
+            self.assertEqual(stats[name]['size'], 5)
+            self.assertTrue(stats[name]['evictions'] > 0)
+        self.assertTrue(stats['lineage']['hits'] > 0)
+
+    def test02(self):
+        """
+        write_table includes lineages that have been evicted
+        """
+
+        for tax_id in ['1280', '180164', '1279']:
+            self.tax._get_lineage(tax_id)
+            self.expected._get_lineage(tax_id)
+        self.assertEqual(self.tax.seen, set(self.expected.cached))
+        outputs = []
+        for tax in [self.tax, self.expected]:
+            output = StringIO()
+            tax.write_table(csvfile=output)
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test03(self):
+        """
+        lineages share the storage of the lineage of their parent
+        """
+
+        cache = LineageCache(maxsize=2)
+        parent = [('root', '1'), ('genus', '2')]
+        cache['2'] = parent
+        cache['3'] = parent + [('species', '3')]
+        self.assertTrue(cache._data['3'][2] is cache._data['2'])
+        self.assertEqual(cache['3'], parent + [('species', '3')])
+        cache['4'] = parent + [('species', '4')]
+        self.assertEqual(cache.evictions, 1)
+        self.assertFalse('2' in cache)
+        self.assertEqual(cache['4'], parent + [('species', '4')])
+        self.assertRaises(KeyError, cache.__getitem__, '2')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+class TestThreadSafe(TestTaxonomyBase):
+    """
+    a Taxonomy created with thread_safe=True shared by threads
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestThreadSafe, self).setUp()
+        self.expected = Taxonomy(self.engine, list(RANKS))
+        self.tax_ids = self.expected.tax_ids()
+        self.lineages = self.expected.lineages(self.tax_ids)
+
+    def test01(self):
+        for cls in [Taxonomy, InMemoryTaxonomy]:
+            tax = cls(self.engine, list(RANKS), thread_safe=True)
+            lineages = tax.map_lineages(self.tax_ids + ['1761'],
+                                        workers=4, chunk_size=20)
+            self.assertEqual(lineages['1761'], self.lineages['85007'])
+            del lineages['1761']
+            self.assertEqual(lineages, self.lineages)
+            self.assertEqual(tax.ranks, self.expected.ranks)
+        self.assertRaises(ValueError, self.tax.map_lineages, self.tax_ids)
+        self.assertEqual(self.tax.map_lineages(self.tax_ids, workers=1),
+                         self.lineages)
+
+    def test02(self):
+        """
+        lookups of the same tax_ids by several threads, evicting
+        entries from small caches
+        """
+
+        store = path.join(path.dirname(self.dbname), 'lineages.db')
+        tax = Taxonomy(self.engine, list(RANKS), cache_size=20,
+                       lineage_store=store, thread_safe=True)
+        errors = []
+
+        def lookup(offset):
+            try:
+                for tax_id in self.tax_ids[offset:] + self.tax_ids[:offset]:
+                    self.assertEqual(tax._get_lineage(tax_id),
+                                     self.lineages[tax_id])
+                    self.assertEqual(tax.primary_from_id(tax_id),
+                                     self.expected.primary_from_id(tax_id))
+                tax.save_lineages()
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=lookup, args=(i * 10,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(tax.ranks, self.expected.ranks)
+
+        stats = tax.cache_stats()
+        for name in ['lineage', 'node', 'name']:
+            self.assertTrue(stats[name]['size'] <= 20)
+            self.assertTrue(stats[name]['evictions'] > 0)
+
+    def test03(self):
+        cache = StripedCache(LineageCache, maxsize=8, stripes=4)
+        lineage = [('root', '1'), ('genus', '2')]
+        for i in range(20):
+            cache[str(i)] = lineage
+        self.assertEqual(len(cache), 8)
+        self.assertEqual(cache.stats()['evictions'], 12)
+        self.assertEqual(cache.get('19'), lineage)
+        self.assertEqual(cache.pop('19'), lineage)
+        self.assertEqual(cache.pop('19', None), None)
+        self.assertFalse('19' in cache)
+        cache.clear()
+        self.assertEqual(list(cache), [])
+
+        # lineages share the storage of their parents in other stripes
+        cache = StripedCache(LineageCache, stripes=4)
+        parent = [('root', '1'), ('genus', '2')]
+        for i in range(3, 8):
+            cache['2'] = parent
+            cache[str(i)] = parent + [('species', str(i))]
+            self.assertTrue(cache._cell(str(i))[2] is cache._cell('2'))
+            self.assertEqual(cache[str(i)], parent + [('species', str(i))])
+
+    def test04(self):
+        """
+        a sqlite database is read through a bounded pool of read-only
+        connections
+        """
+
+        engine = create_engine('sqlite:///%s' % self.dbname,
+                               execution_options={'foo': 'bar'})
+        tax = Taxonomy(engine, list(RANKS), thread_safe=True, pool_size=2)
+        self.assertEqual(tax.engine.get_execution_options(), {'foo': 'bar'})
+
+        lock = threading.Lock()
+        connections = {'open': 0, 'most': 0}
+
+        def checkout(*args):
+            with lock:
+                connections['open'] += 1
+                connections['most'] = max(connections['most'],
+                                          connections['open'])
+
+        def checkin(*args):
+            with lock:
+                connections['open'] -= 1
+
+        sqlalchemy.event.listen(tax.engine, 'checkout', checkout)
+        sqlalchemy.event.listen(tax.engine, 'checkin', checkin)
+        self.assertEqual(tax.map_lineages(self.tax_ids, workers=8,
+                                          chunk_size=5), self.lineages)
+        self.assertEqual(connections['most'], 2)
+
+        self.assertRaises(OperationalError, tax.add_node, tax_id='foo',
+                          parent_id='1280', rank='no_rank', tax_name='foo',
+                          source_id=2)
+        self.assertRaises(ValueError, self.expected.primary_from_name, 'foo')
+        self.assertRaises(ValueError, Taxonomy, create_engine('sqlite://'),
+                          list(RANKS), thread_safe=True)
+        engine.dispose()
+
+
+class TestLineageStore(TestTaxonomyBase):
+    """
+    lineages saved by one Taxonomy are used by the next
+    """
+
+    def setUp(self):
+        outdir = self.mkoutdir()
+        self.dbname = path.join(outdir, 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        self.store = path.join(outdir, 'lineages.db')
+        super(TestLineageStore, self).setUp()
+        self.tax = Taxonomy(self.engine, list(RANKS),
+                            lineage_store=self.store)
+        self.tax_ids = self.tax.tax_ids()
+        self.lineages = self.tax.lineages(self.tax_ids)
+        self.tax.save_lineages()
+
+    def stored(self):
+        return Taxonomy(self.engine, list(RANKS), lineage_store=self.store)
+
+    def test01(self):
+        tax = self.stored()
+        self.assertEqual(tax.ranks, self.tax.ranks)
+        self.assertEqual(tax.lineages(self.tax_ids), self.lineages)
+        self.assertEqual(tax.lineage_store.hits, len(self.tax_ids))
+
+        tax = self.stored()
+        self.assertEqual(tax._get_lineage('1280'), self.lineages['1280'])
+        self.assertEqual(tax.node_cache.misses, 0)
+
+    def test02(self):
+        """
+        lineages are kept if only the modification time changes
+        """
+
+        mtime = os.stat(self.dbname).st_mtime
+        os.utime(self.dbname, (mtime + 10, mtime + 10))
+        tax = self.stored()
+        self.assertEqual(tax.lineages(self.tax_ids), self.lineages)
+        self.assertEqual(tax.lineage_store.misses, 0)
+
+    def test03(self):
+        """
+        lineages are discarded when the taxonomy changes
+        """
+
+        Taxonomy(self.engine, list(RANKS)).add_node(
+            tax_id='1578_1', parent_id='1578', rank='species_group',
+            tax_name='Lactobacillus helveticis/crispatus',
+            children=['47770', '1587'], source_id=2)
+        tax = self.stored()
+        lineage = tax._get_lineage('47770')
+        self.assertEqual(lineage[-2], ('species_group', '1578_1'))
+        self.assertEqual(tax.lineage_store.hits, 0)
+
+
+class TestNormalizedNames(TestTaxonomyBase):
+    """
+    lookups of names differing in case, whitespace or punctuation
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestNormalizedNames, self).setUp()
+        self.scan = Taxonomy(self.engine, list(RANKS))
+        taxtastic.ncbi.build_name_index(self.engine)
+        self.tax = Taxonomy(self.engine, list(RANKS))
+
+    def test01(self):
+        names = ['staphylococcus_aureus', 'Micrococcus  AUREUS.',
+                 'Staphylococcus aureus', 'foo']
+        matches = self.tax.match_names(names)
+        self.assertEqual(matches, {
+            'staphylococcus_aureus': ['Staphylococcus aureus'],
+            'Micrococcus  AUREUS.': ['Micrococcus aureus'],
+            'Staphylococcus aureus': ['Staphylococcus aureus'],
+            'foo': []})
+        self.assertIsNone(self.scan.name_index)
+        self.assertEqual(self.scan.match_names(names), matches)
+
+    def test02(self):
+        self.assertRaises(ValueError, self.tax.primary_from_name,
+                          'staphylococcus_aureus')
+        self.assertEqual(
+            self.tax.primary_from_name('staphylococcus_aureus',
+                                       normalize=True),
+            ('1280', 'Staphylococcus aureus', True))
+        self.assertEqual(
+            self.tax.primary_from_name('Micrococcus  AUREUS.',
+                                       normalize=True),
+            ('1280', 'Staphylococcus aureus', False))
+        self.assertRaises(ValueError, self.tax.primary_from_name, 'foo',
+                          normalize=True)
+        self.assertEqual(
+            self.tax.synonyms(tax_name='micrococcus aureus', normalize=True),
+            self.tax.synonyms(tax_name='Micrococcus aureus'))
+
+    def test03(self):
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='species_group',
+                          tax_name='Lactobacillus helveticis/crispatus',
+                          source_id=2)
+        self.assertEqual(
+            self.tax.match_names(['lactobacillus helveticis crispatus']),
+            {'lactobacillus helveticis crispatus':
+             ['Lactobacillus helveticis/crispatus']})
+
+    def test04(self):
+        tax = InMemoryTaxonomy(self.engine, list(RANKS))
+        names = ['staphylococcus_aureus', 'Micrococcus  AUREUS.',
+                 'gamma 3 proteobacteria', 'foo']
+        self.assertEqual(tax.match_names(names), self.tax.match_names(names))
+        self.assertEqual(tax.primary_from_names(names, normalize=True),
+                         self.tax.primary_from_names(names, normalize=True))
+
+
+class TestFuzzyNames(TestTaxonomyBase):
+    """
+    fuzzy_match_names finds the same names as comparing every name
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestFuzzyNames, self).setUp()
+        self.assertRaises(ValueError, self.tax.fuzzy_match_names, ['foo'])
+        taxtastic.ncbi.build_fuzzy_index(self.engine)
+        self.tax = Taxonomy(self.engine, list(RANKS))
+
+    def compare_all(self, tax_name, max_distance):
+        query = taxtastic.ncbi.normalize_name(tax_name)
+        matches = []
+        for name, in self.engine.execute(
+                'SELECT DISTINCT tax_name FROM names'):
+            distance = taxtastic.utils.edit_distance(
+                query, taxtastic.ncbi.normalize_name(name))
+            if distance <= max_distance:
+                matches.append((distance, name))
+        return [(name, d) for d, name in sorted(matches)]
+
+    def test01(self):
+        names = ['Staphylococus aureus', 'staphylococcus_aureu',
+                 'Escherichia colli', 'Enterococcus', 'E coli', 'xyz']
+        matches = self.tax.fuzzy_match_names(names, limit=100)
+        for name in names:
+            self.assertEqual(matches[name], self.compare_all(name, 2), name)
+
+    def test02(self):
+        matches = self.tax.fuzzy_match_names(['Staphylococus aureus'],
+                                             limit=2, max_distance=1)
+        self.assertEqual(matches['Staphylococus aureus'],
+                         [('Staphylococus aureus', 0),
+                          ('Staphylococcus aureus', 1)])
+
+    def test03(self):
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='species_group',
+                          tax_name='Lactobacillus helveticis/crispatus',
+                          source_id=2)
+        name = 'Lactobacillus helveticus/crispatus'
+        self.assertEqual(self.tax.fuzzy_match_names([name])[name],
+                         self.compare_all(name, 2))
+
+
+class TestInMemory(TestTaxonomyBase):
+    """
+    InMemoryTaxonomy gives the same results as Taxonomy
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        super(TestInMemory, self).setUp()
+        self.tax = InMemoryTaxonomy(self.engine, list(RANKS))
+        self.expected = Taxonomy(self.engine, list(RANKS))
+
+    def outcome(self, tax, method, *args):
+        try:
+            return getattr(tax, method)(*args)
+        except (AssertionError, ValueError) as err:
+            return type(err)
+
+    def test01(self):
+        tax_ids = self.expected.tax_ids()
+        self.assertEqual(sorted(self.tax.tax_ids()), sorted(tax_ids))
+        # the root is its own parent, but not its own child
+        self.assertEqual(self.tax.child_of('1'), None)
+        tax_ids.remove('1')
+        for tax_id in tax_ids + ['1761']:
+            for method in ['lineage', 'sibling_of', 'child_of',
+                           'species_below', 'primary_from_id']:
+                self.assertEqual(self.outcome(self.tax, method, tax_id),
+                                 self.outcome(self.expected, method, tax_id),
+                                 (method, tax_id))
+            self.assertEqual(self.outcome(self.tax, 'children_of', tax_id, 2),
+                             self.outcome(self.expected, 'children_of',
+                                          tax_id, 2))
+        for tax_id in tax_ids:
+            self.assertEqual(sorted(self.tax.synonyms(tax_id)),
+                             sorted(self.expected.synonyms(tax_id)))
+        self.assertEqual(self.tax.nary_subtree('1279'),
+                         self.expected.nary_subtree('1279'))
+        self.assertEqual(self.tax.ranks, self.expected.ranks)
+        tax_ids += ['1761', 'foo']
+        self.assertEqual(self.tax.resolve_tax_ids(tax_ids),
+                         self.expected.resolve_tax_ids(tax_ids))
+
+    def test02(self):
+        for name in ['Staphylococcus aureus', 'Micrococcus aureus']:
+            self.assertEqual(self.tax.primary_from_name(name),
+                             self.expected.primary_from_name(name))
+            self.assertEqual(sorted(self.tax.synonyms(tax_name=name)),
+                             sorted(self.expected.synonyms(tax_name=name)))
+        self.assertRaises(ValueError, self.tax.primary_from_name, 'foo')
+        names = ['Staphylococcus aureus', 'Micrococcus aureus',
+                 'gamma-3 proteobacteria', 'foo']
+        self.assertEqual(self.tax.primary_from_names(names),
+                         self.expected.primary_from_names(names))
+        self.assertRaises(ValueError, self.tax.lineage, 'foo')
+
+    def test03(self):
+        self.tax.add_node(tax_id='1578_1', parent_id='1578',
+                          rank='species_group',
+                          tax_name='Lactobacillus helveticis/crispatus',
+                          children=['47770', '1587'], source_id=2)
+        expected = Taxonomy(self.engine, list(RANKS))
+        for tax_id in ['1578_1', '47770', '1587']:
+            self.assertEqual(self.tax.lineage(tax_id),
+                             expected.lineage(tax_id))
+        self.assertEqual(self.tax.children_of('1578_1', 5),
+                         expected.children_of('1578_1', 5))
+
+    def test04(self):
+        self.tax.add_nodes([
+            dict(tax_id='1578_2', parent_id='1578_1',
+                 rank='species_subgroup', tax_name='subgroup',
+                 children=['47770'], source_id=2),
+            dict(tax_id='1578_1', parent_id='1578', rank='species_group',
+                 tax_name='Lactobacillus helveticis/crispatus',
+                 children=['47770', '1587'], source_id=2)])
+        expected = Taxonomy(self.engine, list(RANKS))
+        for tax_id in ['1578_1', '1578_2', '47770', '1587']:
+            self.assertEqual(self.tax.lineage(tax_id),
+                             expected.lineage(tax_id))
+        self.assertEqual(self.tax.children_of('1578_1', 5),
+                         expected.children_of('1578_1', 5))
+        self.assertEqual(self.tax.primary_from_name('subgroup'),
+                         expected.primary_from_name('subgroup'))
+
+    def test05(self):
+        """
+        table ancestors is updated when nodes are added
+        """
+
+        taxtastic.ncbi.build_ancestors(self.engine)
+        tax = InMemoryTaxonomy(self.engine, list(RANKS))
+        tax.add_node(tax_id='foo1', parent_id='1280', rank='no_rank',
+                     tax_name='foo1', source_id=2)
+        tax.add_nodes([
+            dict(tax_id='1578_1', parent_id='1578', rank='species_group',
+                 tax_name='Lactobacillus helveticis/crispatus',
+                 children=['47770', '1587'], source_id=2)])
+        query = 'select * from ancestors'
+        ancestors = sorted(tuple(row) for row in self.engine.execute(query))
+        taxtastic.ncbi.build_ancestors(self.engine)
+        self.assertEqual(ancestors, sorted(
+            tuple(row) for row in self.engine.execute(query)))
+        expected = Taxonomy(self.engine, list(RANKS))
+        self.assertTrue(expected.ancestors is not None)
+        for tax_id in ['foo1', '1578_1', '47770']:
+            self.assertEqual(tax.lineage(tax_id), expected.lineage(tax_id))
+        self.assertTrue(expected.is_ancestor_of('foo1', '1280'))
+        self.assertTrue(tax.is_ancestor_of('47770', '1578_1'))
+
+    def test06(self):
+        """
+        nodes are not added to memory if they can't be added to the
+        database
+        """
+
+        self.assertRaises(IntegrityError, self.tax.add_node,
+                          tax_id='1280', parent_id='1279', rank='species',
+                          tax_name='foo', source_id=2)
+        self.assertEqual(len(self.tax.tax_ids()),
+                         len(self.expected.tax_ids()))
+        self.assertRaises(ValueError, self.tax.primary_from_name, 'foo')
+        self.assertEqual(self.tax.lineage('1280'),
+                         self.expected.lineage('1280'))
+
 
 def test__node():
     engine = create_engine(
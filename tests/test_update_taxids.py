@@ -6,8 +6,12 @@ import config
 import filecmp
 import logging
 import os
+import shutil
 import sys
 
+from sqlalchemy import create_engine
+
+from taxtastic import ncbi
 from taxtastic.scripts import taxit
 
 log = logging.getLogger(__name__)
@@ -87,3 +91,71 @@ class TestUpdateTaxids(config.TestBase):
         log.info(self.log_info + ' '.join(map(str, args)))
         self.main(args)
         self.assertTrue(filecmp.cmp(out_info, ref_info))
+
+    def test05(self):
+        """
+        --append-lineage gives the same result using table lineages
+        """
+
+        outdir = self.mkoutdir()
+        dbname = os.path.join(outdir, 'taxonomy.db')
+        shutil.copyfile(self.small_taxonomy_db, dbname)
+        engine = create_engine('sqlite:///' + dbname)
+        ncbi.build_lineages(engine)
+        engine.dispose()
+
+        # warnings of unknown tax_ids
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = lambda record: warnings.append(record.getMessage())
+        logger = logging.getLogger('taxtastic.subcommands.update_taxids')
+        logger.addHandler(handler)
+        try:
+            for rank in ['genus', 'below_order', 'subspecies']:
+                outputs = []
+                for db in [self.small_taxonomy_db, dbname]:
+                    out = os.path.join(outdir, 'update.csv')
+                    del warnings[:]
+                    self.main(['--ignore-unknowns', '--append-lineage', rank,
+                               '--out', out, self.seq_info, db])
+                    with open(out) as f:
+                        outputs.append((f.read(), [
+                            w for w in warnings if 'not found' in w]))
+                self.assertTrue(outputs[0][1])
+                self.assertEqual(outputs[0], outputs[1])
+        finally:
+            logger.removeHandler(handler)
+
+    def test06(self):
+        """
+        --fuzzy-matches lists similar names for unknown rows
+        """
+
+        outdir = self.mkoutdir()
+        dbname = os.path.join(outdir, 'taxonomy.db')
+        shutil.copyfile(self.small_taxonomy_db, dbname)
+        engine = create_engine('sqlite:///' + dbname)
+        ncbi.build_fuzzy_index(engine)
+        engine.dispose()
+
+        seq_info = os.path.join(outdir, 'seq_info.csv')
+        with open(seq_info, 'w') as f:
+            f.write('tax_id,tax_name\n'
+                    '1280,Staphylococcus aureus\n'
+                    'missing,Escherichia colli\n')
+        fuzzy_matches = os.path.join(outdir, 'fuzzy.csv')
+        self.main(['--ignore-unknowns', '--name-column', 'tax_name',
+                   '--fuzzy-matches', fuzzy_matches, '--max-candidates', 1,
+                   '--out', os.path.join(outdir, 'update.csv'),
+                   seq_info, dbname])
+        with open(fuzzy_matches) as f:
+            self.assertEqual(f.read().splitlines(), [
+                'name,tax_name,distance,tax_id',
+                'Escherichia colli,Escherichia coli,1,562'])
+
+        # the file is opened when arguments are parsed
+        self.assertRaises(
+            SystemExit, self.main,
+            ['--ignore-unknowns', '--name-column', 'tax_name',
+             '--fuzzy-matches', os.path.join(outdir, 'missing', 'fuzzy.csv'),
+             seq_info, dbname])
@@ -19,6 +19,22 @@ def check_val(val):
     return isinstance(val, str) and '.' not in val
 
 
+class TestEditDistance(unittest.TestCase):
+
+    def test01(self):
+        edit_distance = taxtastic.utils.edit_distance
+        self.assertEqual(edit_distance('', ''), 0)
+        self.assertEqual(edit_distance('kitten', 'sitting'), 3)
+        self.assertEqual(edit_distance('sitting', 'kitten'), 3)
+        self.assertEqual(edit_distance('abc', ''), 3)
+
+    def test02(self):
+        edit_distance = taxtastic.utils.edit_distance
+        self.assertEqual(edit_distance('kitten', 'sitting', limit=3), 3)
+        self.assertEqual(edit_distance('kitten', 'sitting', limit=1), 2)
+        self.assertEqual(edit_distance('a', 'abcdef', limit=2), 3)
+
+
 class TestGetNewNodes(unittest.TestCase):
 
     def setUp(self):